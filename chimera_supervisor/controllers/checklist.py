@@ -6,8 +6,6 @@ from chimera_supervisor.controllers.model import (Session, List, CheckTime, Chec
                                                   CheckDome, CheckTelescope, CheckWeatherStation,
                                                   CheckTransparency, CheckInstrumentFlag,
                                                   Response)
-from chimera_supervisor.controllers.iostatus_model import Session as ioSession
-from chimera_supervisor.controllers.iostatus_model import InstrumentOperationStatus, KeyList
 
 from chimera_supervisor.controllers.handlers import (CheckHandler, TimeHandler,
                                                      HumidityHandler, TemperatureHandler, TransparencyHandler,
@@ -16,17 +14,27 @@ from chimera_supervisor.controllers.handlers import (CheckHandler, TimeHandler,
                                                      DomeHandler, TelescopeHandler, CheckWeatherStationHandler)
 from chimera_supervisor.controllers import baseresponse
 from chimera_supervisor.controllers.status import FlagStatus, ResponseStatus, InstrumentOperationFlag
+from chimera_supervisor.controllers.scheduler.ephemeris import SiteEphemeris
 
 from chimera.core.exceptions import ObjectNotFoundException, InvalidLocationException
-from chimera_supervisor.core.exceptions import CheckAborted,CheckExecutionException
+from chimera_supervisor.core.exceptions import (CheckAborted, CheckExecutionException, ProxyTimeoutException,
+                                                CircuitOpenException)
+
+from sqlalchemy.orm import object_mapper
 
 import logging
 import threading
 import inspect
 import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 # log = logging.getLogger(__name__.replace("_manager",".supervisor"))
 
+# Result of items that must be checked after the responses of the items before them (see CheckList.checkAll).
+DEFERRED = 'DEFERRED'
+
+
 class CheckList(object):
 
     def __init__(self, controller):
@@ -53,8 +61,19 @@ class CheckList(object):
                               CheckWeatherStation: CheckWeatherStationHandler,
                               CheckTelescope: TelescopeHandler,
                               }
+        # Handlers of checks that read what responses write (instrument flags) or wait for the user. Items with
+        # these checks are not checked ahead of the responses of previous items.
+        self.sequentialHandlers = [InstrumentFlagHandler, AskListenerHandler]
+        # Handlers that wait for the user, they take as long as the check asks and are not bounded by check_timeout
+        self.userHandlers = [AskListenerHandler]
+
         self.itemsList = {}
         self.responseList = {}
+        self.siteEphemeris = {}
+
+        # Items are checked concurrently, each check with a timeout, responses run one at a time
+        self._itemPool = None
+        self._responseLock = threading.RLock()
 
     def __start__(self):
 
@@ -69,6 +88,10 @@ class CheckList(object):
         for handler in self.checkHandlers.values():
             self._injectInstrument(handler)
 
+        workers = self.controller["check_workers"]
+        if workers is not None and workers > 1:
+            self._itemPool = ThreadPool(workers)
+
         # Configure base responses
         for name,obj in inspect.getmembers(baseresponse):
             if inspect.isclass(obj) and issubclass(obj,baseresponse.BaseResponse):
@@ -81,39 +104,120 @@ class CheckList(object):
         # Todo: Configure user-defined responses
 
         # Read instrument status flag from database
-        session = ioSession()
         self.log.debug('Loading flags from the database')
+        flags = self.controller.statusStore.load(self.controller.getInstrumentList())
         for inst_ in self.controller.getInstrumentList():
-            status = session.query(InstrumentOperationStatus).filter(InstrumentOperationStatus.instrument == inst_)
-            if status.count() == 0:
-                self.log.warning("No %s intrument on database. Adding with status UNSET."%inst_)
-                iostatus = InstrumentOperationStatus(instrument = inst_,
-                                                     status = InstrumentOperationFlag.UNSET.index,
-                                                     lastUpdate = self.controller.site().ut().replace(tzinfo=None),
-                                                     lastChange = self.controller.site().ut().replace(tzinfo=None))
-                session.add(iostatus)
-                session.commit()
-            else:
-                self.log.debug('%s[%s]' % (inst_,InstrumentOperationFlag[status[0].status]) )
-                self.controller.setFlag(inst_,
-                                        InstrumentOperationFlag[status[0].status],
-                                        False)
-
+            self.log.debug('%s[%s]' % (inst_,flags[inst_]) )
+            self.controller.setFlag(inst_,
+                                    flags[inst_],
+                                    False)
+        self.controller.statusStore.start()
 
         return
 
     def check(self, item):
+        '''
+        Run the checks of an item and, if needed, its responses.
+        '''
+        self.respond(item, self.evaluate(item))
 
-        t0 = time.time()
+    def isIndependent(self, item):
+        '''
+        True if the checks of item do not depend on the responses of other items.
+        '''
+        for check in item.check:
+            if self.checkHandlers.get(type(check)) in self.sequentialHandlers:
+                return False
+        return True
+
+    def checkAll(self, items):
+        '''
+        Evaluate the checks of all independent items concurrently (see evaluate). The result of the other items is
+        DEFERRED, they are evaluated by respond.
+
+        :return: list with the result of each item, either what evaluate returns, the exception it raised or DEFERRED.
+        '''
+        def evaluate(item):
+            if not (item.active and self.isIndependent(item)):
+                return DEFERRED
+            try:
+                return self.evaluate(item)
+            except Exception, e:
+                return e
+
+        if self._itemPool is None or len(items) < 2:
+            return [evaluate(item) for item in items]
+
+        return self._itemPool.map(evaluate, items, chunksize=1)
+
+    def dependencies(self, items):
+        '''
+        Map of events (see Supervisor.trigger) to the ids of the active items that must be checked when they happen,
+        from the triggers of the items and from what their checks look at (see CheckHandler.triggers).
+        '''
+        dependencies = {}
+        for item in items:
+            if not item.active:
+                continue
+            events = set([event.strip() for event in (item.triggers or '').split(',') if event.strip()])
+            for check in item.check:
+                handler = self.checkHandlers.get(type(check))
+                if handler is not None:
+                    events.update(handler.triggers(check))
+            for event in events:
+                dependencies.setdefault(event, set()).add(item.id)
+        return dependencies
+
+    def weatherTtl(self, items):
+        '''
+        Time weather readings may be shared by the checks: "weather_ttl" of the controller, but no longer than the
+        period of the active items that read the weather stations, so each of their checks sees new readings.
+        '''
+        ttl = self.controller["weather_ttl"]
+        for item in items:
+            if not (item.active and item.period):
+                continue
+            for check in item.check:
+                handler = self.checkHandlers.get(type(check))
+                if handler is not None and "weatherstations" in getattr(handler.process, "__requires__", []):
+                    ttl = min(ttl, item.period)
+                    break
+        return ttl
+
+    def prepare(self, items):
+        '''
+        Load the checks and responses of the items, so they can be evaluated in other threads without touching the
+        database session.
+        '''
+        def load(obj):
+            for attr in object_mapper(obj).column_attrs:
+                getattr(obj, attr.key)
+
+        for item in items:
+            load(item)
+            for check in item.check:
+                load(check)
+            for response in item.response:
+                load(response)
+
+    def close(self):
+        if self._itemPool is not None:
+            self._itemPool.terminate()
+        self._itemPool = None
+
+    def evaluate(self, item):
+        '''
+        Run the checks of an item, in order, until one of them fails. Checks are bounded by the "check_timeout" of
+        the controller (see _process). Safe to call from several threads for different items.
 
-        self.mustStop.clear()
+        :return: (status, run_status, msg, t0) or None if the item is inactive.
+        '''
+        t0 = time.time()
 
         self.log.debug('Checking if item is active...')
         if not item.active:
             self.log.debug('Item is inactive. skipping...')
-            item.lastUpdate = self.controller.site().ut().replace(tzinfo=None)
-            item.status = int(FlagStatus.UNKNOWN.index)
-            return
+            return None
 
         self.log.debug('Running check list...')
 
@@ -130,16 +234,17 @@ class CheckList(object):
             try:
                 self.currentCheck = check
                 try:
-                    self.currentHandler = self.checkHandlers[type(check)]
+                    handler = self.checkHandlers[type(check)]
                 except KeyError:
                     self.log.error("No handler to %s item. Skipping it" % check)
                     continue
+                self.currentHandler = handler
 
-                logMsg = str(self.currentHandler.log(check))
+                logMsg = str(handler.log(check))
                 self.log.debug("[start] %s " % logMsg)
                 self.controller.checkBegin(check, logMsg)
 
-                i_status,i_msg = self.currentHandler.process(check) # return response id
+                i_status,i_msg = self._process(handler, check) # return response id
                 # self.log.debug("%s and (%s or (%s != %s)) = %s" % (i_status,
                 #                                                    item.eager,
                 #                                                    i_status,
@@ -157,6 +262,22 @@ class CheckList(object):
             except CheckExecutionException, e:
                 self.controller.checkComplete(check, FlagStatus.ERROR)
                 raise
+            except CheckAborted:
+                raise
+            except CircuitOpenException, e:
+                # Instrument is known not to answer, mark the item as error right away
+                self.log.warning("Check %s not run: %s" % (check, e))
+                self.controller.checkComplete(check, FlagStatus.ERROR)
+                run_status = False
+                status = int(FlagStatus.ERROR.index)
+                msg += str(e)
+                break
+            except (TimeoutError, ProxyTimeoutException), e:
+                self.log.warning("Check %s timed out." % check)
+                self.controller.checkComplete(check, FlagStatus.ERROR)
+                run_status = False
+                status = False
+                break
             except Exception, e:
                 self.log.debug("Exception in check routine: %s" % repr(e))
                 self.controller.checkComplete(check, FlagStatus.ERROR)
@@ -168,42 +289,92 @@ class CheckList(object):
 
         self.log.debug("[start] %s: %s " % (status,msg))
 
-        if run_status:
+        return status, run_status, msg, t0
 
-            self.controller.itemStatusChanged(item,status)
-            # Get response
-            for response in item.response:
-                response_status = ResponseStatus.OK
-                try:
-                    self.log.debug('%s' % response.response_id)
-                    self.currentResponse = self.responseList[response.response_id]
-                    self.controller.itemResponseBegin(item,self.currentResponse)
-                    self.currentResponse.process(response)
-                except KeyError:
-                    self.log.warning("No handler to response %s. Skipping it" % response.response_id)
-                    response_status = ResponseStatus.ERROR
-                    if not item.eager_response:
-                        self.log.info("Running in non-eager response mode. Stopping.")
-                        break
-                except Exception, e:
-                    self.log.exception(e)
-                    response_status = ResponseStatus.ERROR
-                    if not item.eager_response:
-                        self.log.info("Running in non-eager response mode. Stopping.")
-                        break
-                finally:
-                    self.controller.itemResponseComplete(item, self.currentResponse, status)
+    def _process(self, handler, check):
+        '''
+        Call handler in the calling thread. The instrument calls of the handlers give up after their ProxyGuard
+        deadline, which is at most "check_timeout" (see _injectInstrument), so a check never holds a worker for long.
+        A check that still took more than "check_timeout" (e.g. after many slow calls) is taken as timed out.
+
+        :raise TimeoutError: if the handler took longer than "check_timeout".
+        '''
+        t0 = time.time()
+        result = handler.process(check)
+
+        timeout = self.controller["check_timeout"]
+        if timeout is not None and timeout > 0. and handler not in self.userHandlers and time.time()-t0 > timeout:
+            raise TimeoutError('%s took %.1f s, more than %.1f s.' % (handler.__name__, time.time()-t0, timeout))
+        return result
+
+    def _checkDeadline(self, instrument):
+        # deadline of the instrument calls of the checks, bounded by check_timeout
+        deadline = self.controller.guard.deadlineFor(instrument)
+        timeout = self.controller["check_timeout"]
+        if timeout is None or timeout <= 0.:
+            return deadline
+        if deadline is None or deadline <= 0.:
+            return timeout
+        return min(deadline, timeout)
+
+    def respond(self, item, result):
+        '''
+        Run the responses of an item given the result of evaluate and update its status. Responses of different items
+        never run at the same time.
+        '''
+        if result is DEFERRED:
+            result = self.evaluate(item)
+        elif isinstance(result, Exception):
+            raise result
 
-            # currentResponse = self.responseList[item.response]
-            #
-            # currentResponse.process(check)
+        if result is None:
+            item.lastUpdate = self.controller.site().ut().replace(tzinfo=None)
+            item.status = int(FlagStatus.UNKNOWN.index)
+            return
 
-            # item.status = status.index
-            item.lastChange = self.controller.site().ut().replace(tzinfo=None)
-            self.controller.itemResponseComplete(item,msg)
+        status, run_status, msg, t0 = result
+
+        if status == FlagStatus.ERROR.index and item.status != status:
+            self.controller.itemStatusChanged(item, FlagStatus.ERROR)
+
+        with self._responseLock:
+            if run_status:
+
+                self.controller.itemStatusChanged(item,status)
+                # Get response
+                for response in item.response:
+                    response_status = ResponseStatus.OK
+                    try:
+                        self.log.debug('%s' % response.response_id)
+                        self.currentResponse = self.responseList[response.response_id]
+                        self.controller.itemResponseBegin(item,self.currentResponse)
+                        self.currentResponse.process(response)
+                    except KeyError:
+                        self.log.warning("No handler to response %s. Skipping it" % response.response_id)
+                        response_status = ResponseStatus.ERROR
+                        if not item.eager_response:
+                            self.log.info("Running in non-eager response mode. Stopping.")
+                            break
+                    except Exception, e:
+                        self.log.exception(e)
+                        response_status = ResponseStatus.ERROR
+                        if not item.eager_response:
+                            self.log.info("Running in non-eager response mode. Stopping.")
+                            break
+                    finally:
+                        self.controller.itemResponseComplete(item, self.currentResponse, status)
+
+                # currentResponse = self.responseList[item.response]
+                #
+                # currentResponse.process(check)
+
+                # item.status = status.index
+                item.lastChange = self.controller.site().ut().replace(tzinfo=None)
+                self.controller.itemResponseComplete(item,msg)
 
         item.lastUpdate = self.controller.site().ut().replace(tzinfo=None)
         item.status = status
+        self.controller.history.itemChecked(item.name, status, run_status, time.time()-t0 if run_status else None)
 
         self.log.debug("[finish] took: %f s" % (time.time() - t0))
 
@@ -214,83 +385,28 @@ class CheckList(object):
         :return:
         '''
 
-        for response in item.response:
-            try:
-                self.log.debug('%s' % response.response_id)
-                currentResponse = self.responseList[response.response_id]
-                currentResponse.process(response)
-            except KeyError:
-                self.log.error("No handler to response %s. Skipping it" % response.response_id)
-                return
-            except Exception, e:
-                self.log.exception(e)
-                return
+        with self._responseLock:
+            for response in item.response:
+                try:
+                    self.log.debug('%s' % response.response_id)
+                    currentResponse = self.responseList[response.response_id]
+                    currentResponse.process(response)
+                except KeyError:
+                    self.log.error("No handler to response %s. Skipping it" % response.response_id)
+                    return
+                except Exception, e:
+                    self.log.exception(e)
+                    return
 
 
     def updateInstrumentStatus(self,instrument,status,key=None):
-        session = ioSession()
-        iostatus = session.query(InstrumentOperationStatus).filter(InstrumentOperationStatus.instrument == instrument)[0]
-        iostatus_keys = session.query(KeyList).filter(KeyList.key_id == iostatus.id)
-        str_keys = [k.key for k in iostatus_keys]
-        active_keys = [k.active for k in iostatus_keys]
-        # session.commit()
-
-        self.log.debug("Update %s status: %s -> %s" % (instrument,
-                                                       InstrumentOperationFlag[iostatus.status],
-                                                       status))
-        if iostatus.status != InstrumentOperationFlag.LOCK.index: # Instrument currently unlocked
-            iostatus.status = status.index # just flip status flag
-
-            if key is not None and status == InstrumentOperationFlag.LOCK: # new status is a lock
-                if key in str_keys: # Activating existing key
-                    iostatus_keys[str_keys.index(key)].active = True
-                    iostatus_keys[str_keys.index(key)].updatetime = self.controller.site().ut().replace(tzinfo=None)
-                else: # Creating new key
-                    newkey = KeyList(key_id=iostatus.id,
-                                     key=key,
-                                     updatetime=self.controller.site().ut().replace(tzinfo=None),
-                                     active=True)
-                    session.add(newkey)
-        else: # Instrument is locked
-
-            if status != InstrumentOperationFlag.LOCK: # it is an unlock operation
-                if key in str_keys:# and key is in the list
-                    active_keys[str_keys.index(key)] = False
-                    iostatus_keys[str_keys.index(key)].active = False
-                    iostatus_keys[str_keys.index(key)].updatetime = self.controller.site().ut().replace(tzinfo=None)
-                if True not in active_keys: # able to unlock instrument
-                    iostatus.status = status.index
-                else:
-                    # Could not unlock instrument
-                    session.commit()
-                    return False
-
-            else: # it is a new lock operation
-                if key in str_keys: # Activating existing key
-                    iostatus_keys[str_keys.index(key)].active = True
-                    iostatus_keys[str_keys.index(key)].updatetime = self.controller.site().ut().replace(tzinfo=None)
-                else: # Creating new key
-                    newkey = KeyList(key_id=iostatus.id,
-                                     key=key,
-                                     updatetime=self.controller.site().ut().replace(tzinfo=None),
-                                     active=True)
-                    session.add(newkey)
-
-        session.commit()
-        return True
+        return self.controller.statusStore.update(instrument, status, key)
 
     def getInstrumentStatus(self,instrument):
-        session = ioSession()
-        iostatus = session.query(InstrumentOperationStatus).filter(InstrumentOperationStatus.instrument == instrument)
-
-        return InstrumentOperationFlag[iostatus[0].status]
+        return self.controller.statusStore.status(instrument)
 
     def instrumentKey(self,instrument):
-        session = ioSession()
-        iostatus = session.query(InstrumentOperationStatus).filter(InstrumentOperationStatus.instrument == instrument)[0]
-        iostatus_keys = session.query(KeyList).filter(KeyList.key_id == iostatus.id, KeyList.active == True)
-
-        return [k.key for k in iostatus_keys]
+        return self.controller.statusStore.keys(instrument)
 
     def activate(self,item):
         session = Session()
@@ -359,6 +475,18 @@ class CheckList(object):
                     for i, inst in enumerate(instrument_location_list):
                         try:
                             inst_manager = self.controller.getManager().getProxy(inst)
+                            if instrument == "site" and issubclass(handler, CheckHandler):
+                                # Handlers only compute times and positions from the site, do it locally.
+                                if inst not in self.siteEphemeris:
+                                    self.siteEphemeris[inst] = SiteEphemeris.fromSite(inst_manager)
+                                inst_manager = self.siteEphemeris[inst]
+                            elif issubclass(handler, CheckHandler):
+                                inst_manager = self.controller.guard.wrap(instrument, inst, inst_manager,
+                                                                          self._checkDeadline(instrument))
+                            else:
+                                # responses move things around, they get a longer deadline
+                                inst_manager = self.controller.guard.wrap(instrument, inst, inst_manager,
+                                                                          self.controller["response_deadline"])
                             instrument_proxy_list.append(inst_manager)
                         except Exception, e:
                             self.log.error('Could not inject %s %s on %s handler' % (instrument,
@@ -367,6 +495,8 @@ class CheckList(object):
                             self.log.exception(e)
                     if len(instrument_proxy_list) > 0:
                         setattr(handler,instrument,instrument_proxy_list)
+                        if instrument == "weatherstations" and len(self.controller.weather) == 0:
+                            self.controller.weather.setStations(instrument_proxy_list)
                 else:
                     setattr(handler,instrument,[ None , ])
                     self.log.warning('Instrument %s not given.' % instrument)
@@ -375,3 +505,7 @@ class CheckList(object):
             except InvalidLocationException, e:
                 self.log.error("No instrument (%s) to inject on %s handler" % (instrument,handler))
 
+            if instrument == "weatherstations":
+                # Handlers read the weather from the snapshot shared by all of them
+                setattr(handler, "weather", self.controller.weather)
+
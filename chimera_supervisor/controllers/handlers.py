@@ -1,5 +1,7 @@
 import datetime
 
+from chimera_supervisor.core.exceptions import ProxyTimeoutException, CircuitOpenException
+
 def requires(instrument):
     """Simple dependecy injection mechanism. See ProgramExecutor"""
 
@@ -26,6 +28,13 @@ class CheckHandler(object):
     def log(check):
         return str(check)
 
+    @staticmethod
+    def triggers(check):
+        '''
+        Events (see Supervisor.trigger) that may change the result of check, so it is run right away when they happen.
+        '''
+        return []
+
 class TimeHandler(CheckHandler):
     '''
     This class checks if now is before of after a specified time delta with respect to a specific sun event.
@@ -103,20 +112,9 @@ class HumidityHandler(CheckHandler):
     @requires("weatherstations")
     def process(check):
 
-        weatherstations = HumidityHandler.weatherstations
         site = HumidityHandler.site[0]
 
-        manager = HumidityHandler.manager
-
-        humidity = None
-        for i in range(len(weatherstations)):
-            try:
-                h = weatherstations[i].humidity()
-                if datetime.datetime.utcnow() - h.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    humidity = h
-                    break
-            except:
-                pass
+        humidity = HumidityHandler.weather.first('humidity')
 
         if humidity is None:
             return check.mode == 0, "No valid weather station data available!"
@@ -162,20 +160,9 @@ class TemperatureHandler(CheckHandler):
     @requires("site")
     @requires("weatherstations")
     def process(check):
-        weatherstations = TemperatureHandler.weatherstations
         site = TemperatureHandler.site[0]
 
-        manager = TemperatureHandler.manager
-
-        temperature = None
-        for i in range(len(weatherstations)):
-            try:
-                t = weatherstations[i].temperature()
-                if datetime.datetime.utcnow() - t.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    humidity = t
-                    break
-            except:
-                pass
+        temperature = TemperatureHandler.weather.first('temperature')
 
         if temperature is None:
             return check.mode == 0, "No valid weather station data available!"
@@ -222,20 +209,9 @@ class WindSpeedHandler(CheckHandler):
     @requires("site")
     @requires("weatherstations")
     def process(check):
-        weatherstations = WindSpeedHandler.weatherstations
         site = WindSpeedHandler.site[0]
 
-        manager = WindSpeedHandler.manager
-
-        windspeed = None
-        for i in range(len(weatherstations)):
-            try:
-                s = weatherstations[i].wind_speed()
-                if datetime.datetime.utcnow() - s.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    windspeed = s
-                    break
-            except:
-                pass
+        windspeed = WindSpeedHandler.weather.first('wind_speed')
         if windspeed is None:
             return check.mode == 0, "No valid weather station data available!"
 
@@ -280,9 +256,12 @@ class DewPointHandler(CheckHandler):
     @staticmethod
     @requires("weatherstations")
     def process(check):
-        weatherstation = DewPointHandler.weatherstations
+        dewpoint = DewPointHandler.weather.first('dew_point')
 
-        ret = check.dewpoint > weatherstation.dew_point()
+        if dewpoint is None:
+            return False, "No valid weather station data available!"
+
+        ret = check.dewpoint > dewpoint.value
         msg = "Dew point OK" if not ret else "Dew point lower than specified threshold"
         return ret, msg
 
@@ -297,22 +276,12 @@ class TransparencyHandler(CheckHandler):
     Process will return True if dew point is bellow specified threshold  or False, otherwise.
     '''
     @staticmethod
+    @requires("site")
     @requires("weatherstations")
     def process(check):
-        weatherstations = WindSpeedHandler.weatherstations
-        site = WindSpeedHandler.site[0]
+        site = TransparencyHandler.site[0]
 
-        manager = WindSpeedHandler.manager
-
-        transparency = None
-        for i in range(len(weatherstations)):
-            try:
-                t = weatherstations[i].sky_transparency()
-                if datetime.datetime.utcnow() - t.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    transparency = t
-                    break
-            except:
-                pass
+        transparency = TransparencyHandler.weather.first('sky_transparency')
 
         if transparency is None:
             return check.mode == 0, "No valid weather station data available!"
@@ -375,24 +344,17 @@ class DewHandler(CheckHandler):
     @requires("site")
     @requires("weatherstations")
     def process(check):
-        weatherstations = DewHandler.weatherstations
+        weather = DewHandler.weather
         site = DewHandler.site[0]
 
-        temperature = None # weatherstation.temperature()
-        dewpoint = None # weatherstation.dew_point()
-
-        manager = DewHandler.manager
+        temperature = None
+        dewpoint = None
 
-        for i in range(len(weatherstations)):
-            try:
-                t = weatherstations[i].temperature()
-                d = weatherstations[i].dew_point()
-                if datetime.datetime.utcnow() - t.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    temperature = t
-                    dewpoint = d
-                    break
-            except:
-                pass
+        for t, d in zip(weather.readings('temperature'), weather.readings('dew_point')):
+            if weather.isFresh(t) and d is not None:
+                temperature = t
+                dewpoint = d
+                break
 
         if (temperature is None) or (dewpoint is None):
             return check.mode == 0, "No valid weather station data available!"
@@ -534,34 +496,42 @@ class TelescopeHandler(CheckHandler):
     def log(check):
         return "%s"%(check)
 
+    @staticmethod
+    def triggers(check):
+        if abs(check.mode) == 1:
+            return ["parkComplete", "unparkComplete"]
+        elif abs(check.mode) == 3:
+            return ["slewBegin", "slewComplete"]
+        elif abs(check.mode) == 4:
+            return ["slewBegin", "trackingStarted", "trackingStopped"]
+        return []
+
 class CheckWeatherStationHandler(CheckHandler):
 
     @staticmethod
     @requires("weatherstations")
     def process(check):
-        manager = CheckWeatherStationHandler.manager
-        weatherstations = CheckWeatherStationHandler.weatherstations
+        weather = CheckWeatherStationHandler.weather
 
-        ws = weatherstations[check.index]
+        # this item checks the station itself, one that does not answer is just not OK
         try:
-            t = ws.temperature()
-            if check.mode == 0:
-                # Check if WS is ok
-                if datetime.datetime.utcnow() - t.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    return True, "Weather station data OK!"
-                else:
-                    return False, "No valid weather station data available!"
-            elif check.mode == 1:
-                # Check if WS is not OK
-                if datetime.datetime.utcnow() - t.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    return False, "Weather station data OK!"
-                else:
-                    return True, "No valid weather station data available!"
-        except:
-            if check.mode == 0:
-                return False, "No valid weather station data available!"
+            ok = weather.isFresh(weather.reading('temperature', check.index))
+            msg = "No valid weather station data available!"
+        except (ProxyTimeoutException, CircuitOpenException), e:
+            ok = False
+            msg = "Weather station not answering: %s" % e
+        if check.mode == 0:
+            # Check if WS is ok
+            if ok:
+                return True, "Weather station data OK!"
+            else:
+                return False, msg
+        elif check.mode == 1:
+            # Check if WS is not OK
+            if ok:
+                return False, "Weather station data OK!"
             else:
-                return True, "No valid weather station data available!"
+                return True, msg
 
 
     @staticmethod
@@ -601,4 +571,8 @@ class InstrumentFlagHandler(CheckHandler):
 
     @staticmethod
     def log(check):
-        return '%s' % check
\ No newline at end of file
+        return '%s' % check
+
+    @staticmethod
+    def triggers(check):
+        return ["flag:%s" % check.instrument]
\ No newline at end of file
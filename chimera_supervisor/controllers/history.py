@@ -0,0 +1,347 @@
+'''
+History of the instrument flags and of the checklist results. Every flag change and item result is appended to the
+status database in batches by a HistoryRecorder, and the functions bellow aggregate them over a time window (time in
+each flag, fraction of time an item was true, reaction time of the responses). Queries use the (instrument, time) and
+(item, time) indexes, so they only read the records inside the window. The time spent in each status is also summed
+per day (HistoryDay) as records are written, so long windows read the daily sums and only the records of the days at
+their edges.
+'''
+
+import datetime
+import threading
+import logging
+
+from sqlalchemy import func, literal, and_, or_
+from sqlalchemy.orm import aliased
+
+from chimera_supervisor.controllers.iostatus_model import (Session, ScopedSession, FlagHistory, ItemHistory,
+                                                           HistoryDay, HistoryRollup)
+from chimera_supervisor.controllers.status import InstrumentOperationFlag
+
+log = logging.getLogger(__name__)
+
+# Flags of an instrument that count as up
+UP_FLAGS = [InstrumentOperationFlag.READY.index, InstrumentOperationFlag.OPERATING.index]
+
+# Kinds of history (see HistoryDay): model and column with the instrument or item name
+KINDS = {'flag': (FlagHistory, 'instrument'),
+         'item': (ItemHistory, 'item')}
+
+_DAY = datetime.timedelta(days=1)
+
+
+class HistoryRecorder(object):
+    '''
+    Gathers flag changes and item results in memory and writes them in batches.
+
+    :param flushInterval: time (s) between writes.
+    :param maxBatch: number of records that triggers a write before flushInterval.
+    :param session: sessionmaker of the status database.
+    '''
+
+    def __init__(self, flushInterval=10., maxBatch=500, session=ScopedSession):
+        self.flushInterval = flushInterval
+        self.maxBatch = maxBatch
+        self._session = session
+
+        self._flags = []
+        self._items = []
+        self._lock = threading.Lock()
+        self._writeLock = threading.Lock()
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._writer = None
+
+    def flagChanged(self, instrument, status, time=None):
+        '''
+        :param status: new flag (InstrumentOperationFlag).
+        '''
+        with self._lock:
+            self._flags.append({'time': time or datetime.datetime.utcnow(),
+                                'instrument': instrument,
+                                'status': status.index})
+            if len(self._flags) >= self.maxBatch:
+                self._wake.set()
+
+    def itemChecked(self, item, status, responded=False, latency=None, time=None):
+        '''
+        :param item: name of the item.
+        :param status: item status, as stored in the checklist.
+        :param responded: True if the responses of the item were run.
+        :param latency: time (s) from the start of the check to the end of the responses.
+        '''
+        with self._lock:
+            self._items.append({'time': time or datetime.datetime.utcnow(),
+                                'item': item,
+                                'status': int(status),
+                                'responded': bool(responded),
+                                'latency': latency})
+            if len(self._items) >= self.maxBatch:
+                self._wake.set()
+
+    def start(self):
+        if self._writer is not None:
+            return
+        self._stop.clear()
+        self._writer = threading.Thread(target=self._run, name='HistoryRecorder writer')
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        self.flush()
+
+    def flush(self):
+        '''
+        Write the records gathered so far.
+        '''
+        with self._writeLock:
+            with self._lock:
+                flags, self._flags = self._flags, []
+                items, self._items = self._items, []
+            if not (flags or items):
+                return
+
+            session = self._session()
+            try:
+                if flags:
+                    session.execute(FlagHistory.__table__.insert(), flags)
+                if items:
+                    session.execute(ItemHistory.__table__.insert(), items)
+                session.commit()
+            except Exception:
+                session.rollback()
+                # put them back, they are written with the next batch
+                with self._lock:
+                    self._flags = flags + self._flags
+                    self._items = items + self._items
+                session.close()
+                raise
+
+            # the daily sums catch up with the next batch if this fails
+            try:
+                for kind, name in set([('flag', flag['instrument']) for flag in flags] +
+                                      [('item', item['item']) for item in items]):
+                    rollup(session, kind, name)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+    def rollupAll(self):
+        '''
+        Add the records of all instruments and items not summed yet to the daily sums (e.g. records written before
+        the daily sums existed).
+        '''
+        with self._writeLock:
+            session = self._session()
+            try:
+                for kind, (model, column) in KINDS.items():
+                    for name, in session.query(getattr(model, column)).distinct().all():
+                        rollup(session, kind, name)
+                        session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+    def _run(self):
+        try:
+            self.rollupAll()
+        except Exception, e:
+            log.exception(e)
+
+        while not self._stop.isSet():
+            self._wake.wait(self.flushInterval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception, e:
+                log.exception(e)
+
+
+def _day(time):
+    return datetime.datetime(time.year, time.month, time.day)
+
+
+def rollup(session, kind, name):
+    '''
+    Add the time between the records of instrument or item name (kind "flag" or "item") written since its last
+    rollup to the daily sums (HistoryDay). Records are taken in time order, as written by HistoryRecorder. The
+    caller commits session.
+    '''
+    model, column = KINDS[kind]
+    state = session.query(HistoryRollup).filter(HistoryRollup.kind == kind, HistoryRollup.name == name).first()
+
+    records = session.query(model.id, model.time, model.status).filter(getattr(model, column) == name)
+    last = None
+    if state is not None:
+        records = records.filter(or_(model.time > state.time,
+                                     and_(model.time == state.time, model.id > state.record)))
+        last = (state.record, state.time, state.status)
+
+    durations = {}
+    for record in records.order_by(model.time, model.id).yield_per(1000):
+        if last is not None:
+            # time from the last record to this one, split in days
+            start, end = last[1], record[1]
+            while start < end:
+                stop = min(end, _day(start)+_DAY)
+                key = (_day(start), last[2])
+                durations[key] = durations.get(key, 0.) + (stop-start).total_seconds()
+                start = stop
+        last = record
+
+    if last is None:
+        return
+
+    if durations:
+        days = [day for day, status in durations]
+        existing = dict([((row.day, row.status), row) for row in
+                         session.query(HistoryDay).filter(HistoryDay.kind == kind,
+                                                          HistoryDay.name == name,
+                                                          HistoryDay.day >= min(days),
+                                                          HistoryDay.day <= max(days))])
+        for (day, status), seconds in durations.items():
+            if (day, status) in existing:
+                existing[(day, status)].seconds += seconds
+            else:
+                session.add(HistoryDay(kind=kind, name=name, day=day, status=status, seconds=seconds))
+
+    if state is None:
+        state = HistoryRollup(kind=kind, name=name)
+        session.add(state)
+    state.record, state.time, state.status = last
+
+
+def _durations(session, kind, name, start, end):
+    '''
+    Time (s) spent in each status between start and end. Time before the first record is not counted.
+
+    Whole days before the last rollup of name are read from the daily sums, the rest from the records (see
+    _recordDurations).
+    '''
+    state = session.query(HistoryRollup.time).filter(HistoryRollup.kind == kind, HistoryRollup.name == name).first()
+    first = _day(start)
+    if first < start:
+        first += _DAY
+    last = _day(min(end, state[0])) if state is not None and state[0] is not None else None
+
+    if last is None or first >= last:
+        return _recordDurations(session, kind, name, start, end)
+
+    durations = _recordDurations(session, kind, name, start, first)
+    days = session.query(HistoryDay.status, func.sum(HistoryDay.seconds)).filter(HistoryDay.kind == kind,
+                                                                                 HistoryDay.name == name,
+                                                                                 HistoryDay.day >= first,
+                                                                                 HistoryDay.day < last)
+    for status, seconds in days.group_by(HistoryDay.status):
+        durations[status] = durations.get(status, 0.) + seconds
+    for status, seconds in _recordDurations(session, kind, name, last, end).items():
+        durations[status] = durations.get(status, 0.) + seconds
+    return durations
+
+
+def _recordDurations(session, kind, name, start, end):
+    '''
+    Time (s) spent in each status between start and end, from the last record before start and the records in the
+    window. Time before the first record is not counted.
+
+    The durations are summed by the database: each record lasts until the next one (found with the (name, time)
+    index) or until end.
+    '''
+    if start >= end:
+        return {}
+
+    model, column = KINDS[kind]
+    key = getattr(model, column)
+    after = aliased(model)
+    end_ = literal(end, model.__table__.c.time.type)
+
+    nextTime = session.query(func.min(after.time)).filter(getattr(after, column) == name,
+                                                          after.time < end,
+                                                          or_(after.time > model.time,
+                                                              and_(after.time == model.time,
+                                                                   after.id > model.id))).correlate(model).as_scalar()
+    seconds = (func.julianday(func.coalesce(nextTime, end_))-func.julianday(model.time))*86400.
+
+    durations = dict(session.query(model.status, func.sum(seconds)).filter(key == name,
+                                                                           model.time >= start,
+                                                                           model.time < end).group_by(model.status))
+
+    # from start to the first record of the window, in the status of the last record before it
+    last = session.query(model.status).filter(key == name, model.time < start).order_by(model.time.desc()).first()
+    if last is not None:
+        first = session.query(func.min(model.time)).filter(key == name,
+                                                           model.time >= start,
+                                                           model.time < end).scalar()
+        durations[last[0]] = durations.get(last[0], 0.) + ((first or end)-start).total_seconds()
+    return durations
+
+
+def flagStatistics(instrument, start, end, session=None):
+    '''
+    Time in each flag of instrument between start and end (UTC datetimes).
+
+    :return: dictionary with the seconds spent in each flag (by name), the number of flag changes and the uptime, the
+             fraction of the known time the instrument was READY or OPERATING (None if nothing is known).
+    '''
+    session = session or Session()
+    durations = _durations(session, 'flag', instrument, start, end)
+    changes = session.query(func.count(FlagHistory.id)).filter(FlagHistory.instrument == instrument,
+                                                               FlagHistory.time >= start,
+                                                               FlagHistory.time < end).scalar()
+    known = sum(durations.values())
+    up = sum([seconds for status, seconds in durations.items() if status in UP_FLAGS])
+    return {'flags': dict([(str(InstrumentOperationFlag[status]), seconds)
+                           for status, seconds in durations.items() if status is not None]),
+            'changes': changes,
+            'uptime': up/known if known > 0 else None}
+
+
+def itemStatistics(item, start, end, session=None):
+    '''
+    Results of checklist item between start and end (UTC datetimes).
+
+    :return: dictionary with the number of checks, the number of times responses were run, the fraction of the known
+             time the item was true (e.g. the open shutter fraction for an item checking the dome slit, None if
+             nothing is known) and the mean and maximum time (s) from the start of the check to the end of the
+             responses.
+    '''
+    session = session or Session()
+    durations = _durations(session, 'item', item, start, end)
+    window = session.query(ItemHistory).filter(ItemHistory.item == item,
+                                               ItemHistory.time >= start,
+                                               ItemHistory.time < end)
+    checks = window.count()
+    responses, meanLatency, maxLatency = window.filter(ItemHistory.responded == True).with_entities(
+        func.count(ItemHistory.id), func.avg(ItemHistory.latency), func.max(ItemHistory.latency)).one()
+    known = sum(durations.values())
+    return {'checks': checks,
+            'responses': responses,
+            'trueFraction': durations.get(1, 0.)/known if known > 0 else None,
+            'meanLatency': meanLatency,
+            'maxLatency': maxLatency}
+
+
+def summary(instruments, items, start, end):
+    '''
+    Statistics (see flagStatistics and itemStatistics) of all instruments and items between start and end.
+    '''
+    session = Session()
+    try:
+        return {'start': start,
+                'end': end,
+                'instruments': dict([(instrument, flagStatistics(instrument, start, end, session))
+                                     for instrument in instruments]),
+                'items': dict([(item, itemStatistics(item, start, end, session)) for item in items])}
+    finally:
+        session.close()
@@ -1,16 +1,14 @@
 from chimera_supervisor.core.constants import DEFAULT_STATUS_DATABASE
+from chimera_supervisor.core.database import Database
 
 from sqlalchemy import (Column, String, Integer, DateTime, Boolean, ForeignKey,
-                        Float, PickleType, MetaData, create_engine)
+                        Float, PickleType, MetaData, Index)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relation, backref
+from sqlalchemy.orm import relation, backref
 
-engine = create_engine('sqlite:///%s' % DEFAULT_STATUS_DATABASE, echo=False)
+DATABASE_URL = 'sqlite:///%s' % DEFAULT_STATUS_DATABASE
 
 metaData = MetaData()
-metaData.bind = engine
-
-Session = sessionmaker(bind=engine)
 Base = declarative_base(metadata=metaData)
 
 class InstrumentOperationStatus(Base):
@@ -36,4 +34,65 @@ class KeyList(Base):
     __tablename__ = "keylist"
     # __mapper_args__ = {'polymorphic_on': check_type}
 
-metaData.create_all(engine)
+class FlagHistory(Base):
+    '''
+    Every change of an instrument flag. Append only.
+    '''
+    __tablename__ = "flaghistory"
+    id = Column(Integer, primary_key=True)
+    time = Column(DateTime, nullable=False)
+    instrument = Column(String, nullable=False)
+    status = Column(Integer)
+
+    __table_args__ = (Index('ix_flaghistory_instrument_time', 'instrument', 'time'),)
+
+class ItemHistory(Base):
+    '''
+    Every result of a checklist item. Append only.
+    '''
+    __tablename__ = "itemhistory"
+    id = Column(Integer, primary_key=True)
+    time = Column(DateTime, nullable=False)
+    item = Column(String, nullable=False)
+    status = Column(Integer)
+    responded = Column(Boolean, default=False) # responses were run
+    latency = Column(Float, default=None) # time, in seconds, from the start of the check to the end of the responses
+
+    __table_args__ = (Index('ix_itemhistory_item_time', 'item', 'time'),)
+
+class HistoryDay(Base):
+    '''
+    Time, in seconds, an instrument flag or checklist item spent in each status in a (UTC) day, summed from the
+    FlagHistory and ItemHistory records up to the HistoryRollup of the instrument or item. Kept up to date by
+    history.HistoryRecorder.
+    '''
+    __tablename__ = "historyday"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False) # "flag" or "item"
+    name = Column(String, nullable=False) # instrument or item name
+    day = Column(DateTime, nullable=False) # midnight (UTC) starting the day
+    status = Column(Integer)
+    seconds = Column(Float, default=0.)
+
+    __table_args__ = (Index('ix_historyday_kind_name_day', 'kind', 'name', 'day'),)
+
+class HistoryRollup(Base):
+    '''
+    Last FlagHistory or ItemHistory record of an instrument or item summed in HistoryDay. The time after it is not in
+    HistoryDay yet.
+    '''
+    __tablename__ = "historyrollup"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    name = Column(String, nullable=False)
+    record = Column(Integer) # id of the record
+    time = Column(DateTime)
+    status = Column(Integer)
+
+    __table_args__ = (Index('ix_historyrollup_kind_name', 'kind', 'name', unique=True),)
+
+# Created when the first session is opened
+database = Database(DATABASE_URL, metaData, 'CHIMERA_STATUS_DATABASE')
+Session = database.Session
+# Session of the calling thread, for threads that write often (see statusstore and history)
+ScopedSession = database.ScopedSession
@@ -8,15 +8,110 @@ from chimera.core.site import Site
 
 import threading
 import logging
+import heapq
+import random
 
 import time
 
 # log = logging.getLogger(__name__.replace("_manager",".supervisor"))
 
+
+class ItemScheduler(object):
+    '''
+    Keeps when each checklist item must be checked next. Items with a period are kept in a priority queue ordered by
+    the time they are due, items without one are checked at every control cycle of the supervisor. Any item is also
+    due as soon as one of the events it depends on is triggered.
+    '''
+
+    def __init__(self):
+        self._queue = []
+        self._due = {}
+        self._triggers = {}
+        self._triggered = set()
+        self._lock = threading.Lock()
+
+    def _push(self, id, due):
+        self._due[id] = due
+        heapq.heappush(self._queue, (due, id))
+
+    def _clean(self):
+        # drop entries of items that were rescheduled or removed
+        while self._queue and self._due.get(self._queue[0][1]) != self._queue[0][0]:
+            heapq.heappop(self._queue)
+
+    def select(self, items, now, cycle=True):
+        '''
+        Items that must be checked now. Items with a period seen for the first time are due right away. If cycle is
+        True, items without a period are also selected.
+        '''
+        with self._lock:
+            periodic = set()
+            for item in items:
+                if item.period:
+                    periodic.add(item.id)
+                    if item.id not in self._due:
+                        self._push(item.id, now)
+            for id in self._due.keys():
+                if id not in periodic:
+                    del self._due[id]
+
+            due = self._triggered
+            self._triggered = set()
+            self._clean()
+            while self._queue and self._queue[0][0] <= now:
+                t, id = heapq.heappop(self._queue)
+                del self._due[id]
+                due.add(id)
+                self._clean()
+
+        return [item for item in items if item.id in due or (cycle and not item.period)]
+
+    def reschedule(self, item, now):
+        '''
+        Set the next time item is due, after being checked at now.
+        '''
+        if not item.period:
+            return
+        with self._lock:
+            self._push(item.id, now + item.period + random.uniform(0., item.jitter or 0.))
+
+    def setTriggers(self, triggers):
+        '''
+        :param triggers: dictionary with the ids of the items that depend on each event.
+        '''
+        with self._lock:
+            self._triggers = dict(triggers)
+
+    def trigger(self, event):
+        '''
+        Make the items that depend on event due. Returns False if no item depends on it.
+        '''
+        with self._lock:
+            ids = self._triggers.get(event)
+            if not ids:
+                return False
+            self._triggered.update(ids)
+            return True
+
+    def nextDue(self):
+        '''
+        Time the next item is due, or None if there are no items with a period nor triggered items.
+        '''
+        with self._lock:
+            if self._triggered:
+                return 0.
+            self._clean()
+            return self._queue[0][0] if self._queue else None
+
+    def isDue(self, now):
+        due = self.nextDue()
+        return due is not None and due <= now
+
+
 class Machine(threading.Thread):
 
     __state = State.OFF
-    __stateLock = threading.Lock()
+    __stateLock = threading.RLock()
     __wakeUpCall = threading.Condition()
 
     def __init__(self, checklist, controller):
@@ -25,7 +120,8 @@ class Machine(threading.Thread):
         self.checklist = checklist
         self.controller = controller
         self.log = controller.debuglog
-        
+        self.scheduler = ItemScheduler()
+
         self.setDaemon(False)
 
     def state(self, state=None):
@@ -62,7 +158,13 @@ class Machine(threading.Thread):
 
             elif self.state() == State.IDLE:
                 self.log.debug("[idle] waiting for wake-up call..")
-                self.sleep()
+                due = self.scheduler.nextDue()
+                self.sleep(None if due is None else max(0., due-time.time()))
+
+                # check the items that are due, unless a full cycle was started meanwhile
+                if self.scheduler.isDue(time.time()) and self._tick():
+                    self.log.debug("[tick] running due items...")
+                    self._process(cycle=False)
 
             elif self.state() == State.BUSY:
                 self.log.debug("[busy] waiting tasks to finish..")
@@ -81,18 +183,41 @@ class Machine(threading.Thread):
 
         self.log.debug('[shutdown] thread ending...')
 
-    def sleep(self):
+    def sleep(self, timeout=None):
         self.__wakeUpCall.acquire()
         self.log.debug("Sleeping")
-        self.__wakeUpCall.wait()
+        self.__wakeUpCall.wait(timeout)
         self.__wakeUpCall.release()
 
+    def _tick(self):
+        '''
+        Go from IDLE to BUSY. Returns False if the machine was not IDLE.
+        '''
+        self.__stateLock.acquire()
+        try:
+            if self.__state != State.IDLE:
+                return False
+            self.state(State.BUSY)
+            return True
+        finally:
+            self.__stateLock.release()
+
     def wakeup(self):
         self.__wakeUpCall.acquire()
         self.log.debug("Waking up")
         self.__wakeUpCall.notifyAll()
         self.__wakeUpCall.release()
 
+    def trigger(self, event):
+        '''
+        Check right away the items that depend on event.
+        '''
+        if self.scheduler.trigger(event):
+            self.log.debug("[trigger] %s" % event)
+            self.wakeup()
+            return True
+        return False
+
     def runAction(self, name):
 
         session = Session()
@@ -111,7 +236,11 @@ class Machine(threading.Thread):
         else:
             return True
 
-    def _process(self):
+    def _process(self, cycle=True):
+        '''
+        Check the items that are due. A full cycle (started by the supervisor control loop) also checks items
+        without a period.
+        '''
 
         def process ():
 
@@ -126,12 +255,34 @@ class Machine(threading.Thread):
                 self.state(State.OFF)
                 return
 
-            self.log.debug("[start] processing %i items" % checklist.count())
+            items = checklist.all()
+            try:
+                self.scheduler.setTriggers(self.checklist.dependencies(items))
+                self.controller.weather.ttl = self.checklist.weatherTtl(items)
+            except Exception, e:
+                self.log.exception(e)
+            items = self.scheduler.select(items, time.time(), cycle)
+            self.log.debug("[start] processing %i items" % len(items))
+
+            # a stop request only aborts the pass it was made in
+            self.checklist.mustStop.clear()
+            if self.state() != State.BUSY:
+                # stopped while loading the items
+                self.checklist.mustStop.set()
+
+            # Checks of all items run concurrently, responses in list order
+            try:
+                self.checklist.prepare(items)
+                results = self.checklist.checkAll(items)
+            except Exception, e:
+                self.log.exception(e)
+                self.state(State.OFF)
+                return
 
-            for item in checklist:
+            for item, result in zip(items, results):
                 try:
                     self.log.debug("[start] Checking %s"%item)
-                    self.checklist.check(item)
+                    self.checklist.respond(item, result)
                     session.commit()
                 except CheckAborted:
                     self.state(State.OFF)
@@ -140,6 +291,8 @@ class Machine(threading.Thread):
                 except Exception, e:
                     self.log.exception(e)
                     pass
+                finally:
+                    self.scheduler.reschedule(item, time.time())
             try:
                 session.commit()
             except Exception, e:
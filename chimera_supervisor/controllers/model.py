@@ -1,18 +1,16 @@
 from chimera_supervisor.core.constants import DEFAULT_PROGRAM_DATABASE
+from chimera_supervisor.core.database import Database
 
 from sqlalchemy import (Column, String, Integer, DateTime, Boolean, ForeignKey, Time, Interval,
-                        Float, PickleType, MetaData, create_engine)
+                        Float, PickleType, MetaData)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relation, backref
+from sqlalchemy.orm import relation, backref
 
 import datetime
 
-engine = create_engine('sqlite:///%s' % DEFAULT_PROGRAM_DATABASE, echo=False)
+DATABASE_URL = 'sqlite:///%s' % DEFAULT_PROGRAM_DATABASE
 
 metaData = MetaData()
-metaData.bind = engine
-
-Session = sessionmaker(bind=engine)
 Base = declarative_base(metadata=metaData)
 
 class List(Base):
@@ -33,6 +31,13 @@ class List(Base):
     # you want the queue to stop if one of the responses fails (e.g. open dome, open mirror and take flats).
     eager_response      = Column(Boolean, default=True)
 
+    # How often the item is checked (see Machine). Items with period 0 are checked at every control cycle of the
+    # supervisor, others every period seconds plus a random delay of up to jitter seconds, so items with the same
+    # period do not always run together. triggers is a comma separated list of events that check the item right away.
+    period     = Column(Float, default=0.)
+    jitter     = Column(Float, default=0.)
+    triggers   = Column(String, default=None)
+
 
     # check_id     = Column(Integer)
     # response_id     = Column(Integer)
@@ -502,4 +507,22 @@ class ExecuteScript(Response):
     def __str__(self):
         return "[ExecuteScript]: %s" % self.filename
 
-metaData.create_all(engine)
+def upgradeSchema(engine):
+    '''
+    Add to the tables of an existing database the columns created after it. New columns must be nullable or have a
+    server side default.
+    '''
+    quote = engine.dialect.identifier_preparer.quote
+    for table in metaData.sorted_tables:
+        existing = [row[1] for row in engine.execute('PRAGMA table_info(%s)' % quote(table.name))]
+        if len(existing) == 0:
+            continue
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (quote(table.name),
+                                                                   quote(column.name),
+                                                                   column.type.compile(engine.dialect)))
+
+# Created, and its tables upgraded, when the first session is opened
+database = Database(DATABASE_URL, metaData, 'CHIMERA_CHECKLIST_DATABASE', init=upgradeSchema)
+Session = database.Session
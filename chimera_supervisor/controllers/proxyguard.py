@@ -0,0 +1,303 @@
+'''
+Guarded calls to instrument proxies. Every call made by the checklist handlers and responses goes through a
+GuardedProxy, which gives up after a deadline, keeps a latency histogram for each instrument and, after a few
+consecutive timeouts, opens a circuit breaker so further calls to the same instrument fail immediately instead of
+stalling the checklist. After a while a single trial call is let through, if it answers the circuit is closed again.
+'''
+
+import time
+import bisect
+import logging
+import threading
+
+from chimera_supervisor.core.exceptions import ProxyTimeoutException, CircuitOpenException
+
+log = logging.getLogger(__name__)
+
+CIRCUIT_CLOSED = 'CLOSED'
+CIRCUIT_OPEN = 'OPEN'
+CIRCUIT_HALF_OPEN = 'HALF_OPEN'
+
+# Upper limits (s) of the latency histogram buckets. Calls slower than the last one go to an extra bucket.
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1., 5., 10., 30., 60.]
+
+
+class LatencyHistogram(object):
+    '''
+    Histogram of call latencies.
+
+    :param buckets: upper limits (s) of the buckets, in increasing order.
+    '''
+
+    def __init__(self, buckets=None):
+        self.buckets = list(buckets or LATENCY_BUCKETS)
+        self.counts = [0]*(len(self.buckets)+1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        '''
+        Upper limit of the bucket holding the q-th percentile (0-100) of the latencies, None if nothing was recorded.
+        Returns the maximum latency if it falls in the last (unbounded) bucket.
+        '''
+        with self._lock:
+            if self.count == 0:
+                return None
+            limit = q/100.*self.count
+            total = 0
+            for i, count in enumerate(self.counts):
+                total += count
+                if total >= limit and count > 0:
+                    return self.buckets[i] if i < len(self.buckets) else self.max
+            return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total/self.count if self.count > 0 else None,
+                'max': self.max,
+                'p50': self.percentile(50.),
+                'p95': self.percentile(95.),
+                'buckets': zip(self.buckets+[None], self.counts)}
+
+
+class CircuitBreaker(object):
+    '''
+    Circuit breaker of an instrument. The circuit opens after failures consecutive timeouts and, resetTime seconds
+    later, goes half open letting a single trial call through.
+
+    :param failures: consecutive timeouts that open the circuit.
+    :param resetTime: time (s) the circuit stays open.
+    '''
+
+    def __init__(self, failures=3, resetTime=300.):
+        self.failures = failures
+        self.resetTime = resetTime
+        self._state = CIRCUIT_CLOSED
+        self._timeouts = 0
+        self._openedAt = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._currentState()
+
+    def _currentState(self):
+        if self._state == CIRCUIT_OPEN and time.time()-self._openedAt >= self.resetTime:
+            self._state = CIRCUIT_HALF_OPEN
+            self._trial = False
+        return self._state
+
+    def allow(self):
+        '''
+        True if a call can be made now. In half open state only one call is allowed until it finishes.
+        '''
+        with self._lock:
+            state = self._currentState()
+            if state == CIRCUIT_CLOSED:
+                return True
+            elif state == CIRCUIT_HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def retryIn(self):
+        '''
+        Time (s) until the circuit goes half open, 0 if it is not open.
+        '''
+        with self._lock:
+            if self._currentState() != CIRCUIT_OPEN:
+                return 0.
+            return max(0., self.resetTime-(time.time()-self._openedAt))
+
+    def success(self):
+        '''
+        Record a call that answered. Returns True if the circuit was closed by it.
+        '''
+        with self._lock:
+            closed = self._state != CIRCUIT_CLOSED
+            self._state = CIRCUIT_CLOSED
+            self._timeouts = 0
+            self._trial = False
+            return closed
+
+    def failure(self):
+        '''
+        Record a call that timed out. Returns True if the circuit was opened by it.
+        '''
+        with self._lock:
+            self._timeouts += 1
+            if self._state == CIRCUIT_HALF_OPEN or \
+                    (self._state == CIRCUIT_CLOSED and self.failures > 0 and self._timeouts >= self.failures):
+                self._state = CIRCUIT_OPEN
+                self._openedAt = time.time()
+                self._trial = False
+                return True
+            return False
+
+
+class GuardedProxy(object):
+    '''
+    Wraps an instrument proxy, calling its methods through a ProxyGuard.
+
+    :param guard: ProxyGuard.
+    :param name: name of the instrument (its location), used for the circuit breaker and latency histogram.
+    :param proxy: instrument proxy.
+    :param deadline: time (s) to wait for each call, None to wait forever.
+    '''
+
+    def __init__(self, guard, name, proxy, deadline):
+        self._guard = guard
+        self._name = name
+        self._proxy = proxy
+        self._deadline = deadline
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        function = getattr(self._proxy, attr)
+        if not callable(function):
+            return function
+
+        def call(*args, **kwargs):
+            return self._guard.call(self._name, '%s.%s' % (self._name, attr), function, args, kwargs,
+                                    self._deadline)
+        return call
+
+    def __getitem__(self, item):
+        return self._guard.call(self._name, '%s[%s]' % (self._name, item), self._proxy.__getitem__, (item,), {},
+                                self._deadline)
+
+    def __repr__(self):
+        return '<GuardedProxy %s (deadline %s s, %s)>' % (self._name, self._deadline,
+                                                         self._guard.breaker(self._name).state)
+
+
+class ProxyGuard(object):
+    '''
+    Deadlines, latency histograms and circuit breakers of the instruments.
+
+    :param deadline: default time (s) to wait for a call, None to wait forever.
+    :param deadlines: dictionary with the deadline of each instrument type (e.g. {'dome': 30.}).
+    :param failures: consecutive timeouts that open the circuit of an instrument (0 never opens it).
+    :param resetTime: time (s) the circuit of an instrument stays open.
+    '''
+
+    def __init__(self, deadline=10., deadlines=None, failures=3, resetTime=300.):
+        self.deadline = deadline
+        self.deadlines = dict(deadlines or {})
+        self.failures = failures
+        self.resetTime = resetTime
+        self._breakers = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parseDeadlines(value):
+        '''
+        Parse deadlines given as "instrument:seconds" pairs separated by commas (e.g. "dome:30,telescope:15").
+        '''
+        deadlines = {}
+        if not value:
+            return deadlines
+        for pair in str(value).split(','):
+            if not pair.strip():
+                continue
+            instrument, seconds = pair.split(':')
+            deadlines[instrument.strip()] = float(seconds)
+        return deadlines
+
+    def deadlineFor(self, instrument):
+        return self.deadlines.get(instrument, self.deadline)
+
+    def wrap(self, instrument, name, proxy, deadline=None):
+        '''
+        Guard proxy of an instrument of the given type (e.g. "dome") at location name. deadline overrides the
+        deadline of the instrument type.
+        '''
+        return GuardedProxy(self, name, proxy, self.deadlineFor(instrument) if deadline is None else deadline)
+
+    def breaker(self, name):
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(self.failures, self.resetTime)
+            return self._breakers[name]
+
+    def histogram(self, name):
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = LatencyHistogram()
+            return self._histograms[name]
+
+    def state(self, name):
+        return self.breaker(name).state
+
+    def call(self, name, description, function, args=(), kwargs=None, deadline=None):
+        '''
+        Call function, waiting at most deadline seconds.
+
+        :raise CircuitOpenException: if the circuit of instrument name is open (nothing is called).
+        :raise ProxyTimeoutException: if function did not return in time. It keeps running in a daemon thread.
+        '''
+        kwargs = kwargs or {}
+        breaker = self.breaker(name)
+        if not breaker.allow():
+            raise CircuitOpenException('%s not answering, not calling %s (retry in %.0f s).' % (name, description,
+                                                                                               breaker.retryIn()))
+
+        t0 = time.time()
+        if deadline is None or deadline <= 0.:
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.histogram(name).record(time.time()-t0)
+                breaker.success()
+
+        result = []
+
+        def run():
+            try:
+                result.append((True, function(*args, **kwargs)))
+            except Exception, e:
+                result.append((False, e))
+
+        thread = threading.Thread(target=run, name='ProxyGuard %s' % description)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(deadline)
+
+        self.histogram(name).record(time.time()-t0)
+
+        if not result:
+            if breaker.failure():
+                log.warning('%s timed out %i times in a row, opening circuit for %.0f s.' % (name,
+                                                                                           breaker.failures,
+                                                                                           breaker.resetTime))
+            raise ProxyTimeoutException('%s did not answer in %.1f s.' % (description, deadline))
+
+        if breaker.success():
+            log.info('%s answered again, closing circuit.' % name)
+
+        ok, value = result[0]
+        if not ok:
+            raise value
+        return value
+
+    def status(self):
+        '''
+        Circuit state and latency summary of each instrument called so far.
+        '''
+        with self._lock:
+            names = sorted(set(self._breakers.keys()) | set(self._histograms.keys()))
+        return dict([(name, {'state': self.state(name),
+                             'latency': self.histogram(name).summary()}) for name in names])
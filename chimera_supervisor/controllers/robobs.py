@@ -7,9 +7,15 @@ import threading
 import inspect
 
 from chimera_supervisor.controllers.scheduler.model import Session as RSession
+from chimera_supervisor.controllers.scheduler.model import database as rdatabase
 from chimera_supervisor.controllers.scheduler.model import (Program, Targets, BlockPar, ObsBlock,
                                                             ObservingLog, AutoFocus, Point, Expose)
 from chimera_supervisor.controllers.scheduler.machine import Machine
+from chimera_supervisor.controllers.scheduler.visibility import VisibilityCube
+from chimera_supervisor.controllers.scheduler.ephemeris import SiteEphemeris
+from chimera_supervisor.controllers.scheduler.pending import PendingPrograms
+from chimera_supervisor.controllers.scheduler.conditions import conditionReasons
+from chimera_supervisor.controllers.scheduler.constraints import ConstraintPipeline, ConstraintContext, SensorCache
 from chimera_supervisor.controllers.scheduler import algorithms
 
 from chimera.core.chimeraobject import ChimeraObject
@@ -26,6 +32,11 @@ from chimera.util.output import blue, green, red
 
 RobState = Enum('OFF', 'ON')
 
+# Time step (s) used when looking for the next time a pending program can be observed.
+WAKEUP_STEP = 120.
+# Shortest wait (s) before resheduling again when no program can be observed.
+MIN_WAKEUP_WAIT = 60.
+
 schedAlgorithms = {}
 for name,obj in inspect.getmembers(algorithms):
     if inspect.isclass(obj) and issubclass(obj,algorithms.BaseScheduleAlgorith):
@@ -38,6 +49,14 @@ class RobObs(ChimeraObject):
                   "weatherstations" : None,
                   "seeingmonitors"  : None,
                   "cloudsensors"    : None,
+                  "lookahead"       : True, # compute the next program while the current one runs
+                  "lookahead_tolerance" : 300., # max difference (s) between predicted and actual end of program
+                  "lookahead_timeout" : 30., # time (s) to wait for the lookahead before resheduling
+                  "empty_queue_wait" : 300., # wait (s) when the queue is empty or nothing can be observed tonight
+                  "constraints" : None, # extra constraints, comma separated list of module.Class
+                  "max_humidity" : None, # programs are not observed above this humidity
+                  "max_windspeed" : None, # programs are not observed above this wind speed
+                  "sensor_max_age" : 60., # time (s) sensor readings are reused by the constraints
                   }
 
     def __init__(self):
@@ -48,6 +67,18 @@ class RobObs(ChimeraObject):
         self._no_program_on_queue = False
         self._debuglog = None
         self.machine = None
+        self._visibility = None
+        self._siteEphemeris = None
+        self._pending = PendingPrograms()
+        self._current_length = 0.
+        self._schedule_lock = threading.RLock()
+        self._lookahead = None
+        self._lookahead_thread = None
+        self._lookahead_id = 0
+        self._wakeup_timer = None
+        self._wakeup_lock = threading.Lock()
+        self._constraints = None
+        self._sensors = None
 
     def __start__(self):
 
@@ -90,6 +121,7 @@ class RobObs(ChimeraObject):
     def stop(self):
         self._debuglog.debug("Switching robstate off...")
         self.rob_state = RobState.OFF
+        self._cancelWakeup()
 
         return True
 
@@ -97,6 +129,54 @@ class RobObs(ChimeraObject):
         self._debuglog.debug("Waking machine up...")
         self.machine.state(SchedState.START)
 
+    def wakeAt(self, mjd):
+        '''
+        Wake the machine up at the given time (MJD), replacing any wake up already scheduled.
+        '''
+        delay = max((mjd-self.getSiteEphemeris().MJD())*86.4e3, MIN_WAKEUP_WAIT)
+
+        with self._wakeup_lock:
+            if self._wakeup_timer is not None:
+                self._wakeup_timer.cancel()
+            self._wakeup_timer = threading.Timer(delay, self._wakeupTimeout)
+            self._wakeup_timer.setDaemon(True)
+            self._wakeup_timer.start()
+
+        self._debuglog.debug("Waking up in %.1f s." % delay)
+
+    def _cancelWakeup(self):
+        '''
+        Cancel the scheduled wake up, if any.
+
+        :return: True if a wake up was cancelled.
+        '''
+        with self._wakeup_lock:
+            timer, self._wakeup_timer = self._wakeup_timer, None
+        if timer is None:
+            return False
+        timer.cancel()
+        return True
+
+    def _wakeupTimeout(self):
+        with self._wakeup_lock:
+            self._wakeup_timer = None
+        if self.rob_state == RobState.ON:
+            self.wake()
+        else:
+            self._debuglog.debug("Current state is off. Won't wake up.")
+
+    def notifyQueueChanged(self):
+        '''
+        Tell RobObs that programs were added to (or removed from) the queue. If waiting for programs to become
+        observable, reshedule right away.
+        '''
+        self._pending.invalidate()
+        self.queueChanged()
+
+        if self._cancelWakeup() and self.rob_state == RobState.ON:
+            self._debuglog.debug("Queue changed while waiting. Waking up...")
+            self.wake()
+
     def reset_scheduler(self):
         csession = model.Session()
 
@@ -116,6 +196,24 @@ class RobObs(ChimeraObject):
     def getSite(self):
         return self.getManager().getProxy(self["site"])
 
+    def getSiteEphemeris(self):
+        '''
+        Local copy of the site for pure computations (times, coordinates, ephemeris). Use getSite() for anything that
+        depends on the live state of the site.
+        '''
+        if self._siteEphemeris is None:
+            self._siteEphemeris = SiteEphemeris.fromSite(self.getSite())
+        return self._siteEphemeris
+
+    def getSM(self,index=0):
+        return self.getManager().getProxy(self["seeingmonitors"].split(',')[index])
+
+    def getCS(self,index=0):
+        return self.getManager().getProxy(self["cloudsensors"].split(',')[index])
+
+    def getWS(self,index=0):
+        return self.getManager().getProxy(self["weatherstations"].split(',')[index])
+
     def getSched(self,index=0):
         self.log.debug("%s" % self._scheduler_list[index])
         if self._debuglog is not None:
@@ -156,7 +254,7 @@ class RobObs(ChimeraObject):
         try:
             program = session.merge(program)
             self._debuglog.debug('Program %s started' % program)
-            site = self.getSite()
+            site = self.getSiteEphemeris()
 
             log = ObservingLog(time=datetimeFromJD(site.MJD()+2400000.5,),
                                  tid=program.tid,
@@ -168,6 +266,108 @@ class RobObs(ChimeraObject):
             session.commit()
             rsession.commit()
 
+        if self._current_program is not None:
+            self._startLookahead(self._current_length)
+
+    def _startLookahead(self, length):
+        '''
+        Select, in background, the program to observe after the current one, which should end in length seconds.
+        '''
+        if not self["lookahead"]:
+            return
+
+        with self._schedule_lock:
+            self._lookahead = None
+            self._lookahead_id += 1
+        endmjd = self.getSiteEphemeris().MJD()+length/86.4e3
+
+        self._lookahead_thread = threading.Thread(target=self._computeLookahead,
+                                                  args=(endmjd, self._lookahead_id),
+                                                  name='RobObs-lookahead')
+        self._lookahead_thread.setDaemon(True)
+        self._lookahead_thread.start()
+
+    def _computeLookahead(self, endmjd, id):
+        '''
+        Reshedule at endmjd without keeping anything the algorithms change meanwhile (slew times, timed observations,
+        ...): the selection runs on a copy of the pending programs loaded by this thread, inside a scratch block of the
+        scheduler database (see Database.scratch), and without the schedule lock, so the current selection never waits
+        for it. Only the id of the selected program is kept, see nextProgram.
+        '''
+        try:
+            if id != self._lookahead_id:
+                return
+            with rdatabase.scratch():
+                pending = PendingPrograms()
+                pending.refresh()
+                program_info = self.reshedule(endmjd, pending)
+                lookahead = None if program_info is None else (program_info[0].id,
+                                                               program_info[1].schedalgorith)
+                signature = pending.signature()
+            with self._schedule_lock:
+                if id != self._lookahead_id:
+                    self._debuglog.debug('Lookahead program @ %.3f not needed anymore.' % endmjd)
+                    return
+                self._lookahead = (endmjd, lookahead, signature)
+            self._debuglog.debug('Lookahead program @ %.3f: %s' % (endmjd,
+                                                                   lookahead[0] if lookahead else None))
+        except Exception, e:
+            self._debuglog.error('Could not compute lookahead program.')
+            self._debuglog.exception(e)
+
+    def _dropLookahead(self, algorithm):
+        '''
+        Forget the lookahead program if it was selected by algorithm, whose state just changed (see
+        _watchProgramComplete). A lookahead still running may not see the change and is discarded when it ends.
+        '''
+        with self._schedule_lock:
+            if self._lookahead is None:
+                self._lookahead_id += 1
+            elif self._lookahead[1] is not None and self._lookahead[1][1] == algorithm:
+                self._debuglog.debug('Observed a program of the lookahead algorithm, dropping lookahead.')
+                self._lookahead = None
+
+    def nextProgram(self):
+        '''
+        Select the program to observe now. The program computed in background while the last program was running is
+        used if the queue did not change, the program ended close to the predicted time, its algorithm still selects it
+        now and conditions are still good. Otherwise the queue is resheduled.
+        '''
+        if self._lookahead_thread is not None:
+            self._lookahead_thread.join(self["lookahead_timeout"])
+            if self._lookahead_thread.isAlive():
+                self._debuglog.warning('Lookahead not ready after %.1f s. Resheduling...' % self["lookahead_timeout"])
+            self._lookahead_thread = None
+
+        with self._schedule_lock:
+            # a lookahead still running is discarded when it ends, without waiting for it
+            self._lookahead_id += 1
+            lookahead, self._lookahead = self._lookahead, None
+
+            if lookahead is not None and lookahead[1] is not None:
+                endmjd, (programId, algorithm), signature = lookahead
+                nowmjd = self.getSiteEphemeris().MJD()
+                self._pending.refresh()
+                program_info = self._pending.find(programId)
+
+                if signature != self._pending.signature() or program_info is None:
+                    self._debuglog.debug('Queue changed since lookahead. Resheduling...')
+                elif abs(nowmjd-endmjd)*86.4e3 > self["lookahead_tolerance"]:
+                    self._debuglog.debug('Program ended %.1f s away from predicted time. Resheduling...' % (
+                        (nowmjd-endmjd)*86.4e3))
+                else:
+                    # select it again with its algorithm, now, to keep what the algorithm changes
+                    program_info = schedAlgorithms[algorithm].next(nowmjd, [program_info])
+                    self._pending.commit()
+                    if program_info is None:
+                        self._debuglog.debug('Lookahead program not selected by its algorithm now. Resheduling...')
+                    elif not self.checkConditions(program_info, nowmjd, self._pending.duration(program_info)):
+                        self._debuglog.debug('Lookahead program cannot be observed now. Resheduling...')
+                    else:
+                        self._debuglog.debug('Using lookahead program %s' % program_info[0])
+                        return program_info
+
+            return self.reshedule()
 
     def _watchProgramComplete(self, program, status, message=None):
 
@@ -178,7 +378,7 @@ class RobObs(ChimeraObject):
             self._debuglog.debug('Program %s completed with status %s(%s)' % (program,
                                                                         status,
                                                                         message))
-            site = self.getSite()
+            site = self.getSiteEphemeris()
 
             log = ObservingLog(time=datetimeFromJD(site.MJD()+2400000.5,),
                                  tid=program.tid,
@@ -197,12 +397,15 @@ class RobObs(ChimeraObject):
 
                 block_config = rsession.merge(self._current_program[1])
                 sched = schedAlgorithms[block_config.schedalgorith]
-                sched.observed(site.MJD(),self._current_program,
-                               site)
+                with self._schedule_lock:
+                    sched.observed(site.MJD(),self._current_program,
+                                   site)
+                    self._dropLookahead(block_config.schedalgorith)
                 rsession.commit()
 
                 rsession.commit()
-                
+                self._pending.invalidate()
+
                 self._current_program = None
             elif status != SchedulerStatus.OK:
                 self.stop()
@@ -239,6 +442,7 @@ class RobObs(ChimeraObject):
                                                             newState))
         if oldState == SchedState.IDLE and newState == SchedState.OFF:
             if self.rob_state == RobState.ON:
+                self._cancelWakeup()
                 self._debuglog.debug("Scheduler went from BUSY to OFF. Needs resheduling...")
 
                 # if self._current_program is not None:
@@ -266,7 +470,7 @@ class RobObs(ChimeraObject):
                 # csession.add(cprog)
                 # self._current_program = cprog
                 # self._debuglog.debug("Added: %s" % cprog)
-                program_info = self.reshedule()
+                program_info = self.nextProgram()
                 #
                 if program_info is not None:
                     program = session.merge(program_info[0])
@@ -281,15 +485,26 @@ class RobObs(ChimeraObject):
                     csession.commit()
                     program.finished = True
                     session.commit()
-                    # sched = self.getSched()
                     self._current_program = program_info
+                    self._current_length = self._pending.duration(program_info)
+                    self._pending.invalidate()
+                    # sched = self.getSched()
                     self._no_program_on_queue = False
                     # sched.start()
                     # self._current_program_condition.release()
                     self._debuglog.debug("Done")
                 elif self._no_program_on_queue:
-                    self._debuglog.warning("No program on robobs queue, waiting for 5 min.")
-                    time.sleep(300)
+                    wakeup = self.nextObservableTime(self.getSiteEphemeris().MJD())
+                    if wakeup is None:
+                        self._debuglog.warning("No program on robobs queue, waiting for %.1f s." %
+                                               self["empty_queue_wait"])
+                        wakeup = self.getSiteEphemeris().MJD()+self["empty_queue_wait"]/86.4e3
+                    else:
+                        self._debuglog.warning("No program can be observed now, waiting until %.5f." % wakeup)
+                    self.wakeAt(wakeup)
+                    csession.commit()
+                    session.commit()
+                    return
                 else:
                     self._debuglog.warning("No program on robobs queue. Sending telescope to park position.")
                     # ToDo: Run an action from the database to send telescope to park position.
@@ -317,172 +532,167 @@ class RobObs(ChimeraObject):
             else:
                 self._debuglog.debug("Current state is off. Won't respond.")
 
-    def reshedule(self,now=None):
-
-        session = RSession()
+    def reshedule(self,now=None,pending=None):
+        '''
+        Select the program to observe at now (MJD, default is the current time) from pending (PendingPrograms, default
+        is the index of the robotic observatory).
+        '''
 
-        site = self.getSite()
+        site = self.getSiteEphemeris()
         if now is None:
             nowmjd = site.MJD()
         else:
             nowmjd = now
 
-        program = None
-
         # Get a list of priorities
-        plist = self.getPList()
+        plist = self.getPList(pending)
 
         if len(plist) == 0:
             return None
 
         # Get project with highest priority as reference
-        priority = plist[0]
-        program,plen = self.getProgram(nowmjd,plist[0])
-
-        waittime=0
+        program,plen = self.getProgram(nowmjd,plist[0],pending)
 
         if program is not None:
-            # program = session.merge(program)
             if ( (not program[0].slewAt) and (self.checkConditions(program, nowmjd, plen))):
                 # Program should be done right away!
                 return program
 
             self._debuglog.info('Current program length: %.2f m. Slew@: %.3f'%(plen/60., program[0].slewAt))
-
-            waittime=(program[0].slewAt-nowmjd)*86.4e3
         else:
             self._debuglog.warning('No program on %i priority queue.' % plist[0])
 
-        if waittime < 0:
-            waittime = 0
+        # Candidate programs of each priority, the first one being the reference program (if any)
+        priorities, programs, lengths = [], [], []
+        for p in plist:
+            if p == plist[0]:
+                aprogram,aplen = program,plen
+            else:
+                aprogram,aplen = self.getProgram(nowmjd,p,pending)
+            if aprogram is not None:
+                priorities.append(p)
+                programs.append(aprogram)
+                lengths.append(aplen)
 
-        self._debuglog.info('Wait time is: %.2f m'%(waittime/60.))
+        if len(programs) == 0:
+            return None
 
-        for p in plist[1:]:
+        lengths = np.array(lengths, dtype=np.float64)
+        slewAt = np.array([aprogram[0].slewAt for aprogram in programs], dtype=np.float64)
+        waittimes = np.clip((slewAt-nowmjd)*86.4e3, 0., None)
 
-            # Get program and program duration (lenght)
+        # Each candidate is checked when it can start and all of them after the end of each candidate.
+        checktimes = np.where(nowmjd > slewAt, nowmjd, slewAt)
+        aftertimes = nowmjd+(waittimes+lengths)/86400.
+        times, index = np.unique(np.concatenate((checktimes, aftertimes)), return_inverse=True)
+        checkindex, afterindex = index[:len(programs)], index[len(programs):]
 
-            aprogram,aplen = self.getProgram(nowmjd,p)
+        ok, flags = self.checkConditionsBatch(programs, times, lengths)
+        okAfter, flagsAfter = self.checkConditionsBatch(programs, times)
 
-            # aprogram = session.merge(aprogram)
+        current = None
+        waittime = 0.
+        if program is not None:
+            current = 0
+            waittime = waittimes[0]
 
-            if aprogram is None:
-                continue
+        self._debuglog.info('Wait time is: %.2f m'%(waittime/60.))
 
-            checktime = nowmjd if nowmjd > aprogram[0].slewAt else aprogram[0].slewAt
+        for i in range(0 if current is None else 1, len(programs)):
 
-            can_observe = self.checkConditions(aprogram,checktime,aplen)
-            if program is None and can_observe:
+            can_observe = ok[i, checkindex[i]]
+            if current is None and can_observe:
                 self._debuglog.info('No higher priority program. Choosing this instead and continue')
-                program = aprogram
-                waittime=(program[0].slewAt-nowmjd)*86.4e3
-                if waittime < 0.:
-                    waittime = 0.
+                current, waittime = i, waittimes[i]
                 self._debuglog.info('Wait time is: %.2f m'%(waittime/60.))
                 continue
             elif not can_observe:
                 # if condition is False, project cannot be executed. Go to next in the list
-                self._debuglog.info('Selected program cannot be observed. Skipping...')
+                self._debuglog.info('Selected program cannot be observed (%s). Skipping...' %
+                                    conditionReasons(flags[i, checkindex[i]]))
                 continue
 
-
-
-            self._debuglog.info('Current program length: %.2f m. Slew@: %.3f'%(aplen/60.,aprogram[0].slewAt))
-            #return program
-            #if aplen < 0 and program:
-            #	log.debug('Using normal program (aplen < 0)...')
-            #	return program
+            self._debuglog.info('Current program length: %.2f m. Slew@: %.3f'%(lengths[i]/60.,slewAt[i]))
+            self._debuglog.info('Wait time is: %.2f m'%(waittimes[i]/60.))
 
             # If alternate program fits will send it instead
-
-            awaittime=(aprogram[0].slewAt-nowmjd)*86.4e3
-
-            if awaittime < 0.:
-                awaittime = 0.
-
-            self._debuglog.info('Wait time is: %.2f m'%(awaittime/60.))
-
-            # if awaittime+aplen < waittime+plen:
-            # if awaittime < waittime:
-            # #if aprogram.slewAt+aplen/86.4e3 < program.slewAt:
-            #     self._debuglog.info('Choose program with priority %i'%p)
-            #     # put program back with same priority
-            #     #self.rq.put((prt,program))
-            #     # return alternate program
-            #     session.commit()
-            #     return aprogram
-            checktime = nowmjd if nowmjd > program[0].slewAt else program[0].slewAt
-            # if not self.checkConditions(program,checktime):
-            #     program,plen,waittime = aprogram,aplen,awaittime
-
-            if awaittime+aplen < waittime:
-                self._debuglog.info('Program with priority %i fits in this slot. Selecting it instead.'%p)
-                program, plen, waittime = aprogram, aplen, awaittime
-                # put program back with same priority
-                #self.rq.put((prt,program))
-                # return alternate program
-                # session.commit()
-                # return aprogram
-            elif awaittime < waittime and self.checkConditions(program,nowmjd+(awaittime+aplen)/86400.,plen):
-                self._debuglog.info('Program with higher priority can be executed after current program. '
-                                    'Selecting program with priority %i.' % p)
-                program, plen, waittime = aprogram, aplen, awaittime
+            if waittimes[i]+lengths[i] < waittime:
+                self._debuglog.info('Program with priority %i fits in this slot. Selecting it instead.' %
+                                    priorities[i])
+                current, waittime = i, waittimes[i]
+            elif waittimes[i] < waittime and ok[current, afterindex[i]]:
                 # Checks if program with higher priority can be observed latter on. If so, then use current
                 # program instead if waittime is lower.
+                self._debuglog.info('Program with higher priority can be executed after current program. '
+                                    'Selecting program with priority %i.' % priorities[i])
+                current, waittime = i, waittimes[i]
+
+            if waittimes[i] < waittime:
+                self._debuglog.debug('Program with higher priority has a higher waittime (%.2f/%.2f)' % (
+                    waittimes[i], waittime))
+            if not okAfter[current, afterindex[i]]:
+                self._debuglog.debug('Program with higher priority cannot be observed afterwards (%.2f): %s' %
+                                     (times[afterindex[i]], conditionReasons(flagsAfter[current, afterindex[i]])))
 
-            if awaittime < waittime:
-                self._debuglog.debug('Program with higher priority has a higher waittime (%.2f/%.2f)' % (awaittime,
-                                                                                                       waittime))
-            if not self.checkConditions(program,nowmjd+(awaittime+aplen)/86400.):
-                self._debuglog.debug('Program with higher priority cannot be observed afterwards (%.2f)' %
-                                     (nowmjd+(awaittime+aplen)/86400.))
-            #program,plen,priority = aprogram,aplen,p
-            #if not program.slewAt :
-            #    # Program should be done right now if possible!
-            #    # TEST "if possible"
-            #    log.debug('Choose program with priority %i'%p)
-            #    return program
-
-        if program is None:
+        if current is None:
             # if project cannot be executed return nothing.
             # [TO-CHECK] What the scheduler will do? should sleep for a while and
             # [TO-CHECK] try again.
-            session.commit()
             return None
-        checktime = nowmjd if nowmjd > program[0].slewAt else program[0].slewAt
-        if not self.checkConditions(program,checktime,plen):
-            session.commit()
+
+        if not ok[current, checkindex[current]]:
+            self._debuglog.info('Selected program cannot be observed (%s).' %
+                                conditionReasons(flags[current, checkindex[current]]))
             return None
 
-        self._debuglog.info('Choose program with priority %i'%priority)
-        session.commit()
-        return program
+        self._debuglog.info('Choose program with priority %i'%priorities[current])
+        return programs[current]
 
-    def getProgram(self, nowmjd, priority):
+    def nextObservableTime(self, nowmjd):
+        '''
+        Earliest time (MJD), until the end of the night, when a pending program reaches its slew time and its
+        observing conditions are fulfilled.
 
-        session = RSession()
+        :return: time or None if no pending program can be observed tonight.
+        '''
+        with self._schedule_lock:
+            programs = []
+            for priority in self.getPList():
+                for sAL, aprograms in self._pending.byAlgorithm(priority):
+                    programs.extend(aprograms)
+
+            if len(programs) == 0:
+                return None
+
+            site = self.getSiteEphemeris()
+            nightEnd = site.MJD(site.sunrise_twilight_begin(datetimeFromJD(nowmjd+2400000.5)))
+
+            slewAt = np.array([program[0].slewAt for program in programs], dtype=np.float64)
+            times = np.arange(nowmjd, nightEnd, WAKEUP_STEP/86.4e3)
+            times = np.unique(np.concatenate((times, slewAt[(slewAt > nowmjd) & (slewAt < nightEnd)])))
+            if len(times) == 0:
+                return None
+
+            ok, flags = self.checkConditionsBatch(programs,
+                                                  times,
+                                                  [self._pending.duration(program) for program in programs])
+            observable = (ok & (times[np.newaxis, :] >= slewAt[:, np.newaxis])).any(axis=0)
+
+            if not observable.any():
+                return None
+            return times[np.argmax(observable)]
+
+    def getProgram(self, nowmjd, priority, pending=None):
+        '''
+        Select the next program with the given priority. Programs are read from the pending programs index (default is
+        the one of the robotic observatory), which is updated by getPList.
+        '''
+        if pending is None:
+            pending = self._pending
 
         self._debuglog.debug('Looking for program with priority %i to observe @ %.3f '%(priority,nowmjd))
 
-        programs = session.query(Program,
-                                 BlockPar,
-                                 ObsBlock,
-                                 Targets).join(
-            BlockPar,Program.blockpar_id == BlockPar.id).join(
-            ObsBlock,Program.obsblock_id == ObsBlock.id).join(
-            Targets, Program.tid == Targets.id).filter(Program.priority == priority,
-                                                       Program.finished == False).order_by(Program.slewAt)
-
-        schedAlgList = np.array([t[1].schedalgorith for t in programs])
-        unique_shed_algorithm_list = np.unique(schedAlgList)
-
-        mjd = self.getSite().MJD()
-        dt = np.zeros(programs.count())
-
-        prog = []
-        for sAL in unique_shed_algorithm_list:
-
-            # nquery = programs.filter(BlockPar.schedalgorith == sAL)
+        for sAL, programs in pending.byAlgorithm(priority):
 
             sched = schedAlgorithms[sAL]
 
@@ -490,26 +700,21 @@ class RobObs(ChimeraObject):
 
             if program is not None:
                 self._debuglog.debug('Found program %s' % program[0])
-                dT = 0.
-
-                for ii,act in enumerate(program[2].actions):
-                    if act.__tablename__ == 'action_expose':
-                        dT+=act.exptime*act.frames
-                session.commit()
-                return program,dT
+                # store changes made by the algorithm (e.g. slew time)
+                pending.commit()
+                return program,pending.duration(program)
 
         self.log.warning('No program found...')
-        session.commit()
+        pending.commit()
         return None,0.
 
 
-    def getPList(self):
-
-        session = RSession()
-        plist = [p[0] for p in session.query(Program.priority).distinct().order_by(Program.priority)]
-        session.commit()
+    def getPList(self, pending=None):
 
-        return plist
+        if pending is None:
+            pending = self._pending
+        pending.refresh()
+        return pending.priorities()
 
     def checkConditions(self, program, time, program_length = 0., external_checker = None):
         '''
@@ -523,112 +728,89 @@ class RobObs(ChimeraObject):
         :return: True (Program can be executed) | False (Program cannot be executed)
         '''
 
-        site = self.getSite()
-        # 1) check airmass
-        session = RSession()
-        # program = session.merge(prg)
-        target = session.merge(program[3])
-        # obsblock = session.merge(program[2])
-        blockpar = session.merge(program[1])
-
-        raDec = Position.fromRaDec(target.targetRa,target.targetDec)
-
-        dateTime = datetimeFromJD(time+2400000.5)
-        lst = site.LST_inRads(dateTime) # in radians
-
-        alt = float(site.raDecToAltAz(raDec,lst).alt)
-        airmass = 1./np.cos(np.pi/2.-alt*np.pi/180.)
+        ok, flags = self.checkConditionsBatch([program], [time], [program_length])
 
-        if blockpar.minairmass < airmass < blockpar.maxairmass:
-            self._debuglog.debug('\tairmass:%.3f'%airmass)
+        if external_checker is not None:
+            # Todo: add a 3rd option which is a function to check if program is ok from the algorithm itself.
             pass
-        else:
-            self._debuglog.warning('Target %s out of airmass range @ %.3f... (%f < %f < %f)'%(target,time,
-                                                                                       blockpar.minairmass,
-                                                                                       airmass,
-                                                                                       blockpar.maxairmass))
-            return False
 
-        if program_length > 0.:
-            dateTime = datetimeFromJD((time+program_length/86.4e3)+2400000.5).replace(tzinfo=None)
-            lst = site.LST_inRads(dateTime)  # in radians
-            night_end = site.sunrise_twilight_begin(time).replace(tzinfo=None)
-            if dateTime > night_end:
-                self._debuglog.warning('Block finish @ %s. Night end is @ %s!' % (dateTime,
-                                                                                  night_end))
-                return False
-
-            alt = float(site.raDecToAltAz(raDec, lst).alt)
-            airmass = 1./np.cos(np.pi/2.-alt*np.pi/180.)
-
-            if blockpar.minairmass < airmass < blockpar.maxairmass:
-                self._debuglog.debug('\tairmass:%.3f'%airmass)
-                pass
-            else:
-                self._debuglog.warning('Target %s out of airmass range @ %.3f... (%f < %f < %f)'%(target,time,
-                                                                                           blockpar.minairmass,
-                                                                                           airmass,
-                                                                                           blockpar.maxairmass))
-                # return False
-                # FIXME
-                pass
-
-        # 2) check moon Brightness
-        moonPos = site.moonpos(dateTime)
-        moonBrightness = site.moonphase(dateTime)*100.
-        if blockpar.minmoonBright < moonBrightness < blockpar.maxmoonBright:
-            self._debuglog.debug('\tMoon brightness:%.2f'%moonBrightness)
-            pass
-        elif moonPos.alt < 0.:
-            self._debuglog.warning('\tMoon bellow horizon. Moon brightness:%.2f'%moonBrightness)
-        else:
-            self._debuglog.warning('Wrong Moon Brightness... (%f < %f < %f)'%(blockpar.minmoonBright,
-                                                                   moonBrightness,
-                                                                   blockpar.maxmoonBright))
+        if not ok[0, 0]:
+            self._debuglog.warning('Target %s cannot be observed @ %.3f: %s' % (program[3], time,
+                                                                                conditionReasons(flags[0, 0])))
             return False
 
-        # 3) check moon distance
-        moonRaDec = site.altAzToRaDec(moonPos,lst)
-
-        moonDist = raDec.angsep(moonRaDec)
+        self._debuglog.debug('Target OK!')
 
-        if moonDist < blockpar.minmoonDist:
-            self._debuglog.warning('Object to close to the moon... '
-                                   'Target@ %s / Moon@ %s (moonDist = %f | minmoonDist = %f)'%(raDec,
-                                                                                               moonRaDec,
-                                                                                               moonDist,
-                                                                                               blockpar.minmoonDist))
-            return False
-        else:
-            self._debuglog.debug('\tMoon distance:%.3f'%moonDist)
-        # 4) check seeing
+        return True
 
-        if self["seeingmonitors"] is not None:
+    def checkConditionsBatch(self, programs, times, lengths=None):
+        '''
+        Check the restrictions of many programs at many times at once (see scheduler.constraints).
 
-            seeing = self.getSM().seeing()
+        :param programs: list of (Program, BlockPar, ObsBlock, Targets).
+        :param times: list of times (MJD).
+        :param lengths: length of each program (seconds). If given, programs must finish before the end of the night.
+        :return: ok (programs x times boolean matrix), flags (programs x times matrix of CONDITION_* flags)
+        '''
 
-            if seeing > blockpar.maxseeing:
-                self._debuglog.warning('Seeing higher than specified... sm = %f | max = %f'%(seeing,
-                                                                                  blockpar.maxseeing))
-                return False
-            elif seeing < 0.:
-                self._debuglog.warning('No seeing measurement...')
-            else:
-                self._debuglog.debug('Seeing %.3f'%seeing)
-        # 5) check cloud cover
-        if self["cloudsensors"] is not None:
-            pass
+        times = np.atleast_1d(np.asarray(times, dtype=np.float64))
 
-        if self["weatherstations"] is not None:
-            pass
+        cube = self.getVisibility(times.min())
+        for program in programs:
+            if not cube.hasTarget(program[3].id):
+                cube = self.getVisibility(times.min(), program[3].id)
+                break
 
-        if external_checker is not None:
-            # Todo: add a 3rd option which is a function to check if program is ok from the algorithm itself.
-            pass
+        constraints = self.getConstraints()
+        context = ConstraintContext(cube, self.getSiteEphemeris(), programs, times, lengths, self._sensors)
+        return constraints.evaluate(context)
 
-        self._debuglog.debug('Target OK!')
+    def getConstraints(self):
+        '''
+        Constraint pipeline used to check programs. Built on first use with the default constraints, the sensors
+        configured and the extra constraints given in the "constraints" option.
+        '''
+        if self._constraints is None:
+            self._sensors = SensorCache(self["sensor_max_age"])
+
+            if self["seeingmonitors"] is not None:
+                self._sensors.register('seeing', lambda: self.getSM().seeing())
+            if self["cloudsensors"] is not None:
+                self._sensors.register('transparency', lambda: self.getCS().sky_transparency())
+            if self["weatherstations"] is not None:
+                self._sensors.register('humidity', lambda: self.getWS().humidity())
+                self._sensors.register('windspeed', lambda: self.getWS().wind_speed())
+
+            constraints = ConstraintPipeline.default(self["max_humidity"], self["max_windspeed"])
+
+            if self["constraints"] is not None:
+                for path in self["constraints"].split(','):
+                    module, cls = path.strip().rsplit('.', 1)
+                    try:
+                        constraints.add(getattr(__import__(module, fromlist=[cls]), cls)())
+                    except Exception, e:
+                        self.log.error('Could not load constraint %s' % path)
+                        self.log.exception(e)
+
+            self._debuglog.debug('Constraints: %s' % ', '.join([str(c) for c in constraints.constraints]))
+            self._constraints = constraints
+        return self._constraints
+
+    def getVisibility(self, time, tid=None):
+        '''
+        Return the visibility cube for the night of time (MJD). The cube is kept while it covers the requested time and
+        target and reloaded otherwise.
+        '''
+        jd = time+2400000.5
+        cube = self._visibility
+        if cube is None or not cube.contains(jd) or (tid is not None and not cube.hasTarget(tid)):
+            cube = VisibilityCube.forNight(self.getSiteEphemeris(), jd)
+            self._visibility = cube
+        return cube
 
-        return True
+    @event
+    def queueChanged(self):
+        pass
 
     def getLogger(self):
         return self._debuglog
@@ -638,8 +820,7 @@ class RobObs(ChimeraObject):
         for algorithm in schedAlgorithms.values():
 
             try:
-                inst_manager = self.getManager().getProxy(self['site'])
-                setattr(algorithm,'site',inst_manager)
+                setattr(algorithm,'site',self.getSiteEphemeris())
             except Exception, e:
                 self.log.error('Could not inject %s on %s handler' % ('site',
                                                                          algorithm))
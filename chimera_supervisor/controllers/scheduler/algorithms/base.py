@@ -13,7 +13,7 @@ from chimera.util.position import Position
 from chimera.util.coord import Coord
 from chimera.util.output import blue, green, red
 import logging
-from multiprocessing.pool import ThreadPool as Pool
+import logging.handlers
 
 ScheduleOptions = Enum("HIG","STD")
 
@@ -27,7 +27,8 @@ fileHandler = logging.handlers.RotatingFileHandler(os.path.join(SYSTEM_CONFIG_DI
                                       "scheduler_algorithms.log"),
                                                        maxBytes=100 *
                                                        1024 * 1024,
-                                                       backupCount=10)
+                                                       backupCount=10,
+                                                       delay=True) # file is only opened on the first record
 
 # _log_handler = logging.FileHandler(fileHandler)
 fileHandler.setFormatter(logging.Formatter(fmt='%(asctime)s[%(levelname)s:%(threadName)s]-%(name)s-(%(filename)s:%(lineno)d):: %(message)s'))
@@ -87,6 +88,18 @@ class BaseScheduleAlgorith():
         '''
         pass
 
+    @staticmethod
+    def addBlocks(session, blocks):
+        '''
+        Same as add, for a list of blocks at once. Records are added to session, which is committed by the caller
+        (see QueueWriter).
+
+        :param session:
+        :param blocks:
+        :return:
+        '''
+        pass
+
     @staticmethod
     def clean(pid):
         '''
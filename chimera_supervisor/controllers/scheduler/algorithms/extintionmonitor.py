@@ -1,5 +1,7 @@
 
 from chimera_supervisor.controllers.scheduler.algorithms.base import *
+from chimera_supervisor.controllers.scheduler.visibility import VisibilityCube
+from chimera_supervisor.controllers.scheduler.catalog import BlockCatalog
 
 class ExtintionMonitor(BaseScheduleAlgorith):
 
@@ -37,22 +39,32 @@ class ExtintionMonitor(BaseScheduleAlgorith):
     @staticmethod
     def add(block):
         session = Session()
-
-        obsblock = session.merge(block[0])
-        # Check if this is already in the database
-        ext_moni_block = session.query(ExtMoniDB).filter(ExtMoniDB.pid == obsblock.pid,
-                                                         ExtMoniDB.tid == obsblock.objid).first()
-
-        if ext_moni_block is not None:
-            # already in the database, just update
-            ext_moni_block.nairmass += 1
-        else:
-            ext_moni_block = ExtMoniDB(pid = obsblock.pid,
-                                       tid = obsblock.objid)
-            session.add(ext_moni_block)
-
+        ExtintionMonitor.addBlocks(session, [block])
         session.commit()
 
+    @staticmethod
+    def addBlocks(session, blocks):
+        # Number of times each target is added
+        nadd = {}
+        for block in blocks:
+            key = (block[0].pid, block[0].objid)
+            nadd[key] = nadd.get(key, 0) + 1
+
+        # Check which are already in the database
+        ext_moni_blocks = {}
+        for pid in set([key[0] for key in nadd]):
+            for ext_moni_block in session.query(ExtMoniDB).filter(ExtMoniDB.pid == pid):
+                ext_moni_blocks[(ext_moni_block.pid, ext_moni_block.tid)] = ext_moni_block
+
+        for key in nadd:
+            if key in ext_moni_blocks:
+                # already in the database, just update
+                ext_moni_blocks[key].nairmass += nadd[key]
+            else:
+                session.add(ExtMoniDB(pid = key[0],
+                                      tid = key[1],
+                                      nairmass = nadd[key]))
+
 
     @staticmethod
     def process(*args,**kwargs):
@@ -81,7 +93,6 @@ class ExtintionMonitor(BaseScheduleAlgorith):
         nightend   = kwargs['obsEnd']
         time_grid = np.arange(nightstart,nightend,slotLen/60./60./24.)
         site = kwargs['site']
-        targets = kwargs['query']
 
         nstars = 3 # if 'nstars' not in kwargs else kwargs['nstars']
         nairmass = 3 # if 'nairmass' not in kwargs else kwargs['nairmass']
@@ -105,14 +116,6 @@ class ExtintionMonitor(BaseScheduleAlgorith):
         MINALTITUDE = 10.
         MAXAIRMASS = 1./np.cos(np.pi/2.-np.pi/18.)
 
-        radecArray = np.array([Position.fromRaDec(targets[:][0][2].targetRa,
-                                                  targets[:][0][2].targetDec)])
-
-        # sort = np.argsort(targets[:][0][2].targetRa)
-        # radecArray = radecArray[sort]
-
-        targetNameArray = np.array([targets[:][0][2].name])
-
         # Creat observation slots.
         slotDtype = [ ('start',np.float),
                       ('end',np.float)  ,
@@ -122,68 +125,41 @@ class ExtintionMonitor(BaseScheduleAlgorith):
         obsSlots = np.array([],
                               dtype= slotDtype)
 
-
-        blockid = targets[:][0][0].blockid
-        radecPos = np.array([0])
-        blockidList = np.array([blockid])
-        blockDuration = np.array([0]) # store duration of each block
-        maxAirmass = np.array([targets[:][0][1].maxairmass]) # store max airmass of each block
-        minAirmass = np.array([targets[:][0][1].minairmass]) # store max airmass of each block
-        if maxAirmass[0] < 0:
-            maxAirmass[0] = MAXAIRMASS
-        if minAirmass[0] < 0:
-            minAirmass[0] = MAXAIRMASS # ignore minAirmaa if not set
-
         # Get single block ids and determine block duration
-        for itr,target in enumerate(targets):
-            if blockid != target[0].blockid:
-                radecArray =  np.append(radecArray,Position.fromRaDec(target[2].targetRa,
-                                                                      target[2].targetDec))
-                targetNameArray = np.append(targetNameArray,target[2].name)
-                blockid = target[0].blockid
-                radecPos = np.append(radecPos,itr)
-                blockidList = np.append(blockidList,blockid)
-                if target[1].maxairmass > 0:
-                    maxAirmass = np.append(maxAirmass,target[1].maxairmass)
-                else:
-                    maxAirmass = np.append(maxAirmass,
-                                           MAXAIRMASS)
-
-                if target[1].minairmass > 0:
-                    minAirmass = np.append(minAirmass,target[1].minairmass)
-                else:
-                    minAirmass = np.append(minAirmass,
-                                           MAXAIRMASS) # ignored if not set
+        catalog = kwargs['catalog'] if kwargs.get('catalog') is not None else \
+            BlockCatalog.fromQuery(kwargs['query'])
 
-                blockDuration = np.append(blockDuration,0.)
-
-            for blk_actions in target[0].actions:
-                if blk_actions.__tablename__ == 'action_expose':
-                    blockDuration[-1]+=((blk_actions.exptime+overheads['readout'])*blk_actions.frames)
-                elif blk_actions.__tablename__ == 'action_focus':
-                    if blk_actions.step > 0:
-                        blockDuration[-1]+=overheads['autofocus']['align']
-                    elif blk_actions.step == 0:
-                        blockDuration[-1]+=overheads['autofocus']['set']
+        if len(catalog) == 0:
+            log.warning('No targets to schedule.')
+            return obsSlots
 
+        targetNameArray = [row[2].name for row in catalog.rows]
+        blockidList = catalog['blockid']
+        blockDuration = catalog.duration(overheads) # store duration of each block
+        maxAirmass = np.where(catalog['maxairmass'] > 0, catalog['maxairmass'], MAXAIRMASS) # store max airmass of each block
+        minAirmass = np.where(catalog['minairmass'] > 0, catalog['minairmass'], MAXAIRMASS) # ignore minAirmass if not set
 
+        # Altitudes and moon distances are read from the visibility cube of the night
+        cube = kwargs['visibility'] if kwargs.get('visibility') is not None else \
+            VisibilityCube.forNight(site, nightstart, executor=kwargs.get('executor'))
+        cols = cube.columns(catalog['tid'])
 
         # Start allocating
         ## get lst at meadle of the observing window
         midnight = (nightstart+nightend)/2.
-        dateTime = datetimeFromJD(midnight)
-        lstmid = site.LST_inRads(dateTime) # in radians
+        lstmid = cube.engine.lst(midnight) # in radians
 
         nalloc = 0 # number of stars allocated
         nblock = 0 # block iterator
         nballoc = 0 # total number of blocks allocated
 
-        while nalloc < nstars and nblock < len(radecArray):
-        # while nblock < len(radecArray):
+        while nalloc < nstars and nblock < len(catalog):
+        # while nblock < len(catalog):
             # get airmasses
-            olst = np.float(radecArray[nblock].ra)*np.pi/180.*0.999
-            maxAltitude = float(site.raDecToAltAz(radecArray[nblock],
-                                                  olst).alt)
+            olst = catalog['ra'][nblock]*0.999
+            maxAltitude = float(cube.engine.altitude(cube.ra[cols[nblock]],
+                                                     cube.dec[cols[nblock]],
+                                                     olst))
             minAM = 1./np.cos(np.pi/2.-maxAltitude*np.pi/180.)
 
             log.debug("Altitute max/min: %.2f/%.2f" % (maxAltitude,MINALTITUDE))
@@ -192,8 +168,8 @@ class ExtintionMonitor(BaseScheduleAlgorith):
             log.debug('Working on: %s'%targetNameArray[nblock])
 
             if maxAltitude < MINALTITUDE:
+                log.debug('Max altitude %6.2f lower than minimum: %s'%(maxAltitude,targetNameArray[nblock]))
                 nblock+=1
-                log.debug('Max altitude %6.2f lower than minimum: %s'%(float(radecArray[nblock].ra),radecArray[nblock]))
                 continue
             elif minAM > minAirmass[nblock]:
             #    nblock+=1
@@ -222,12 +198,11 @@ class ExtintionMonitor(BaseScheduleAlgorith):
 
             start = nightstart if start < nightstart else start
             end = nightend if end > nightend else end
-            log.debug('Trying to allocate %s'%(radecArray[nblock]))
+            log.debug('Trying to allocate %s'%(targetNameArray[nblock]))
             nballoc_tmp = nballoc
 
-            lst_grid = [site.LST_inRads(datetimeFromJD(tt)) for tt in time_grid]
-            airmass_grid = np.array([Airmass(float(site.raDecToAltAz(radecArray[nblock],
-                                                         lst).alt)) for lst in lst_grid])
+            airmass_grid = np.array([Airmass(alt) for alt in cube.altitude(time_grid,
+                                                                          cols[nblock:nblock+1])[:, 0]])
             min_amidx = np.argmin(airmass_grid)
             for dam in dairMass:
                 converged = False
@@ -328,29 +303,25 @@ class ExtintionMonitor(BaseScheduleAlgorith):
                     # moonRaDec = self.site.altAzToRaDec(self.site.moonpos(dateTime),lst)
                     # moonDist = raDec.angsep(moonRaDec)
 
-                    _dateTime = datetimeFromJD(time)
-                    lst = site.LST_inRads(_dateTime)
-                    moonpos = site.moonpos(_dateTime)
+                    moon = cube.moon(time)[0]
                     #check that moon is above horizon!
-                    if moonpos.alt > 0.:
-
-                        moonRaDec = site.altAzToRaDec(moonpos,lst)
-
-
+                    if moon['alt'] > 0.:
 
-                        moonBrightness = site.moonphase(_dateTime)*100.
-                        s_target = targets[:][nblock]
+                        moonDist = cube.moonSeparation([time], cols[nblock:nblock+1])[0, 0]
+                        moonBrightness = moon['brightness']
+                        s_target = catalog.blocks[nblock]
 
-                        if (radecArray[nblock].angsep(moonRaDec) < s_target[1].minmoonDist) or not (s_target[1].minmoonBright < moonBrightness < s_target[1].maxmoonBright):
+                        if (moonDist < s_target['minmoonDist']) or not (s_target['minmoonBright'] < moonBrightness < s_target['maxmoonBright']):
                             log.warning('Cannot allocate target due to moon restrictions...')
-                            log.debug("Moon Conditions @ %s: Target@ %s | Moon@: %s | AngSep: %.2f (min.: %.2f) |Moon Brightness: %.2f (%.2f:%.2f) "%(time,
-                                                                                                       radecArray[nblock],
-                                                                                                       moonRaDec,
-                                                                                                       radecArray[nblock].angsep(moonRaDec),
-                                                                                                    s_target[1].minmoonDist,
+                            log.debug("Moon Conditions @ %s: Target@ %s | Moon@: %.2f %.2f | AngSep: %.2f (min.: %.2f) |Moon Brightness: %.2f (%.2f:%.2f) "%(time,
+                                                                                                       targetNameArray[nblock],
+                                                                                                       moon['ra']*180./np.pi,
+                                                                                                       moon['dec']*180./np.pi,
+                                                                                                       moonDist,
+                                                                                                    s_target['minmoonDist'],
                                                                                        moonBrightness,
-                                                                                       s_target[1].minmoonBright,
-                                                                                       s_target[1].maxmoonBright))
+                                                                                       s_target['minmoonBright'],
+                                                                                       s_target['maxmoonBright']))
                             break
 
 
@@ -410,7 +381,7 @@ class ExtintionMonitor(BaseScheduleAlgorith):
         log.debug("Selecting target with ExtintionMonitor algorithm.")
 
         mjd = time #ExtintionMonitor.site.MJD()
-        lst = ExtintionMonitor.site.LST(datetimeFromJD(time+2400000.5))
+        cube = VisibilityCube.forNight(ExtintionMonitor.site, time+2400000.5)
 
         # dt = np.array([ np.abs(mjd - program[0].slewAt) for program in programs])
         # iprog = np.argmin(dt)
@@ -424,15 +395,14 @@ class ExtintionMonitor(BaseScheduleAlgorith):
         for program in programs:
             extmoni_info = session.query(ExtMoniDB).filter(ExtMoniDB.pid == program[0].pid,
                                                            ExtMoniDB.tid == program[0].tid).first()
-            target_coord = Position.fromRaDec(Coord.fromH(program[3].targetRa),
-                                              Coord.fromD(program[3].targetDec))
+            col = cube.columns([program[3].id])
             # set desired altitudes
             max_airmass = program[1].maxairmass
             minalt = 90.-np.arccos(1./max_airmass)*180./np.pi
             minalt *= 1.1
 
-            olst = np.float(target_coord.ra.R)*0.999
-            maxalt = ExtintionMonitor.site.raDecToAltAz(target_coord, olst).alt.D
+            olst = cube.ra[col[0]]*0.999
+            maxalt = float(cube.engine.altitude(cube.ra[col[0]], cube.dec[col[0]], olst))
 
             # add 1 to nairmass so the values can be threated as boundaries.
             desire_alt = np.linspace(minalt,maxalt,extmoni_info.nairmass+1)
@@ -445,8 +415,7 @@ class ExtintionMonitor(BaseScheduleAlgorith):
             if program[0].slewAt < mjd:
                 log.debug("Slew time has passed. Calculating target's current altitude.")
 
-                alt = ExtintionMonitor.site.raDecToAltAz(target_coord,
-                                                                  lst).alt.D
+                alt = cube.altitude([mjd+2400000.5], col)[0, 0]
 
                 if not (minalt < alt < maxalt):
                     log.debug("Target altitude (%.2f) outside limit (%.2f/%.2f)" % (alt,
@@ -470,10 +439,9 @@ class ExtintionMonitor(BaseScheduleAlgorith):
                                                                                       minalt,
                                                                                       maxalt))
                 slewAt = program[0].slewAt
-                for tt in np.linspace(mjd,program[0].slewAt,10):
-                    observe_lst = ExtintionMonitor.site.LST_inRads(datetimeFromJD(tt+2400000.5))
-                    alt = ExtintionMonitor.site.raDecToAltAz(target_coord,
-                                                             observe_lst).alt.D
+                slew_grid = np.linspace(mjd,program[0].slewAt,10)
+                alt_grid = cube.altitude(slew_grid+2400000.5, col)[:, 0]
+                for tt, alt in zip(slew_grid, alt_grid):
                     log.debug('Slew@: %.2f (alt/airmass: %.2f/%.3f )' % (tt, alt,
                                                                          1. / np.cos(np.pi / 2. - alt * np.pi / 180.)))
 
@@ -1,5 +1,8 @@
 
 from chimera_supervisor.controllers.scheduler.algorithms.base import *
+from chimera_supervisor.controllers.scheduler.visibility import VisibilityCube
+from chimera_supervisor.controllers.scheduler.executor import ScheduleExecutor
+from chimera_supervisor.controllers.scheduler.catalog import BlockCatalog, AvailableTargets
 
 class Higher(BaseScheduleAlgorith):
 
@@ -41,6 +44,7 @@ class Higher(BaseScheduleAlgorith):
         nightstart = kwargs['obsStart']
         nightend   = kwargs['obsEnd']
         site = kwargs['site']
+        revisit = kwargs.get('revisit', False)
 
         # Creat observation slots.
 
@@ -65,37 +69,37 @@ class Higher(BaseScheduleAlgorith):
 
         # For each slot select the higher in the sky...
 
-        targets = kwargs['query']
+        # One entry per observing block, taken from the first target of each block.
+        catalog = kwargs['catalog'] if kwargs.get('catalog') is not None else \
+            BlockCatalog.fromQuery(kwargs['query'])
 
-        radecArray = np.array([Position.fromRaDec(targets[:][0][2].targetRa,
-                                                  targets[:][0][2].targetDec)])
+        if len(catalog) == 0:
+            log.warning('No targets to schedule.')
+            return obsSlots
 
-        moonPar = np.array([( target[1].minmoonDist,
-                              target[1].minmoonBright ,
-                              target[1].maxmoonBright,
-                              target[0].length) for target in targets[:]],
-                           dtype=[('minmoonDist',np.float),
-                                  ('minmoonBright',np.float),
-                                  ('maxmoonBright',np.float),
-                                  ('lenght',np.float)])
+        nsecondary = catalog['ntargets'] - 1
 
-        radecPos = np.array([0])
+        # Block length is used as an hour angle offset (in arcseconds), as in Coord.fromAS(length). Convert it to a
+        # time offset in days.
+        time_offset = catalog['length']/3600./360.98564736629
 
-        blockid = targets[:][0][0].blockid
+        # Altitude of the blocks at the middle of their observation and moon position, read from the visibility cube
+        # of the night. Altitudes are read one slot at a time, so large catalogs do not need a slots x blocks matrix.
+        cube = kwargs.get('visibility')
+        if cube is None:
+            with ScheduleExecutor(pool_size) as executor:
+                cube = VisibilityCube.forNight(site, nightstart,
+                                               executor=kwargs.get('executor', executor))
+        cols = cube.columns(catalog['tid'])
 
-        for itr,target in enumerate(targets):
-            if blockid != target[0].blockid:
-                radecArray =  np.append(radecArray,Position.fromRaDec(target[2].targetRa,
-                                                                      target[2].targetDec))
-                blockid = target[0].blockid
-                radecPos = np.append(radecPos,itr)
+        moon = cube.moon(obsSlots['start'])
+        log.debug('Reading visibility for %i slots x %i blocks' % (len(obsSlots), len(cols)))
 
-        '''
-        radecArray = np.array([Position.fromRaDec(target[2].targetRa,
-                                                 target[2].targetDec) for target in targets])'''
+        available = AvailableTargets(catalog)
 
-        mask = np.zeros(len(radecArray)) == 0
-        #radecPos = np.arange(len(radecArray))
+        # Only blocks inside the largest moon exclusion radius are checked for moon distance
+        skyIndex = catalog.skyIndex()
+        maxMoonDist = catalog['minmoonDist'].max()
         nblocks_scheduled = 0
 
         for itr in range(len(obsSlots)):
@@ -103,191 +107,81 @@ class Higher(BaseScheduleAlgorith):
             # this "if" is the key to multitarget blocks...
             if obsSlots['blockid'][itr] == -1:
 
-                dateTime = datetimeFromJD(obsSlots['start'][itr])
-
-                lst = site.LST_inRads(dateTime) # in radians
-
-                # This loop is really slow! Must think of a way to speed
-                # things up...
-
                 # Apply moon exclusion radius..
-                moonPos = site.moonpos(dateTime)
-                moonRaDec = site.altAzToRaDec(moonPos,lst)
-
-                moonBrightness = site.moonphase(dateTime)*100.
+                moonAlt = moon['alt'][itr]
+                moonBrightness = moon['brightness'][itr]
 
                 if (
-                    (not (moonPar['minmoonBright'].max() < moonBrightness < moonPar['maxmoonBright'].min())) and
-                        (moonPos.alt > 0.)
+                    (not (available.max('minmoonBright') < moonBrightness <
+                              available.min('maxmoonBright'))) and
+                        (moonAlt > 0.)
                     ):
                     log.warning('Slot[%03i]: Moon brightness (%5.1f%%) out of range (%5.1f%% -> %5.1f%%). \
     Moon alt. = %6.2f. Skipping this slot...'%(itr+1,
                                       moonBrightness,
-                                      moonPar['minmoonBright'].max(),
-                                      moonPar['maxmoonBright'].min(),
-                                      moonPos.alt))
+                                      available.max('minmoonBright'),
+                                      available.min('maxmoonBright'),
+                                      moonAlt))
                     continue
 
-                # Calculate target parameters
-                log.debug('Starting slow loop')
-
-                targetPar = np.zeros(len(radecArray),
-                                     dtype=[('altitude', np.float),
-                                            ('start_altitude', np.float),
-                                            ('end_altitude', np.float),
-                                            ('moonD', np.float),
-                                            ('minmoonD', np.float),
-                                            ('mask_moonBright', np.bool)])
-
-                def worker(index):
-                    try:
-                        time_offset = Coord.fromAS(moonPar['lenght'][index])
-                        log.debug('%s %s %s' % (lst, time_offset.R, time_offset.H))
-                        targetPar[index] = (
-                            float(site.raDecToAltAz(radecArray[index],lst+time_offset.R/2.).alt),
-                            float(site.raDecToAltAz(radecArray[index],lst).alt),
-                            float(site.raDecToAltAz(radecArray[index],lst+time_offset.R).alt),
-                            radecArray[index].angsep(moonRaDec),
-                            moonPar['minmoonDist'][index],
-                            ((moonPar['minmoonBright'][index] < moonBrightness < moonPar['maxmoonBright'][index])
-                             or (moonPos.alt < 0.))
-                        )
-                    except Exception, e:
-                        log.exception(e)
-
-                # for item in items:
-                #     pool.apply_async(worker, (item,))
-                #
-                # pool.close()
-                # pool.join()
-                pool = Pool(pool_size)
-
-                for i in range(len(radecArray)):
-                    # if i % 100 == 0:
-                    #     log.debug('%i/%i'%(i,len(radecArray)))
-                    #
-                    # targetPar[i] = ( float(site.raDecToAltAz(radecArray[i],lst).alt),
-                    #                  radecArray[i].angsep(moonRaDec),
-                    #                  targets[i][1].minmoonDist,
-                    #                  targets[i][1].minmoonBright < moonBrightness < targets[i][1].maxmoonBright )
-                    pool.apply_async(worker,(i,))
-
-                log.debug('Starting pool')
-                pool.close()
-                pool.join()
-                log.debug('Pool done')
-
                 # Create moon mask
-                moonMask = np.bitwise_and(targetPar['moonD'] > targetPar['minmoonD'],targetPar['mask_moonBright'])
+                mask_moonBright = np.bitwise_or(np.bitwise_and(catalog['minmoonBright'] < moonBrightness,
+                                                               moonBrightness < catalog['maxmoonBright']),
+                                                moonAlt < 0.)
+                moonMask = mask_moonBright
+                near, moonDist = skyIndex.query(moon['ra'][itr], moon['dec'][itr], maxMoonDist)
+                moonMask[near[moonDist <= catalog['minmoonDist'][near]]] = False
 
-                # guarantee it is a copy not a reference...
-                # tmp_Mask = np.bitwise_and(moonMask)
-                mapping = np.arange(len(mask))[moonMask]
-                tmp_radecArray = np.array(radecArray[moonMask], copy=True)
-                tmp_radecPos = np.array(radecPos[moonMask], copy=True)
+                altitude = cube.altitude(obsSlots['start'][itr:itr+1], cols, time_offset/2.)[0]
+                stg = available.argmax(altitude, moonMask)
 
-                if len(tmp_radecArray) == 0:
+                if stg < 0:
                     log.warning('Slot[%03i]: Could not find suitable target'%(itr+1))
                     continue
 
-                #sitelat = np.sum(np.array([float(tt) / 60.**i for i,tt in enumerate(str(site['latitude']).split(':'))]))
-                alt = targetPar['altitude'][moonMask]
-
-                stg = alt.argmax()
-                start_alt = targetPar['start_altitude'][moonMask][stg]
-                end_alt = targetPar['end_altitude'][moonMask][stg]
+                alt = altitude[stg]
+                start_alt, end_alt = cube.altitude(obsSlots['start'][itr]+np.array([0., time_offset[stg]]),
+                                                   cols[stg:stg+1])[:, 0]
 
                 # Check airmass
-                airmass = 1./np.cos(np.pi/2.-alt[stg]*np.pi/180.)
+                airmass = 1./np.cos(np.pi/2.-alt*np.pi/180.)
                 start_airmass = 1./np.cos(np.pi/2.-start_alt*np.pi/180.)
                 end_airmass = 1./np.cos(np.pi/2.-end_alt*np.pi/180.)
                 # Since this is the highest at this time, doesn't make
                 # sense to iterate over it
-                if start_airmass > targets[:][radecPos[stg]][1].maxairmass or \
-                                start_airmass > targets[:][radecPos[stg]][1].maxairmass or airmass < 0.:
+                if start_airmass > catalog['maxairmass'][stg] or airmass < 0.:
                     log.info('Object too low in the sky, (Alt.=%6.2f) airmass = %5.2f/%5.2f/%5.2f (max = %5.2f)... '
-                             'Skipping this slot..' % (alt[stg], start_airmass, airmass, end_airmass,
-                                                     targets[:][radecPos[stg]][1].maxairmass))
+                             'Skipping this slot..' % (alt, start_airmass, airmass, end_airmass,
+                                                     catalog['maxairmass'][stg]))
                     continue
 
-                # Now, this one makes sense to iterate over.. But, a target
-                # that is too close to the moon now, may not be in the
-                # future, so, need to keep it in the list. That's why we
-                # use temporary arrays...
-                # s_target = targets[:][tmp_radecPos[stg]]
-
-                # while ( (tmp_radecArray[stg].angsep(moonRaDec) < s_target[1].minmoonDist)  ):
-                #     if len(tmp_Mask) == 0:
-                #         break
-                #     msg = '''Target %s %s cannot be observed due to moon restrictions (d = %.2f < %.2f). Moon @ %s (Phase: %.2f)'''
-                #     log.warning(msg%(s_target[0],
-                #                      s_target[2],
-                #                      tmp_radecArray[stg].angsep(moonRaDec),
-                #                      s_target[1].minmoonDist,
-                #                      moonRaDec,
-                #                      moonBrightness))
-                #     tmp_Mask[stg] = False
-                #     tmp_radecArray = tmp_radecArray[tmp_Mask]
-                #     tmp_radecPos = tmp_radecPos[tmp_Mask]
-                #     alt = alt[tmp_Mask]
-                #     stg = alt.argmax()
-                #     tmp_Mask = tmp_Mask[tmp_Mask]
-                #     # Check airmass
-                #     airmass = 1./np.cos(np.pi/2.-alt[stg]*np.pi/180.)
-                #     if airmass > targets[:][radecPos[stg]][1].maxairmass:
-                #         log.info('New object too low in the sky, (Alt.=%6.2f) airmass = %5.2f (max = %5.2f)...'%(alt[stg],airmass,targets[:][radecPos[stg]][1].maxairmass))
-                #
-                #         tmp_Mask = [] # empty tmp mask. This is the highest! No sense going on...
-                #         break
-                #     s_target = targets[:][tmp_radecPos[stg]]
-
-                s_target = targets[tmp_radecPos[stg]]
+                s_target = catalog.rows[stg]
 
                 log.info('Slot[%03i] @%.3f: %s %s (Alt.=%6.2f, airmass=%5.2f (max=%5.2f))' % (itr+1,
                                                                                               obsSlots['start'][itr],
                                                                                               s_target[0],
                                                                                               s_target[2],
-                                                                                              start_alt,
+                                                                                              alt,
                                                                                               airmass,
-                                                                                              s_target[1].maxairmass))
+                                                                                              catalog['maxairmass'][stg]))
 
-                mask[mapping[stg]] = False
-                radecArray = radecArray[mask]
-                radecPos = radecPos[mask]
-                moonPar = moonPar[mask]
-                mask = mask[mask]
+                # In "TIMESEQUENCE" a target that is selected now is kept in the queue so it can be scheduled again.
+                if not revisit:
+                    available.remove(stg)
                 obsSlots['blockid'][itr] = s_target[0].blockid
                 nblocks_scheduled += 1
                 if max_sched_blocks > 0 and nblocks_scheduled >= max_sched_blocks:
                     log.info('Maximum number of scheduled blocks (%i) reached. Stopping.' % max_sched_blocks)
                     break
 
-
                 # Check if this block has more targets...
-                secTargets = targets.filter(ObsBlock.blockid == s_target[0].blockid,
-                                            ObsBlock.objid != s_target[0].objid)
-
-                if secTargets.count() > 0:
+                if nsecondary[stg] > 0:
                     log.debug(red('Secondary targets not implemented yet...'))
                     pass
 
-                if len(mask) == 0:
+                if not available.any():
                     break
 
-                '''
-                if not targets[stg][0].blockid in obsTargets['blockid']:
-                    #log.debug('#%s %i %i %f: lst = %f | ra = %f | scheduled = %i'%(s_target[0].pid,stg,targets[:][stg][0].blockid,obsSlots['start'][itr],lst,s_target[1].targetRa,targets[:][stg][0].scheduled))
-                    log.info('Slot[%03i]: %s'%(itr+1,s_target[2]))
-
-                    #obsTargets = np.append( obsTargets, np.array((s_target[0],s_target[1],targets[stg][0].blockid),dtype=[('obsblock',ObsBlock),('targets',Targets),('blockid',np.int)]))
-
-                    #self.addObservation(s_target[0],obsSlots['start'][itr])
-                    targets[stg][0].scheduled = True
-
-                else:
-                    log.debug('#Block already scheduled#%s %i %i %f: lst = %f | ra = %f | scheduled = %i'%(s_target[0].pid,stg,targets[stg][0].blockid,obsSlots['start'][itr],lst,s_target[1].targetRa,targets[stg][0].scheduled))
-                '''
-            #targets = targets.filter(ObsBlock.scheduled == False)
             else:
                 log.warning('Observing slot[%i]@%.4f is already filled with block id %i...'%(itr,
                                                                                              obsSlots['start'][itr],
@@ -56,6 +56,8 @@ class Recurrent(BaseScheduleAlgorith):
                                                      and_(ObsBlock.observed == True,
                                                           ObsBlock.lastObservation < reference_date)))
         new_ntargets = len(kwargs['query'][:])
+        # A catalog built from the unfiltered query would bypass the selection above
+        kwargs.pop('catalog', None)
         log.debug('Filtering %i of %i targets' % (new_ntargets, ntargets))
         # Select targets with the Higher algorithm
         programs = Higher.process(slotLen=slotLen,*args,**kwargs)
@@ -78,24 +80,27 @@ class Recurrent(BaseScheduleAlgorith):
     @staticmethod
     def add(block):
         session = Session()
+        Recurrent.addBlocks(session, [block])
+        session.commit()
 
-        obsblock = session.merge(block[0])
-
-        # Check if this is already in the database
-        recurrent_block = session.query(RecurrentDB).filter(RecurrentDB.pid == obsblock.pid,
-                                                          RecurrentDB.blockid == obsblock.id,
-                                                          RecurrentDB.tid == obsblock.objid).first()
-
-        if recurrent_block is None:
+    @staticmethod
+    def addBlocks(session, blocks):
+        # Check which are already in the database
+        keys = set([(block[0].pid, block[0].id, block[0].objid) for block in blocks])
+        existing = set()
+        for pid in set([key[0] for key in keys]):
+            existing.update(session.query(RecurrentDB.pid,
+                                          RecurrentDB.blockid,
+                                          RecurrentDB.tid).filter(RecurrentDB.pid == pid).all())
+
+        for pid, blockid, tid in keys - existing:
             # Not in the database, add it
             recurrent_block = RecurrentDB()
-            recurrent_block.pid = obsblock.pid
-            recurrent_block.blockid = obsblock.id
-            recurrent_block.tid = obsblock.objid
+            recurrent_block.pid = pid
+            recurrent_block.blockid = blockid
+            recurrent_block.tid = tid
             session.add(recurrent_block)
 
-        session.commit()
-
     @staticmethod
     def observed(time, program, site = None, soft = False):
         '''
@@ -48,8 +48,9 @@ class Timed(BaseScheduleAlgorith):
         # Select targets with the Higher algorithm
         programs = Higher.process(slotLen=slotLen,*args,**kwargs)
 
-        session = Session()
-        # Store desired times in the database
+        # Store desired times in the database, together with the queue if a QueueWriter is given
+        writer = kwargs.get('writer')
+        session = Session() if writer is None else None
         try:
             for obs_times in config['times']:
                 if obs_times > nightend:
@@ -58,10 +59,14 @@ class Timed(BaseScheduleAlgorith):
                 print('Requesting observation @ %.3f' % obs_times)
                 timed = TimedDB(pid = config['pid'],
                                 execute_at=obs_times)
-                session.add(timed)
+                if writer is not None:
+                    writer.add(timed)
+                else:
+                    session.add(timed)
             return programs
         finally:
-            session.commit()
+            if session is not None:
+                session.commit()
 
 
     @staticmethod
@@ -0,0 +1,318 @@
+'''
+Benchmark of the scheduling algorithms on synthetic target catalogs. Everything runs offline: the site is a
+SiteEphemeris with a fixed clock and the robotic observatory database is replaced by an in-memory sqlite database, so
+runs are deterministic and can be compared between versions (see the chimera-schedbench script).
+
+Each run (visibility, or an algorithm on a catalog size) is done in a child process and the peak memory is measured
+from the start of each step, so the peak of a step is not hidden by the largest run done before it.
+'''
+
+import os
+import time
+import cPickle
+import resource
+import datetime
+import logging
+
+import numpy as np
+
+from chimera_supervisor.core.database import createEngine
+from chimera_supervisor.controllers.scheduler import model
+from chimera_supervisor.controllers.scheduler.model import (Session, Projects, BlockPar, ObsBlock, Targets, Program,
+                                                            Action, Expose)
+from chimera_supervisor.controllers.scheduler.ephemeris import SiteEphemeris, UTC
+from chimera_supervisor.controllers.scheduler.visibility import VisibilityCube
+from chimera_supervisor.controllers.scheduler.catalog import BlockCatalog
+from chimera_supervisor.controllers.scheduler.queuewriter import QueueWriter
+from chimera_supervisor.controllers.scheduler.algorithms import (Higher, ExtintionMonitor, TimeSequence, Timed,
+                                                                 Recurrent)
+
+log = logging.getLogger(__name__)
+
+ALGORITHMS = [Higher, ExtintionMonitor, TimeSequence, Timed, Recurrent]
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+# Number of next() calls timed on each run, evenly distributed over the night.
+NEXT_CALLS = 20
+
+
+class BenchmarkSite(SiteEphemeris):
+    '''
+    SiteEphemeris with a fixed "now", so algorithms that look at the current time (Recurrent, observed) give the
+    same results on every run.
+    '''
+
+    def __init__(self, latitude=-30.1678, longitude=-70.8046, elevation=2187., now=None):
+        SiteEphemeris.__init__(self, np.radians(latitude), np.radians(longitude), elevation)
+        self.now = now if now is not None else datetime.datetime(2017, 6, 15, 18, 0, 0)
+
+    def ut(self):
+        return self.now.replace(tzinfo=UTC)
+
+
+class BenchmarkResult(object):
+
+    def __init__(self, algorithm, size, step, wall, peak, filled=0, total=0, calls=1):
+        self.algorithm = algorithm
+        self.size = size
+        self.step = step
+        self.wall = wall
+        self.peak = peak
+        self.filled = filled
+        self.total = total
+        self.calls = calls
+
+    def __str__(self):
+        return '%-16s %8i %-10s %10.4f %10.4f %9.1f %13s' % (self.algorithm, self.size, self.step, self.wall,
+                                                           self.wall/max(self.calls, 1), self.peak,
+                                                           '%i/%i' % (self.filled, self.total) if self.total else '')
+
+    @staticmethod
+    def header():
+        return '%-16s %8s %-10s %10s %10s %9s %13s' % ('algorithm', 'blocks', 'step', 'wall[s]', 'call[s]',
+                                                       'peak[MB]', 'filled/slots')
+
+
+def _resetPeakMemory():
+    # Reset the peak resident memory of the process to its current value (linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear:
+            clear.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def _peakMemory():
+    # Peak resident memory of the process, in MB, since the last _resetPeakMemory (since the process started if it
+    # cannot be reset). ru_maxrss is in kB on linux.
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024.
+    except (IOError, OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+def _isolated(function, *args):
+    '''
+    Call function in a child process and return its result, so the memory it uses does not count on the next runs.
+    Calls it in this process where fork is not available.
+    '''
+    if not hasattr(os, 'fork'):
+        return function(*args)
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            try:
+                result = (True, function(*args))
+            except Exception, e:
+                log.exception(e)
+                result = (False, repr(e))
+            with os.fdopen(write, 'wb') as output:
+                cPickle.dump(result, output, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            os._exit(0)
+
+    os.close(write)
+    with os.fdopen(read, 'rb') as input:
+        data = input.read()
+    os.waitpid(pid, 0)
+
+    if not data:
+        raise RuntimeError('Benchmark process died.')
+    ok, value = cPickle.loads(data)
+    if not ok:
+        raise RuntimeError(value)
+    return value
+
+
+def useMemoryDatabase():
+    '''
+    Bind the scheduler Session to a new in-memory sqlite database, for the rest of the process.
+
+    :return: the database engine.
+    '''
+    engine = createEngine('sqlite://')
+    model.metaData.create_all(engine)
+    Session.configure(bind=engine)
+    return engine
+
+
+def makeCatalog(engine, size, pid, schedalgorith, seed=0):
+    '''
+    Fill the database with a project and size observing blocks, one target and one exposure each. Targets are
+    uniformly distributed in the sky, from the south pole to +30 degrees.
+    '''
+    model.metaData.drop_all(engine)
+    model.metaData.create_all(engine)
+
+    rs = np.random.RandomState(seed)
+    ra = rs.uniform(0., 24., size)
+    dec = np.degrees(np.arcsin(rs.uniform(-1., 0.5, size)))
+    length = rs.uniform(300., 3600., size)
+    exptime = rs.randint(10, 300, size)
+    frames = rs.randint(1, 5, size)
+    ids = np.arange(1, size+1)
+
+    connection = engine.connect()
+    transaction = connection.begin()
+    connection.execute(Projects.__table__.insert(), [{'pid': pid, 'priority': 1}])
+    connection.execute(BlockPar.__table__.insert(), [{'id': 1, 'bid': 1, 'pid': pid, 'maxairmass': 2.0,
+                                                      'minmoonDist': 20., 'schedalgorith': schedalgorith}])
+    connection.execute(Targets.__table__.insert(), [{'id': int(i), 'name': 'BENCH%06i' % i,
+                                                     'targetRa': float(ra[i-1]), 'targetDec': float(dec[i-1])}
+                                                    for i in ids])
+    connection.execute(ObsBlock.__table__.insert(), [{'id': int(i), 'objid': int(i), 'blockid': int(i),
+                                                      'bparid': 1, 'pid': pid, 'length': float(length[i-1])}
+                                                     for i in ids])
+    connection.execute(Action.__table__.insert(), [{'id': int(i), 'block_id': int(i), 'type': 'Expose'}
+                                                   for i in ids])
+    connection.execute(Expose.__table__.insert(), [{'id': int(i), 'exptime': int(exptime[i-1]),
+                                                    'frames': int(frames[i-1])} for i in ids])
+    transaction.commit()
+    connection.close()
+
+
+def algorithmConfig(algorithm, pid, slotLen):
+    '''
+    Configuration given to each algorithm, as in a project configuration file.
+    '''
+    config = {'slotLen': slotLen}
+    if algorithm is Timed:
+        config.update({'pid': pid, 'times': [1., 3., 5.]})
+    elif algorithm is Recurrent:
+        config.update({'recurrence': 1})
+    return config
+
+
+def runAlgorithm(engine, algorithm, size, site, nightstart, nightend, slotLen=900., seed=0):
+    '''
+    Benchmark process and next of one algorithm on a catalog of the given size.
+
+    :return: list of BenchmarkResult
+    '''
+    pid = 'BENCH'
+    makeCatalog(engine, size, pid, algorithm.id(), seed)
+    results = []
+
+    # Same catalog for every algorithm, so this is the cube computed by benchmarkVisibility
+    cube = VisibilityCube.forNight(site, nightstart, cacheDir=None)
+
+    session = Session()
+    query = session.query(ObsBlock, BlockPar, Targets).filter(ObsBlock.pid == pid,
+                                                               BlockPar.pid == pid).join(BlockPar).join(Targets)
+
+    _resetPeakMemory()
+    t0 = time.time()
+    catalog = BlockCatalog.fromQuery(query)
+    results.append(BenchmarkResult(algorithm.name(), size, 'catalog', time.time()-t0, _peakMemory()))
+
+    writer = QueueWriter(session)
+
+    _resetPeakMemory()
+    t0 = time.time()
+    slots = algorithm.process(slotLen,
+                              obsStart=nightstart,
+                              obsEnd=nightend,
+                              query=query,
+                              site=site,
+                              config=algorithmConfig(algorithm, pid, slotLen),
+                              visibility=cube,
+                              catalog=catalog,
+                              writer=writer,
+                              today=site.now)
+    wall = time.time()-t0
+    nslots = int(np.ceil((nightend-nightstart)*86400./slotLen))
+    results.append(BenchmarkResult(algorithm.name(), size, 'process', wall, _peakMemory(),
+                                   int(np.sum(slots['blockid'] > 0)), nslots))
+
+    # Write the selected blocks as programs, as chimera-robobs makeQueue does.
+    _resetPeakMemory()
+    t0 = time.time()
+    writer.addSlots(query, slots, algorithm)
+    nprograms = writer.flush()
+    results.append(BenchmarkResult(algorithm.name(), size, 'queue', time.time()-t0, _peakMemory(),
+                                   nprograms, nprograms))
+
+    programs = session.query(Program, BlockPar, ObsBlock, Targets).join(
+        BlockPar, Program.blockpar_id == BlockPar.id).join(
+        ObsBlock, Program.obsblock_id == ObsBlock.id).join(
+        Targets, Program.tid == Targets.id).filter(Program.finished == False).order_by(Program.slewAt)
+
+    if programs.count() > 0:
+        ExtintionMonitor.site = site
+        times = np.linspace(nightstart, nightend, NEXT_CALLS)-2400000.5
+        found = 0
+        _resetPeakMemory()
+        t0 = time.time()
+        for mjd in times:
+            if algorithm.next(mjd, programs) is not None:
+                found += 1
+        results.append(BenchmarkResult(algorithm.name(), size, 'next', time.time()-t0, _peakMemory(),
+                                       found, len(times), len(times)))
+
+    session.commit()
+    return results
+
+
+def benchmarkVisibility(engine, size, site, nightstart, seed=0):
+    '''
+    Benchmark the computation of the visibility cube of the night for a catalog of the given size.
+    '''
+    makeCatalog(engine, size, 'BENCH', 0, seed)
+
+    _resetPeakMemory()
+    t0 = time.time()
+    VisibilityCube.forNight(site, nightstart, cacheDir=None)
+    return BenchmarkResult('ALL', size, 'visibility', time.time()-t0, _peakMemory())
+
+
+def run(sizes=None, algorithms=None, date=None, slotLen=900., seed=0, output=None):
+    '''
+    Run the benchmark for every algorithm and catalog size.
+
+    :param sizes: number of observing blocks of each catalog.
+    :param algorithms: algorithm classes to benchmark.
+    :param date: date of the night (evening), default 2017-06-15.
+    :param output: function called with each result line as it is ready.
+    :return: list of BenchmarkResult
+    '''
+    sizes = sizes if sizes is not None else DEFAULT_SIZES
+    algorithms = algorithms if algorithms is not None else ALGORITHMS
+    date = date if date is not None else datetime.datetime(2017, 6, 15, 18, 0, 0)
+
+    site = BenchmarkSite(now=date)
+    nightstart = site.JD(site.sunset_twilight_end(date))
+    nightend = site.JD(site.sunrise_twilight_begin(date))
+
+    engine = useMemoryDatabase()
+
+    if output is not None:
+        output(BenchmarkResult.header())
+
+    results = []
+    for size in sizes:
+        result = _isolated(benchmarkVisibility, engine, size, site, nightstart, seed)
+        results.append(result)
+        if output is not None:
+            output(str(result))
+
+        for algorithm in algorithms:
+            try:
+                for result in _isolated(runAlgorithm, engine, algorithm, size, site, nightstart, nightend, slotLen,
+                                        seed):
+                    results.append(result)
+                    if output is not None:
+                        output(str(result))
+            except Exception, e:
+                log.exception(e)
+                if output is not None:
+                    output('%-16s %8i failed: %s' % (algorithm.name(), size, repr(e)))
+
+    return results
@@ -0,0 +1,223 @@
+'''
+Columnar catalog of observing blocks. The (ObsBlock, BlockPar, Targets) rows selected for scheduling are read once and
+stored as a numpy structured array with one entry per observing block: coordinates of its first target (in radians),
+block constraints and the exposure content used to compute the block duration. Scheduling algorithms work on these
+columns instead of building arrays of Position objects from the query.
+'''
+
+import logging
+
+import numpy as np
+
+from chimera_supervisor.controllers.scheduler.model import Expose, AutoFocus
+from chimera_supervisor.controllers.scheduler.skyindex import SkyIndex
+
+log = logging.getLogger(__name__)
+
+# Maximum number of ids in a single "IN" clause (sqlite limits the number of variables of a statement).
+_MAX_IN = 500
+
+BLOCK_DTYPE = [('blockid', np.int64),
+               ('tid', np.int64),
+               ('ra', np.float64),
+               ('dec', np.float64),
+               ('schedalgorith', np.int64),
+               ('maxairmass', np.float64),
+               ('minairmass', np.float64),
+               ('minmoonDist', np.float64),
+               ('minmoonBright', np.float64),
+               ('maxmoonBright', np.float64),
+               ('length', np.float64),
+               ('exptime', np.float64),
+               ('frames', np.int64),
+               ('focusAlign', np.int64),
+               ('focusSet', np.int64),
+               ('ntargets', np.int64)]
+
+
+class BlockCatalog(object):
+    '''
+    One entry per observing block, in the order blocks first appear in the query.
+
+    Columns are accessed by name (catalog['ra']). The first (ObsBlock, BlockPar, Targets) row of each block is kept in
+    rows, for logging and for database updates.
+    '''
+
+    def __init__(self, blocks, rows):
+        self.blocks = blocks
+        self.rows = rows
+        self._skyIndex = None
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, column):
+        return self.blocks[column]
+
+    @staticmethod
+    def fromQuery(query):
+        '''
+        Build the catalog from an (ObsBlock, BlockPar, Targets) query. The query is executed once and actions of all
+        blocks are read in bulk.
+
+        :param query: SQLAlchemy query returning (ObsBlock, BlockPar, Targets) rows.
+        :return: BlockCatalog
+        '''
+        rows = query.all()
+
+        index = {}
+        first = []
+        rowBlock = np.zeros(len(rows), dtype=np.int)
+        for i, row in enumerate(rows):
+            blockid = row[0].blockid
+            if blockid not in index:
+                index[blockid] = len(first)
+                first.append(i)
+            rowBlock[i] = index[blockid]
+
+        blocks = np.zeros(len(first), dtype=BLOCK_DTYPE)
+
+        if len(first) > 0:
+            blocks['ntargets'] = np.bincount(rowBlock, minlength=len(first))
+            data = np.array([(rows[i][0].blockid,
+                              rows[i][2].id,
+                              rows[i][2].targetRa,
+                              rows[i][2].targetDec,
+                              rows[i][1].schedalgorith,
+                              rows[i][1].maxairmass,
+                              rows[i][1].minairmass,
+                              rows[i][1].minmoonDist,
+                              rows[i][1].minmoonBright,
+                              rows[i][1].maxmoonBright,
+                              rows[i][0].length) for i in first], dtype=np.float64)
+
+            for j, column in enumerate(['blockid', 'tid', 'ra', 'dec', 'schedalgorith', 'maxairmass', 'minairmass',
+                                        'minmoonDist', 'minmoonBright', 'maxmoonBright', 'length']):
+                blocks[column] = data[:, j]
+            blocks['ra'] *= np.pi/12.
+            blocks['dec'] *= np.pi/180.
+
+            BlockCatalog._readActions(query.session, rows, rowBlock, blocks)
+
+        log.debug('Block catalog with %i blocks from %i rows' % (len(blocks), len(rows)))
+        return BlockCatalog(blocks, [rows[i] for i in first])
+
+    @staticmethod
+    def _readActions(session, rows, rowBlock, blocks):
+        # Sum exposures and count autofocus actions of every ObsBlock in the catalog
+        obsblock = dict([(row[0].id, rowBlock[i]) for i, row in enumerate(rows)])
+        ids = obsblock.keys()
+
+        for i in range(0, len(ids), _MAX_IN):
+            chunk = ids[i:i+_MAX_IN]
+
+            for block_id, exptime, frames in session.query(Expose.block_id,
+                                                           Expose.exptime,
+                                                           Expose.frames).filter(Expose.block_id.in_(chunk)):
+                blocks['exptime'][obsblock[block_id]] += exptime*frames
+                blocks['frames'][obsblock[block_id]] += frames
+
+            for block_id, step in session.query(AutoFocus.block_id,
+                                                AutoFocus.step).filter(AutoFocus.block_id.in_(chunk)):
+                if step > 0:
+                    blocks['focusAlign'][obsblock[block_id]] += 1
+                elif step == 0:
+                    blocks['focusSet'][obsblock[block_id]] += 1
+
+    def skyIndex(self):
+        '''
+        SkyIndex over the block coordinates, built on first use.
+        '''
+        if self._skyIndex is None:
+            self._skyIndex = SkyIndex(self.blocks['ra'], self.blocks['dec'])
+        return self._skyIndex
+
+    def select(self, mask):
+        '''
+        Catalog with the blocks selected by mask (boolean array or indexes).
+        '''
+        index = np.arange(len(self.blocks))[mask]
+        return BlockCatalog(self.blocks[index], [self.rows[i] for i in index])
+
+    def duration(self, overheads=None):
+        '''
+        Duration of each block (seconds) from its exposures, plus readout and autofocus overheads.
+
+        :param overheads: dictionary as {'autofocus': {'align': 0., 'set': 0.}, 'readout': 0.}
+        '''
+        overheads = overheads if overheads is not None else {}
+        readout = overheads.get('readout', 0.)
+        autofocus = overheads.get('autofocus', {})
+
+        return (self.blocks['exptime'] + readout*self.blocks['frames'] +
+                autofocus.get('align', 0.)*self.blocks['focusAlign'] +
+                autofocus.get('set', 0.)*self.blocks['focusSet'])
+
+
+class AvailableTargets(object):
+    '''
+    Blocks of a catalog that are still available for scheduling.
+
+    Removal is O(1) and does not copy the catalog: a flag is cleared and the remaining blocks are selected with
+    vectorized operations over the full columns. Minimum and maximum of a column over the available blocks are kept
+    with a pre-sorted index that is only advanced when its head is removed.
+    '''
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.mask = np.ones(len(catalog), dtype=np.bool)
+        self.count = len(catalog)
+        self._orders = {}
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, index):
+        return bool(self.mask[index])
+
+    def any(self):
+        return self.count > 0
+
+    def remove(self, index):
+        if self.mask[index]:
+            self.mask[index] = False
+            self.count -= 1
+
+    def argmax(self, values, where=None):
+        '''
+        Index of the largest value among the available blocks (and where), or -1 if there is none.
+
+        :param values: one value per block in the catalog.
+        :param where: optional boolean array with additional conditions.
+        '''
+        select = self.mask if where is None else np.bitwise_and(self.mask, where)
+        if not select.any():
+            return -1
+        return int(np.where(select, values, -np.inf).argmax())
+
+    def _first(self, column, reverse):
+        key = (column, reverse)
+        if key not in self._orders:
+            order = np.argsort(self.catalog[column], kind='mergesort')
+            self._orders[key] = [order[::-1] if reverse else order, 0]
+
+        order, pos = self._orders[key]
+        while pos < len(order) and not self.mask[order[pos]]:
+            pos += 1
+        self._orders[key][1] = pos
+
+        if pos == len(order):
+            return None
+        return self.catalog[column][order[pos]]
+
+    def max(self, column):
+        '''
+        Maximum of a catalog column over the available blocks (None if there are no blocks left).
+        '''
+        return self._first(column, True)
+
+    def min(self, column):
+        '''
+        Minimum of a catalog column over the available blocks (None if there are no blocks left).
+        '''
+        return self._first(column, False)
@@ -0,0 +1,50 @@
+'''
+Observing conditions of queue programs. Each (program, time) pair checked by the constraints (see constraints.py)
+gets a set of flags telling why the program cannot be observed at that time.
+'''
+
+import numpy as np
+
+from chimera.core.site import datetimeFromJD
+
+CONDITION_OK = 0
+CONDITION_AIRMASS = 1
+CONDITION_NIGHT_END = 2
+CONDITION_MOON_BRIGHTNESS = 4
+CONDITION_MOON_DISTANCE = 8
+CONDITION_SEEING = 16
+CONDITION_CLOUDS = 32
+CONDITION_WEATHER = 64
+
+_conditionNames = [(CONDITION_AIRMASS, 'airmass'),
+                   (CONDITION_NIGHT_END, 'night end'),
+                   (CONDITION_MOON_BRIGHTNESS, 'moon brightness'),
+                   (CONDITION_MOON_DISTANCE, 'moon distance'),
+                   (CONDITION_SEEING, 'seeing'),
+                   (CONDITION_CLOUDS, 'clouds'),
+                   (CONDITION_WEATHER, 'weather')]
+
+
+def conditionReasons(flags):
+    '''
+    Human readable list of the conditions in flags.
+    '''
+    if flags == CONDITION_OK:
+        return 'ok'
+    return ', '.join([name for flag, name in _conditionNames if flags & flag])
+
+
+def nightEnd(site, jd):
+    '''
+    Julian date of the start of the morning twilight following each jd. Twilight is only computed once for all
+    times in the same night.
+    '''
+    jd = np.atleast_1d(np.asarray(jd, dtype=np.float64))
+    end = np.zeros_like(jd)
+
+    current = None
+    for i in np.argsort(jd):
+        if current is None or jd[i] >= current:
+            current = site.JD(site.sunrise_twilight_begin(datetimeFromJD(jd[i])))
+        end[i] = current
+    return end
@@ -0,0 +1,366 @@
+'''
+Pipeline of observing constraints. Each constraint checks one restriction (airmass, moon, seeing, clouds, ...) for
+many programs and times at once and tells how expensive it is and whether it only depends on ephemerides (static) or
+on live sensor readings. The pipeline runs the static constraints first, cheapest first, on all candidates and only
+asks the live ones about the candidates that are still observable, so sensors are not read when nothing can be
+observed anyway.
+
+New constraints subclass Constraint and are added with ConstraintPipeline.add (see also the RobObs "constraints"
+option).
+'''
+
+import time
+import logging
+import threading
+
+import numpy as np
+
+from chimera_supervisor.controllers.scheduler.ephemeris import angularSeparation
+from chimera_supervisor.controllers.scheduler.conditions import (CONDITION_OK, CONDITION_AIRMASS,
+                                                                 CONDITION_NIGHT_END, CONDITION_MOON_BRIGHTNESS,
+                                                                 CONDITION_MOON_DISTANCE, CONDITION_SEEING,
+                                                                 CONDITION_CLOUDS, CONDITION_WEATHER, nightEnd)
+
+log = logging.getLogger(__name__)
+
+PROGRAM_DTYPE = [('minairmass', np.float64),
+                 ('maxairmass', np.float64),
+                 ('minmoonBright', np.float64),
+                 ('maxmoonBright', np.float64),
+                 ('minmoonDist', np.float64),
+                 ('maxseeing', np.float64),
+                 ('cloudcover', np.float64)]
+
+
+def readingValue(reading):
+    '''
+    Value of a sensor reading, which may be a plain number or an object with a value attribute (e.g. weather
+    station readings).
+    '''
+    if reading is None:
+        return None
+    return float(getattr(reading, 'value', reading))
+
+
+class SensorCache(object):
+    '''
+    Last reading of each live sensor. A sensor is only read again when its reading is older than maxAge seconds,
+    so checking many programs in a short time reads each sensor once.
+
+    :param maxAge: time (s) a reading is kept.
+    '''
+
+    def __init__(self, maxAge=60.):
+        self.maxAge = maxAge
+        self._sensors = {}
+        self._readings = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, function):
+        '''
+        Register a sensor. function is called without arguments and returns the reading, or None if not available.
+        '''
+        with self._lock:
+            self._sensors[name] = function
+            self._readings.pop(name, None)
+
+    def has(self, name):
+        return name in self._sensors
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._readings = {}
+            else:
+                self._readings.pop(name, None)
+
+    def read(self, name):
+        '''
+        Cached reading of sensor name, or None if the sensor is not registered or could not be read.
+        '''
+        with self._lock:
+            if name not in self._sensors:
+                return None
+            now = time.time()
+            if name in self._readings and now-self._readings[name][0] < self.maxAge:
+                return self._readings[name][1]
+            function = self._sensors[name]
+
+        try:
+            reading = function()
+        except Exception, e:
+            log.warning('Could not read sensor %s: %s' % (name, repr(e)))
+            reading = None
+
+        with self._lock:
+            self._readings[name] = (time.time(), reading)
+        return reading
+
+
+class ConstraintContext(object):
+    '''
+    Programs and times being checked, with the quantities shared by several constraints computed once.
+
+    As for a single program, airmass is checked at the start of the observation. If the program length is given,
+    the observation must finish before the end of the night and the moon is checked at the end of the observation.
+
+    :param cube: VisibilityCube with the targets of all programs.
+    :param site: SiteEphemeris.
+    :param programs: list of (Program, BlockPar, ObsBlock, Targets).
+    :param times: start times (MJD).
+    :param lengths: length of each program (seconds), or None.
+    :param sensors: SensorCache with the live sensors, or None.
+    '''
+
+    def __init__(self, cube, site, programs, times, lengths=None, sensors=None):
+        self.cube = cube
+        self.site = site
+        self.programs = programs
+        self.sensors = sensors
+        self.times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+        self.lengths = np.zeros(len(programs)) if lengths is None else np.asarray(lengths, dtype=np.float64)
+
+        self.par = np.array([(program[1].minairmass,
+                              program[1].maxairmass,
+                              program[1].minmoonBright,
+                              program[1].maxmoonBright,
+                              program[1].minmoonDist,
+                              program[1].maxseeing,
+                              program[1].cloudcover) for program in programs],
+                            dtype=PROGRAM_DTYPE)
+        self.cols = cube.columns([program[3].id for program in programs])
+
+        self.jd = self.times+2400000.5
+        self.hasLength = (self.lengths > 0.)[:, np.newaxis]
+        self.end = self.jd[np.newaxis, :]+self.lengths[:, np.newaxis]/86.4e3
+        self._moon = None
+
+    def __len__(self):
+        return len(self.programs)
+
+    @property
+    def shape(self):
+        return len(self.programs), len(self.times)
+
+    @property
+    def moon(self):
+        '''
+        Moon (see VisibilityCube.moon) for each program and time, at the end of the observation.
+        '''
+        if self._moon is None:
+            moonTime = np.where(self.hasLength, self.end, self.jd[np.newaxis, :])
+            self._moon = self.cube.moon(moonTime.ravel()).reshape(moonTime.shape)
+        return self._moon
+
+    def reading(self, name):
+        if self.sensors is None:
+            return None
+        return self.sensors.read(name)
+
+
+class Constraint(object):
+    '''
+    Base class of the constraints.
+
+    flag is the CONDITION_* flag set when the constraint fails, cost a relative estimate of how expensive the
+    constraint is and live tells if it needs sensor readings.
+    '''
+    name = 'base'
+    flag = CONDITION_OK
+    cost = 1.
+    live = False
+
+    def evaluate(self, context, rows):
+        '''
+        Check the constraint for some of the programs.
+
+        :param context: ConstraintContext.
+        :param rows: indexes of the programs to check.
+        :return: boolean matrix (rows x times), True where the constraint is violated.
+        '''
+        return np.zeros((len(rows), len(context.times)), dtype=bool)
+
+    def __str__(self):
+        return '%s(cost=%.1f%s)' % (self.name, self.cost, ', live' if self.live else '')
+
+
+class AirmassConstraint(Constraint):
+    name = 'airmass'
+    flag = CONDITION_AIRMASS
+    cost = 1.
+
+    def evaluate(self, context, rows):
+        par = context.par[rows]
+        airmass = context.cube.airmass(context.jd, context.cols[rows]).T
+        return np.bitwise_not((par['minairmass'][:, np.newaxis] < airmass) &
+                              (airmass < par['maxairmass'][:, np.newaxis]))
+
+
+class NightEndConstraint(Constraint):
+    '''
+    Programs with a length must end before the start of the morning twilight.
+    '''
+    name = 'night end'
+    flag = CONDITION_NIGHT_END
+    cost = 2.
+
+    def evaluate(self, context, rows):
+        hasLength = context.hasLength[rows]
+        if not hasLength.any():
+            return np.zeros((len(rows), len(context.times)), dtype=bool)
+        return hasLength & (context.end[rows] > nightEnd(context.site, context.jd)[np.newaxis, :])
+
+
+class MoonBrightnessConstraint(Constraint):
+    '''
+    Moon brightness must be inside the program range, unless the moon is bellow the horizon.
+    '''
+    name = 'moon brightness'
+    flag = CONDITION_MOON_BRIGHTNESS
+    cost = 1.
+
+    def evaluate(self, context, rows):
+        par = context.par[rows]
+        moon = context.moon[rows]
+        return np.bitwise_not(((par['minmoonBright'][:, np.newaxis] < moon['brightness']) &
+                               (moon['brightness'] < par['maxmoonBright'][:, np.newaxis])) | (moon['alt'] < 0.))
+
+
+class MoonDistanceConstraint(Constraint):
+    name = 'moon distance'
+    flag = CONDITION_MOON_DISTANCE
+    cost = 1.5
+
+    def evaluate(self, context, rows):
+        cols = context.cols[rows]
+        moon = context.moon[rows]
+        moonDist = angularSeparation(context.cube.ra[cols][:, np.newaxis], context.cube.dec[cols][:, np.newaxis],
+                                     moon['ra'], moon['dec'])
+        return moonDist < context.par['minmoonDist'][rows][:, np.newaxis]
+
+
+class SeeingConstraint(Constraint):
+    '''
+    Current seeing must be bellow the program maximum. Negative readings mean no measurement and are ignored.
+    '''
+    name = 'seeing'
+    flag = CONDITION_SEEING
+    cost = 10.
+    live = True
+
+    def evaluate(self, context, rows):
+        seeing = readingValue(context.reading('seeing'))
+        violated = np.zeros((len(rows), len(context.times)), dtype=bool)
+        if seeing is None or seeing < 0.:
+            log.debug('No seeing measurement...')
+            return violated
+        violated[seeing > context.par['maxseeing'][rows]] = True
+        return violated
+
+
+class CloudConstraint(Constraint):
+    '''
+    Current cloud cover (%), from the sky transparency measured by the cloud sensor, must be bellow the program
+    cloudcover. Programs with cloudcover <= 0 have no cloud restriction.
+    '''
+    name = 'clouds'
+    flag = CONDITION_CLOUDS
+    cost = 10.
+    live = True
+
+    def evaluate(self, context, rows):
+        violated = np.zeros((len(rows), len(context.times)), dtype=bool)
+        cloudcover = context.par['cloudcover'][rows]
+        if not (cloudcover > 0.).any():
+            return violated
+        transparency = readingValue(context.reading('transparency'))
+        if transparency is None:
+            log.debug('No sky transparency measurement...')
+            return violated
+        violated[(cloudcover > 0.) & (100.-transparency > cloudcover)] = True
+        return violated
+
+
+class WeatherConstraint(Constraint):
+    '''
+    Nothing can be observed with humidity or wind speed above the given limits. Limits set to None are not checked.
+    '''
+    name = 'weather'
+    flag = CONDITION_WEATHER
+    cost = 10.
+    live = True
+
+    def __init__(self, maxHumidity=None, maxWindSpeed=None):
+        self.maxHumidity = maxHumidity
+        self.maxWindSpeed = maxWindSpeed
+
+    def evaluate(self, context, rows):
+        bad = False
+        if self.maxHumidity is not None:
+            humidity = readingValue(context.reading('humidity'))
+            if humidity is not None and humidity > self.maxHumidity:
+                log.debug('Humidity higher than specified... %.2f > %.2f' % (humidity, self.maxHumidity))
+                bad = True
+        if not bad and self.maxWindSpeed is not None:
+            windSpeed = readingValue(context.reading('windspeed'))
+            if windSpeed is not None and windSpeed > self.maxWindSpeed:
+                log.debug('Wind speed higher than specified... %.2f > %.2f' % (windSpeed, self.maxWindSpeed))
+                bad = True
+        return np.zeros((len(rows), len(context.times)), dtype=bool) | bad
+
+
+class ConstraintPipeline(object):
+    '''
+    Ordered set of constraints. Static constraints are evaluated on all programs, then live constraints only on the
+    programs that can still be observed at some of the times.
+    '''
+
+    def __init__(self, constraints=None):
+        self._constraints = []
+        for constraint in (constraints or []):
+            self.add(constraint)
+
+    @staticmethod
+    def default(maxHumidity=None, maxWindSpeed=None):
+        return ConstraintPipeline([AirmassConstraint(),
+                                   MoonBrightnessConstraint(),
+                                   MoonDistanceConstraint(),
+                                   NightEndConstraint(),
+                                   SeeingConstraint(),
+                                   CloudConstraint(),
+                                   WeatherConstraint(maxHumidity, maxWindSpeed)])
+
+    def add(self, constraint):
+        self._constraints.append(constraint)
+        # stable sort: static before live, then cheapest first
+        self._constraints.sort(key=lambda c: (c.live, c.cost))
+
+    def remove(self, name):
+        self._constraints = [constraint for constraint in self._constraints if constraint.name != name]
+
+    @property
+    def constraints(self):
+        return list(self._constraints)
+
+    def evaluate(self, context):
+        '''
+        :param context: ConstraintContext.
+        :return: ok (programs x times boolean matrix), flags (programs x times matrix of CONDITION_* flags)
+        '''
+        flags = np.zeros(context.shape, dtype=np.int)
+        if len(context) == 0:
+            return flags == CONDITION_OK, flags
+
+        allRows = np.arange(len(context))
+        for constraint in self._constraints:
+            if constraint.live:
+                rows = np.where((flags == CONDITION_OK).any(axis=1))[0]
+                if len(rows) == 0:
+                    break
+            else:
+                rows = allRows
+
+            violated = constraint.evaluate(context, rows)
+            flags[rows] |= np.where(violated, constraint.flag, CONDITION_OK)
+
+        return flags == CONDITION_OK, flags
@@ -0,0 +1,337 @@
+'''
+Vectorized ephemeris for the scheduling algorithms. Instead of asking the site for the position of one target at one
+time (a remote call each), compute the local sidereal time of a whole time grid at once and the altitude of every
+target over that grid with numpy.
+'''
+
+import datetime
+
+import ephem
+import numpy as np
+
+from chimera.util.coord import Coord
+from chimera.util.position import Position
+
+# Difference between julian dates and ephem (Dublin julian) dates.
+EPHEM_JD_OFFSET = 2415020.0
+
+MOON_DTYPE = [('ra', np.float64),
+              ('dec', np.float64),
+              ('alt', np.float64),
+              ('brightness', np.float64)]
+
+
+class _UTC(datetime.tzinfo):
+
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return 'UTC'
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+UTC = _UTC()
+
+
+def _toRadians(value):
+    if hasattr(value, 'R'):
+        return float(value.R)
+    return float(Coord.fromDMS(str(value)).R)
+
+
+def airmass(altitude):
+    '''
+    Plane parallel airmass for altitudes given in degrees. Works on scalars and arrays. Objects bellow the horizon
+    get a negative airmass, the same convention used by the algorithms when checking targets.
+    '''
+    return 1./np.cos(np.pi/2.-np.asarray(altitude)*np.pi/180.)
+
+
+def angularSeparation(ra1, dec1, ra2, dec2):
+    '''
+    Angular separation (degrees) between two sets of positions given in radians. Inputs are broadcast against each
+    other.
+    '''
+    sdec = np.sin((dec2-dec1)/2.)
+    sra = np.sin((ra2-ra1)/2.)
+    hav = sdec*sdec + np.cos(dec1)*np.cos(dec2)*sra*sra
+    return np.degrees(2.*np.arcsin(np.sqrt(np.clip(hav, 0., 1.))))
+
+
+class EphemerisEngine(object):
+    '''
+    Compute local sidereal time and target altitudes for arrays of times and targets.
+
+    Times are julian dates (UT), coordinates are in radians and altitudes are returned in degrees.
+    '''
+
+    def __init__(self, latitude, longitude, elevation=0.):
+        '''
+        :param latitude: site latitude in radians.
+        :param longitude: site longitude in radians (east positive).
+        :param elevation: site elevation in meters.
+        '''
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self.elevation = float(elevation)
+        self._sinlat = np.sin(self.latitude)
+        self._coslat = np.cos(self.latitude)
+
+    @staticmethod
+    def fromSite(site):
+        '''
+        Build an engine from a Site (or Site proxy). Only the site coordinates are read, so this costs a couple of
+        calls and everything else is computed locally.
+        '''
+        if isinstance(site, EphemerisEngine):
+            return site
+        try:
+            elevation = float(site['altitude'])
+        except Exception:
+            elevation = 0.
+        return EphemerisEngine(_toRadians(site['latitude']),
+                               _toRadians(site['longitude']),
+                               elevation)
+
+    def observer(self):
+        '''
+        An ephem.Observer at the site, without atmospheric refraction.
+        '''
+        observer = ephem.Observer()
+        observer.lat = self.latitude
+        observer.lon = self.longitude
+        observer.elevation = self.elevation
+        observer.pressure = 0.
+        return observer
+
+    def lst(self, jd):
+        '''
+        Local mean sidereal time, in radians, for the julian dates (UT) in jd.
+        '''
+        jd = np.asarray(jd, dtype=np.float64)
+        d = jd - 2451545.0
+        t = d/36525.
+        gmst = 280.46061837 + 360.98564736629*d + 0.000387933*t*t - t*t*t/38710000.
+        return np.mod(np.radians(gmst)+self.longitude, 2.*np.pi)
+
+    def altitude(self, ra, dec, lst):
+        '''
+        Altitude (degrees) of targets at ra/dec for local sidereal time lst, all in radians. Inputs are broadcast
+        against each other.
+        '''
+        sinalt = np.sin(dec)*self._sinlat + np.cos(dec)*self._coslat*np.cos(lst-ra)
+        return np.degrees(np.arcsin(np.clip(sinalt, -1., 1.)))
+
+    def altitudeGrid(self, ra, dec, lst, offset=0.):
+        '''
+        Altitude matrix with one row per sidereal time and one column per target.
+
+        :param ra: targets right ascension (radians).
+        :param dec: targets declination (radians).
+        :param lst: local sidereal times (radians).
+        :param offset: hour angle offset (radians) added to each time. Either a scalar or one value per target.
+        :return: array with shape (len(lst), len(ra)).
+        '''
+        ra = np.asarray(ra, dtype=np.float64)[np.newaxis, :]
+        dec = np.asarray(dec, dtype=np.float64)[np.newaxis, :]
+        lst = np.asarray(lst, dtype=np.float64)[:, np.newaxis] + np.asarray(offset, dtype=np.float64)
+        return self.altitude(ra, dec, lst)
+
+
+class MoonEphemeris(object):
+    '''
+    Moon position and illuminated fraction tabulated on a time grid and interpolated for any time inside it. The
+    table is computed locally, so asking for the moon at each slot does not require calls to the site.
+    '''
+
+    def __init__(self, engine, times, ra, dec, fraction):
+        '''
+        :param engine: EphemerisEngine of the site.
+        :param times: julian dates of the table.
+        :param ra: moon apparent right ascension (radians).
+        :param dec: moon apparent declination (radians).
+        :param fraction: moon illuminated fraction (0-1).
+        '''
+        self.engine = engine
+        self.times = np.asarray(times, dtype=np.float64)
+        self.ra = np.unwrap(ra)
+        self.dec = np.asarray(dec, dtype=np.float64)
+        self.fraction = np.asarray(fraction, dtype=np.float64)
+
+    @staticmethod
+    def compute(engine, times):
+        '''
+        Compute the table at the given julian dates.
+        '''
+        times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+        observer = engine.observer()
+        moon = ephem.Moon()
+
+        ra = np.zeros(len(times))
+        dec = np.zeros(len(times))
+        fraction = np.zeros(len(times))
+
+        for i in range(len(times)):
+            observer.date = times[i]-EPHEM_JD_OFFSET
+            moon.compute(observer)
+            ra[i] = float(moon.ra)
+            dec[i] = float(moon.dec)
+            fraction[i] = moon.moon_phase
+
+        return MoonEphemeris(engine, times, ra, dec, fraction)
+
+    def at(self, times):
+        '''
+        Moon ra, dec (radians), altitude (degrees) and brightness (illuminated fraction in %) at the given julian
+        dates. Times outside the table are computed directly.
+        '''
+        times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+        moon = np.zeros(len(times), dtype=MOON_DTYPE)
+
+        moon['ra'] = np.interp(times, self.times, self.ra)
+        moon['dec'] = np.interp(times, self.times, self.dec)
+        moon['brightness'] = np.interp(times, self.times, self.fraction)
+
+        outside = np.bitwise_not((self.times[0] <= times) & (times <= self.times[-1]))
+        if outside.any():
+            table = MoonEphemeris.compute(self.engine, times[outside])
+            moon['ra'][outside] = table.ra
+            moon['dec'][outside] = table.dec
+            moon['brightness'][outside] = table.fraction
+
+        moon['ra'] = np.mod(moon['ra'], 2.*np.pi)
+        moon['alt'] = self.engine.altitude(moon['ra'], moon['dec'], self.engine.lst(times))
+        moon['brightness'] *= 100.
+
+        return moon
+
+
+class SiteEphemeris(EphemerisEngine):
+    '''
+    In-process replacement for the pure computations of a chimera Site, with the same method names (ut, JD, MJD,
+    LST, LST_inRads, raDecToAltAz, altAzToRaDec, sun and moon positions, rise, set and twilight times). It is built
+    from the site coordinates once, so the scheduler can use it instead of the Site proxy without a remote call each
+    time. Dates are UT; naive datetimes are taken as UT and returned datetimes are UT aware.
+    '''
+
+    def __init__(self, latitude, longitude, elevation=0., twilight_begin=-12., twilight_end=-18.):
+        '''
+        :param twilight_begin: sun altitude (degrees) at the start of evening twilight (end of morning twilight).
+        :param twilight_end: sun altitude (degrees) at the end of evening twilight (start of morning twilight).
+        '''
+        EphemerisEngine.__init__(self, latitude, longitude, elevation)
+        self.twilight_begin = twilight_begin
+        self.twilight_end = twilight_end
+
+    @staticmethod
+    def fromSite(site):
+        '''
+        Build from a Site (or Site proxy). A SiteEphemeris is returned as is.
+        '''
+        if isinstance(site, SiteEphemeris):
+            return site
+        engine = EphemerisEngine.fromSite(site)
+        return SiteEphemeris(engine.latitude, engine.longitude, engine.elevation)
+
+    def __getitem__(self, item):
+        if item == 'latitude':
+            return Coord.fromR(self.latitude)
+        elif item == 'longitude':
+            return Coord.fromR(self.longitude)
+        elif item == 'altitude':
+            return self.elevation
+        raise KeyError(item)
+
+    @staticmethod
+    def _toUT(date):
+        if date is None:
+            return datetime.datetime.utcnow()
+        elif isinstance(date, datetime.datetime):
+            if date.tzinfo is not None:
+                date = date.replace(tzinfo=None) - date.utcoffset()
+            return date
+        elif isinstance(date, datetime.date):
+            return datetime.datetime(date.year, date.month, date.day)
+        return date
+
+    def _getEphem(self, date=None, horizon=None):
+        observer = ephem.Observer()
+        observer.lat = self.latitude
+        observer.lon = self.longitude
+        observer.elevation = self.elevation
+        observer.date = SiteEphemeris._toUT(date)
+        if horizon is not None:
+            observer.horizon = str(horizon)
+        return observer
+
+    @staticmethod
+    def _datetime(date):
+        return date.datetime().replace(tzinfo=UTC)
+
+    def ut(self):
+        return datetime.datetime.utcnow().replace(tzinfo=UTC)
+
+    def JD(self, date=None):
+        return float(ephem.Date(SiteEphemeris._toUT(date))) + EPHEM_JD_OFFSET
+
+    def MJD(self, date=None):
+        return self.JD(date) - 2400000.5
+
+    def LST_inRads(self, date=None):
+        return float(self._getEphem(date).sidereal_time())
+
+    def LST(self, date=None):
+        return Coord.fromR(self.LST_inRads(date))
+
+    def raDecToAltAz(self, raDec, lst_inRads):
+        ra = float(raDec.ra.R)
+        dec = float(raDec.dec.R)
+        ha = float(lst_inRads) - ra
+
+        alt = np.arcsin(np.clip(np.sin(dec)*self._sinlat + np.cos(dec)*self._coslat*np.cos(ha), -1., 1.))
+        az = np.arctan2(-np.sin(ha)*np.cos(dec),
+                        np.sin(dec)*self._coslat - np.cos(dec)*self._sinlat*np.cos(ha))
+
+        return Position.fromAltAz(Coord.fromR(float(alt)), Coord.fromR(float(np.mod(az, 2.*np.pi))))
+
+    def altAzToRaDec(self, altAz, lst_inRads):
+        alt = float(altAz.alt.R)
+        az = float(altAz.az.R)
+
+        dec = np.arcsin(np.clip(np.sin(alt)*self._sinlat + np.cos(alt)*self._coslat*np.cos(az), -1., 1.))
+        ha = np.arctan2(-np.sin(az)*np.cos(alt),
+                        np.sin(alt)*self._coslat - np.cos(alt)*self._sinlat*np.cos(az))
+        ra = np.mod(float(lst_inRads) - ha, 2.*np.pi)
+
+        return Position.fromRaDec(Coord.fromR(float(ra)), Coord.fromR(float(dec)))
+
+    def sunrise(self, date=None):
+        return SiteEphemeris._datetime(self._getEphem(date).next_rising(ephem.Sun()))
+
+    def sunset(self, date=None):
+        return SiteEphemeris._datetime(self._getEphem(date).next_setting(ephem.Sun()))
+
+    def sunset_twilight_begin(self, date=None):
+        return SiteEphemeris._datetime(self._getEphem(date, self.twilight_begin).next_setting(ephem.Sun()))
+
+    def sunset_twilight_end(self, date=None):
+        return SiteEphemeris._datetime(self._getEphem(date, self.twilight_end).next_setting(ephem.Sun()))
+
+    def sunrise_twilight_begin(self, date=None):
+        return SiteEphemeris._datetime(self._getEphem(date, self.twilight_end).next_rising(ephem.Sun()))
+
+    def sunrise_twilight_end(self, date=None):
+        return SiteEphemeris._datetime(self._getEphem(date, self.twilight_begin).next_rising(ephem.Sun()))
+
+    def sunpos(self, date=None):
+        sun = ephem.Sun(self._getEphem(date))
+        return Position.fromAltAz(Coord.fromR(float(sun.alt)), Coord.fromR(float(sun.az)))
+
+    def moonpos(self, date=None):
+        moon = ephem.Moon(self._getEphem(date))
+        return Position.fromAltAz(Coord.fromR(float(moon.alt)), Coord.fromR(float(moon.az)))
+
+    def moonphase(self, date=None):
+        return ephem.Moon(self._getEphem(date)).moon_phase
@@ -0,0 +1,91 @@
+'''
+Long lived worker pool for the scheduler. A single executor is created for a whole queue build (see chimera-robobs
+makeQueue) and shared by all algorithms, instead of creating a new pool for every observing slot. Work is split in
+chunks of targets, so each task does a reasonable amount of numpy work.
+'''
+
+import logging
+import itertools
+
+from multiprocessing.pool import ThreadPool, Pool
+
+log = logging.getLogger(__name__)
+
+
+class ScheduleExecutor(object):
+    '''
+    Map functions over chunks of targets using a thread or process pool.
+
+    With pool_size <= 1 work is done serially in the calling thread and no pool is created. Functions used with a
+    process pool must be defined at module level so they can be pickled.
+    '''
+
+    THREAD = 'thread'
+    PROCESS = 'process'
+
+    def __init__(self, pool_size=1, pool_type=THREAD, chunk_size=4096):
+        self.pool_size = int(pool_size)
+        self.pool_type = pool_type
+        self.chunk_size = int(chunk_size)
+        self._pool = None
+
+        if pool_type not in (ScheduleExecutor.THREAD, ScheduleExecutor.PROCESS):
+            raise ValueError('Unknown pool type %s. Use "%s" or "%s".' % (pool_type,
+                                                                          ScheduleExecutor.THREAD,
+                                                                          ScheduleExecutor.PROCESS))
+
+    @staticmethod
+    def fromConfig(config):
+        '''
+        Create an executor from a project configuration dictionary. Recognized keys are pool_size, pool_type
+        ("thread" or "process") and chunk_size.
+        '''
+        config = config if config is not None else {}
+        return ScheduleExecutor(config.get('pool_size', 1),
+                                config.get('pool_type', ScheduleExecutor.THREAD),
+                                config.get('chunk_size', 4096))
+
+    def _getPool(self):
+        if self._pool is None:
+            log.debug('Starting %s pool with %i workers' % (self.pool_type, self.pool_size))
+            if self.pool_type == ScheduleExecutor.PROCESS:
+                self._pool = Pool(self.pool_size)
+            else:
+                self._pool = ThreadPool(self.pool_size)
+        return self._pool
+
+    def chunks(self, size):
+        '''
+        Split range(size) in (start, end) chunks.
+        '''
+        return [(i, min(i+self.chunk_size, size)) for i in range(0, size, self.chunk_size)]
+
+    def map(self, func, iterable):
+        '''
+        Apply func to each item of iterable and return the list of results, in order.
+        '''
+        if self.pool_size <= 1:
+            return map(func, iterable)
+        return self._getPool().map(func, iterable)
+
+    def imap(self, func, iterable):
+        '''
+        Same as map, but results are returned as an iterator as they are ready (still in order). Avoids keeping all
+        results in memory at once.
+        '''
+        if self.pool_size <= 1:
+            return itertools.imap(func, iterable)
+        return self._getPool().imap(func, iterable)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
@@ -1,9 +1,10 @@
 from chimera_supervisor.core.constants import DEFAULT_ROBOBS_DATABASE
+from chimera_supervisor.core.database import Database
 
 from sqlalchemy import (Column, String, Integer, DateTime, Boolean, ForeignKey,
-                        Float, PickleType, MetaData, Text, create_engine)
+                        Float, PickleType, MetaData, Text, Index, inspect)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relation, backref
+from sqlalchemy.orm import relation, backref
 from sqlalchemy.ext.hybrid import hybrid_property
 
 from chimera.controllers.scheduler.model import (Program as CProgram,
@@ -16,12 +17,9 @@ from chimera.util.position import Position
 
 import logging as log
 
-engine = create_engine('sqlite:///%s' % DEFAULT_ROBOBS_DATABASE, echo=False)
-# log.debug('-- engine created with sqlite:///%s' % DEFAULT_PROGRAM_DATABASE)
-metaData = MetaData()
-metaData.bind = engine
+DATABASE_URL = 'sqlite:///%s' % DEFAULT_ROBOBS_DATABASE
 
-Session = sessionmaker(bind=engine)
+metaData = MetaData()
 Base = declarative_base(metadata=metaData)
 
 import datetime as dt
@@ -78,6 +76,8 @@ class TimedDB(Base):
     finished = Column(Boolean, default=False)
     scheduled = Column(Boolean, default=False)
 
+    __table_args__ = (Index('ix_timeddb_pid_finished_execute_at', 'pid', 'finished', 'execute_at'),)
+
     def __init__(self, pid=None, execute_at = None):
         Base.__init__(self)
 
@@ -105,6 +105,8 @@ class RecurrentDB(Base):
     max_visits = Column(Integer,default=0) # 0 means unrestricted
     lastVisit = Column(DateTime, default = None)
 
+    __table_args__ = (Index('ix_recurrent_pid_blockid_tid', 'pid', 'blockid', 'tid'),)
+
     def __str__(self):
         return '[Recurrent:%s] visits: %i lastVisit: %s]' % (self.pid, self.visits, self.lastVisit)
 
@@ -125,6 +127,8 @@ class Targets(Base):
     magFilter = Column(String, default=None)
     link = Column(String, default=None)
 
+    __table_args__ = (Index('ix_targets_targetra', 'targetRa'),)
+
     def __str__(self):
         raDec = Position.fromRaDec(self.targetRa, self.targetDec, 'J2000')
 
@@ -164,6 +168,8 @@ class BlockPar(Base):
     schedalgorith = Column(Integer, default=0)  # scheduling algorith
     applyextcorr = Column(Boolean, default=False)
 
+    __table_args__ = (Index('ix_blockpar_pid_bid', 'pid', 'bid'),)
+
     def __str__(self):
         msg = "#[id: %4i][bid: %4i][PID: %10s][airmass: %5.2f][seeing: %5.2f][cloud: %2i][schedAlgorith: %2i]"
         return msg % (self.id, self.bid, self.pid, self.maxairmass, self.maxseeing,
@@ -185,6 +191,8 @@ class ObsBlock(Base):
     actions   = relation("Action", backref=backref("obsblock", order_by="Action.id"),
                          cascade="all, delete, delete-orphan")
 
+    __table_args__ = (Index('ix_obsblock_pid_scheduled_completed', 'pid', 'scheduled', 'completed'),)
+
     def __str__(self):
         if self.observed:
             return "#%i %s[%i] [lastObserved: %s%s%s]: with %i actions." % (self.blockid,
@@ -220,7 +228,6 @@ class Projects(Base):
 
 class Program(Base):
     __tablename__ = "program"
-    print "model.py"
 
     id = Column(Integer, primary_key=True)
     tid = Column(Integer, ForeignKey('targets.id'))
@@ -240,6 +247,9 @@ class Program(Base):
     obsblock_id = Column(Integer, ForeignKey("obsblock.id"))  # Block ID
     blockpar_id = Column(Integer, ForeignKey("blockpar.id"))  # BlockPar ID
 
+    __table_args__ = (Index('ix_program_priority_finished_slewat', 'priority', 'finished', 'slewAt'),
+                      Index('ix_program_finished_slewat', 'finished', 'slewAt'))
+
     # actions = relation("Action", backref=backref("program", order_by="Action.id"),
     #                    cascade="all, delete, delete-orphan")
 
@@ -458,6 +468,34 @@ class Expose(Action):
         return ca
 ###
 
-#metaData.drop_all(engine)
-metaData.create_all(engine)
+def createIndexes(engine):
+    '''
+    Create the indexes of the model missing in the database and update the statistics used to choose them.
+    '''
+    inspector = inspect(engine)
+    for table in metaData.sorted_tables:
+        existing = [index['name'] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing:
+                log.info('Creating index %s on %s' % (index.name, table.name))
+                index.create(engine)
+    engine.execute('ANALYZE')
+
+# Changes to the schema of existing databases. Migration i takes a database from version i to i+1, the version is
+# stored in the database user_version. Append new migrations at the end, never change the order.
+MIGRATIONS = [createIndexes]
+
+def upgradeSchema(engine):
+    '''
+    Apply the migrations the database has not gone through yet.
+    '''
+    version = engine.execute('PRAGMA user_version').scalar()
+    for i in range(version, len(MIGRATIONS)):
+        log.info('Upgrading %s schema to version %i' % (engine.url, i+1))
+        MIGRATIONS[i](engine)
+        engine.execute('PRAGMA user_version=%i' % (i+1))
+
+# Created, and its schema upgraded, when the first session is opened
+database = Database(DATABASE_URL, metaData, 'CHIMERA_ROBOBS_DATABASE', init=upgradeSchema)
+Session = database.Session
 
@@ -0,0 +1,135 @@
+'''
+In-memory index of the programs waiting in the robotic observatory queue. Unfinished programs are loaded with their
+BlockPar, ObsBlock and Targets in a single query and grouped by priority and scheduling algorithm, so selecting the
+next program does not go to the database for every priority level.
+'''
+
+import logging
+import threading
+
+from sqlalchemy import func
+
+from chimera_supervisor.controllers.scheduler.model import Session, Program, BlockPar, ObsBlock, Targets, Expose
+
+log = logging.getLogger(__name__)
+
+# Maximum number of ids in a single "IN" clause (sqlite limits the number of variables of a statement).
+_MAX_IN = 500
+
+
+class PendingPrograms(object):
+    '''
+    Unfinished programs, as (Program, BlockPar, ObsBlock, Targets) tuples, grouped by priority and algorithm and
+    sorted by slew time.
+
+    The index is reloaded by refresh() when it was invalidated or when the queue in the database changed (number of
+    unfinished programs or largest program id). Changes made by the algorithms to the loaded objects (e.g. slewAt)
+    are written with commit().
+    '''
+
+    def __init__(self):
+        self.session = None
+        self._signature = None
+        self._programs = {}
+        self._byId = {}
+        self._duration = {}
+        self._lock = threading.RLock()
+
+    def invalidate(self):
+        '''
+        Force a reload on the next refresh. Call whenever a program is finished or the queue is changed.
+        '''
+        with self._lock:
+            self._signature = None
+
+    def refresh(self):
+        '''
+        Reload the index if the queue changed since it was loaded.
+        '''
+        with self._lock:
+            session = Session()
+            try:
+                signature = tuple(session.query(func.count(Program.id),
+                                                func.max(Program.id)).filter(Program.finished == False).one())
+            finally:
+                session.commit()
+
+            if signature != self._signature:
+                self._load()
+                self._signature = signature
+
+    def _load(self):
+        if self.session is not None:
+            self.session.commit()
+            self.session.close()
+
+        # Objects are kept after commit, so they can be used without reloading them one by one
+        self.session = Session(expire_on_commit=False)
+
+        rows = self.session.query(Program,
+                                  BlockPar,
+                                  ObsBlock,
+                                  Targets).join(
+            BlockPar, Program.blockpar_id == BlockPar.id).join(
+            ObsBlock, Program.obsblock_id == ObsBlock.id).join(
+            Targets, Program.tid == Targets.id).filter(Program.finished == False).order_by(Program.slewAt).all()
+
+        self._programs = {}
+        self._byId = {}
+        for row in rows:
+            self._programs.setdefault(row[0].priority, {}).setdefault(row[1].schedalgorith, []).append(row)
+            self._byId[row[0].id] = row
+
+        # Exposure time of each block
+        self._duration = {}
+        ids = list(set([row[2].id for row in rows]))
+        for i in range(0, len(ids), _MAX_IN):
+            for block_id, exptime, frames in self.session.query(Expose.block_id,
+                                                                Expose.exptime,
+                                                                Expose.frames).filter(
+                    Expose.block_id.in_(ids[i:i+_MAX_IN])):
+                self._duration[block_id] = self._duration.get(block_id, 0.) + exptime*frames
+
+        self.session.commit()
+        log.debug('Loaded %i pending programs in %i priorities.' % (len(rows), len(self._programs)))
+
+    def signature(self):
+        '''
+        Number of unfinished programs and largest program id when the index was last refreshed. Selections made with
+        the same signature were made on the same queue.
+        '''
+        with self._lock:
+            return self._signature
+
+    def priorities(self):
+        '''
+        Priorities with pending programs, sorted.
+        '''
+        with self._lock:
+            return sorted(self._programs.keys())
+
+    def byAlgorithm(self, priority):
+        '''
+        List of (algorithm id, programs) for the given priority, sorted by algorithm id.
+        '''
+        with self._lock:
+            programs = self._programs.get(priority, {})
+            return [(sAL, list(programs[sAL])) for sAL in sorted(programs.keys())]
+
+    def find(self, id):
+        '''
+        Pending program with the given Program id, or None if it is not pending anymore.
+        '''
+        with self._lock:
+            return self._byId.get(id)
+
+    def duration(self, program):
+        '''
+        Total exposure time (seconds) of a program.
+        '''
+        return self._duration.get(program[2].id, 0.)
+
+    def commit(self):
+        with self._lock:
+            if self.session is not None:
+                self.session.commit()
@@ -0,0 +1,128 @@
+'''
+Batched writer for the observing queue. Programs selected for a night, the algorithm specific records of the
+selected blocks and the "scheduled" flag of the blocks are collected and written in a single transaction.
+'''
+
+import logging
+
+from chimera_supervisor.controllers.scheduler.model import Projects, ObsBlock, Program
+
+log = logging.getLogger(__name__)
+
+# Maximum number of ids in a single "IN" clause (sqlite limits the number of variables of a statement).
+_MAX_IN = 500
+
+
+class QueueWriter(object):
+    '''
+    Collect the blocks allocated by the scheduling algorithms and write them to the queue at once with flush().
+
+    :param session: database session used for all reads and writes. Only flush() commits it.
+    '''
+
+    def __init__(self, session):
+        self.session = session
+        self.programs = []
+        self.records = []
+        self.blocks = {}
+        self._algorithms = []
+        self._scheduled = set()
+        self._priority = {}
+
+    def __len__(self):
+        return len(self.programs)
+
+    def priority(self, pid):
+        if pid not in self._priority:
+            project = self.session.query(Projects.priority).filter(Projects.pid == pid).first()
+            self._priority[pid] = project[0] if project is not None else 0
+        return self._priority[pid]
+
+    def addBlock(self, rows, obstime, algorithm):
+        '''
+        Add one allocated block to the queue.
+
+        :param rows: (ObsBlock, BlockPar, Targets) rows of the block (one per target).
+        :param obstime: julian date of the observation.
+        :param algorithm: scheduling algorithm class that allocated the block.
+        '''
+        for subblock in rows:
+            self.programs.append({'tid': subblock[0].objid,
+                                  'name': subblock[2].name,
+                                  'pi': '',
+                                  'priority': self.priority(subblock[0].pid),
+                                  'slewAt': obstime-2400000.5,
+                                  'pid': subblock[0].pid,
+                                  'obsblock_id': subblock[0].id,
+                                  'blockpar_id': subblock[1].id})
+            self._scheduled.add(subblock[0].id)
+
+            if algorithm not in self.blocks:
+                self._algorithms.append(algorithm)
+                self.blocks[algorithm] = []
+            self.blocks[algorithm].append(subblock)
+
+    def addSlots(self, query, slots, algorithm):
+        '''
+        Add the blocks allocated to the observing slots returned by an algorithm. Rows of all the blocks are read
+        from query at once.
+
+        :param query: (ObsBlock, BlockPar, Targets) query given to the algorithm.
+        :param slots: slots returned by the algorithm process (with start and blockid).
+        :param algorithm: scheduling algorithm class.
+        :return: list of (obstime, rows) added.
+        '''
+        blockids = sorted(set([int(slot['blockid']) for slot in slots if slot['blockid'] > 0]))
+
+        rows = {}
+        for i in range(0, len(blockids), _MAX_IN):
+            for row in query.filter(ObsBlock.blockid.in_(blockids[i:i+_MAX_IN])):
+                rows.setdefault(row[0].blockid, []).append(row)
+
+        added = []
+        for slot in slots:
+            if slot['blockid'] > 0 and slot['blockid'] in rows:
+                self.addBlock(rows[slot['blockid']], slot['start'], algorithm)
+                added.append((slot['start'], rows[slot['blockid']]))
+        return added
+
+    def add(self, record):
+        '''
+        Add an algorithm specific record (e.g. TimedDB) to be written with the queue.
+        '''
+        self.records.append(record)
+
+    def flush(self):
+        '''
+        Write everything collected so far in a single transaction.
+
+        :return: number of programs written.
+        '''
+        nprograms = len(self.programs)
+        try:
+            self.session.bulk_insert_mappings(Program, self.programs)
+
+            for algorithm in self._algorithms:
+                algorithm.addBlocks(self.session, self.blocks[algorithm])
+
+            self.session.add_all(self.records)
+
+            scheduled = list(self._scheduled)
+            for i in range(0, len(scheduled), _MAX_IN):
+                self.session.query(ObsBlock).filter(ObsBlock.id.in_(scheduled[i:i+_MAX_IN])).update(
+                    {ObsBlock.scheduled: True}, synchronize_session='fetch')
+
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+        log.debug('Wrote %i programs to the queue.' % nprograms)
+
+        self.programs = []
+        self.records = []
+        self.blocks = {}
+        self._algorithms = []
+        self._scheduled = set()
+
+        return nprograms
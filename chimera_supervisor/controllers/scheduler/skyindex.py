@@ -0,0 +1,109 @@
+'''
+Spatial index over a set of sky positions, used to find the targets close to the moon without computing the distance
+to every target of the catalog.
+'''
+
+import numpy as np
+
+# Default size (degrees) of the cells of the index.
+CELL_SIZE = 2.
+
+
+def _unitVector(ra, dec):
+    cosdec = np.cos(dec)
+    return np.array([cosdec*np.cos(ra), cosdec*np.sin(ra), np.sin(dec)]).T
+
+
+class SkyIndex(object):
+    '''
+    Positions bucketed on an (almost) equal-area grid: the sky is split in declination zones of cellSize degrees and
+    each zone in as many right ascension cells as needed for them to be at most cellSize wide. Positions are stored
+    as unit vectors, sorted by cell, so the positions of consecutive cells of a zone are contiguous. A cone search
+    only looks at the cells that can be inside the cone and checks those positions exactly.
+
+    Coordinates are in radians, distances in degrees.
+    '''
+
+    def __init__(self, ra, dec, cellSize=CELL_SIZE):
+        ra = np.mod(np.asarray(ra, dtype=np.float64), 2.*np.pi)
+        dec = np.asarray(dec, dtype=np.float64)
+
+        self.height = np.radians(cellSize)
+        self.nzones = int(np.ceil(np.pi/self.height))
+
+        # cells of each zone, sized at the zone edge closest to the equator
+        edges = -np.pi/2.+np.arange(self.nzones+1)*self.height
+        maxcos = np.where((edges[:-1] < 0.) & (edges[1:] > 0.), 1.,
+                          np.maximum(np.cos(edges[:-1]), np.cos(np.minimum(edges[1:], np.pi/2.))))
+        self.ncells = np.maximum(1, np.ceil(2.*np.pi*maxcos/self.height)).astype(np.int)
+        self.offset = np.concatenate(([0], np.cumsum(self.ncells)))
+
+        cell = self._cell(self._zone(dec), ra)
+        self.order = np.argsort(cell, kind='mergesort')
+        self.xyz = _unitVector(ra[self.order], dec[self.order])
+        # positions of cell i are order[start[i]:start[i+1]]
+        self.start = np.searchsorted(cell[self.order], np.arange(self.offset[-1]+1), side='left')
+
+    def __len__(self):
+        return len(self.order)
+
+    def _zone(self, dec):
+        return np.clip(np.floor((dec+np.pi/2.)/self.height).astype(np.int), 0, self.nzones-1)
+
+    def _cell(self, zone, ra):
+        ncells = self.ncells[zone]
+        return self.offset[zone]+np.minimum(np.floor(ra/(2.*np.pi)*ncells).astype(np.int), ncells-1)
+
+    def _candidates(self, ra, dec, radius):
+        # slices of the sorted positions in the cells that can be inside the cone
+        if abs(dec)+radius >= np.pi/2.:
+            halfwidth = np.pi
+        else:
+            halfwidth = np.arcsin(min(1., np.sin(radius)/np.cos(dec)))+1e-9
+
+        ra = np.mod(ra, 2.*np.pi)
+        slices = []
+        for zone in range(self._zone(dec-radius), self._zone(dec+radius)+1):
+            ncells = self.ncells[zone]
+            first = self.offset[zone]
+            if halfwidth >= np.pi or ncells == 1:
+                slices.append((self.start[first], self.start[first+ncells]))
+                continue
+
+            lo = int(np.floor((ra-halfwidth)/(2.*np.pi)*ncells))
+            hi = int(np.floor((ra+halfwidth)/(2.*np.pi)*ncells))
+            if hi-lo+1 >= ncells:
+                slices.append((self.start[first], self.start[first+ncells]))
+            elif lo < 0:
+                slices.append((self.start[first+lo+ncells], self.start[first+ncells]))
+                slices.append((self.start[first], self.start[first+hi+1]))
+            elif hi >= ncells:
+                slices.append((self.start[first+lo], self.start[first+ncells]))
+                slices.append((self.start[first], self.start[first+hi-ncells+1]))
+            else:
+                slices.append((self.start[first+lo], self.start[first+hi+1]))
+
+        slices = [(i, j) for i, j in slices if j > i]
+        if len(slices) == 0:
+            return np.zeros(0, dtype=np.int)
+        return np.concatenate([np.arange(i, j) for i, j in slices])
+
+    def query(self, ra, dec, radius):
+        '''
+        Positions within radius of (ra, dec).
+
+        :param ra: right ascension of the center (radians).
+        :param dec: declination of the center (radians).
+        :param radius: radius of the cone (degrees).
+        :return: indexes (in the arrays given to the constructor) and distance (degrees) to the center.
+        '''
+        radius = np.radians(radius)
+        if radius < 0.:
+            return np.zeros(0, dtype=np.int), np.zeros(0)
+
+        candidates = self._candidates(ra, dec, radius)
+
+        cosdist = np.dot(self.xyz[candidates], _unitVector(ra, dec))
+        inside = cosdist >= np.cos(radius)
+
+        return self.order[candidates[inside]], np.degrees(np.arccos(np.clip(cosdist[inside], -1., 1.)))
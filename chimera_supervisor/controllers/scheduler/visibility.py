@@ -0,0 +1,368 @@
+'''
+Nightly visibility cube. Altitude and moon separation of every target in the Targets table, together with the moon
+altitude and brightness, are computed once on a fixed time grid covering a whole night (local noon to local noon) and
+stored as memory-mapped numpy files. The files are keyed by site, night and a hash of the target catalog, so queue
+builds, reschedules and simulations for the same night only read from it. Only the last few cubes used are kept. Cubes already in memory are found from a
+cheap catalog signature, without reading the catalog.
+'''
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+from sqlalchemy import func
+
+from chimera_supervisor.core.constants import DEFAULT_VISIBILITY_CACHE
+from chimera_supervisor.controllers.scheduler.model import Targets, Session
+from chimera_supervisor.controllers.scheduler.ephemeris import (EphemerisEngine, MoonEphemeris,
+                                                                airmass, angularSeparation)
+from chimera_supervisor.controllers.scheduler.executor import ScheduleExecutor
+
+from chimera.core.exceptions import ChimeraException
+
+log = logging.getLogger(__name__)
+
+# Number of targets computed at a time when building a cube, if no executor is given. Bounds memory usage for
+# large catalogs.
+CHUNK_SIZE = 4096
+
+_catalogDtype = [('tid', np.int64),
+                 ('ra', np.float64),
+                 ('dec', np.float64)]
+
+_moonDtype = [('ra', np.float64),
+              ('dec', np.float64),
+              ('fraction', np.float64)]
+
+# Changes whenever the content of the cache files change, so old caches are not used.
+CACHE_VERSION = 2
+
+# Number of cubes kept in the cache directory, the least recently used ones are removed when a new one is stored.
+CACHE_KEEP = 7
+
+# Time (s) after which an unfinished cube (left by a process that died while storing it) is removed.
+CACHE_TMP_AGE = 86400.
+
+# Cubes already loaded by this process, keyed as in the cache directory.
+_loaded = {}
+
+# Cache key of the loaded cubes by site, night, step and catalog signature, so a loaded cube is found without reading
+# the whole catalog.
+_signatures = {}
+
+
+class VisibilityCubeException(ChimeraException):
+    pass
+
+
+def _computeChunk(task):
+    # Altitude and moon separation for a chunk of targets. Module level so it can run on a process pool.
+    latitude, longitude, ra, dec, lst, moonRa, moonDec = task
+    engine = EphemerisEngine(latitude, longitude)
+    return (engine.altitudeGrid(ra, dec, lst).astype(np.float32),
+            angularSeparation(ra[np.newaxis, :], dec[np.newaxis, :],
+                              moonRa[:, np.newaxis], moonDec[:, np.newaxis]).astype(np.float32))
+
+
+class VisibilityCube(object):
+    '''
+    Altitude, airmass, moon separation and moon brightness on a time grid for a catalog of targets.
+
+    Times are julian dates. Values for times between grid points are linearly interpolated. Times outside the grid
+    are computed directly.
+    '''
+
+    def __init__(self, engine, times, catalog, altitude, moonSeparation, moon):
+        self.engine = engine
+        self.times = times
+        self.step = float(times[1]-times[0])
+        self.catalog = catalog
+        self.tid = catalog['tid']
+        self.ra = catalog['ra']
+        self.dec = catalog['dec']
+        self._altitude = altitude
+        self._moonSeparation = moonSeparation
+        self._moon = MoonEphemeris(engine, times, moon['ra'], moon['dec'], moon['fraction'])
+
+        self._index = dict([(tid, i) for i, tid in enumerate(self.tid)])
+
+    @staticmethod
+    def nightStart(engine, jd):
+        '''
+        Julian date of the local (mean) noon preceding jd.
+        '''
+        lon = engine.longitude/2./np.pi
+        return np.floor(jd+lon)-lon
+
+    @staticmethod
+    def forNight(site, jd, step=300., cacheDir=DEFAULT_VISIBILITY_CACHE, session=None, executor=None):
+        '''
+        Return the visibility cube for the night containing jd. The cube is loaded from memory or from the cache
+        directory if it was already computed for this site, night and target catalog. Otherwise it is computed and
+        stored.
+
+        :param site: Site (or Site proxy).
+        :param jd: julian date inside the night.
+        :param step: grid step in seconds.
+        :param cacheDir: where to store the cube. If None, cube is not stored.
+        :param session: database session used to read the target catalog.
+        :param executor: ScheduleExecutor used to compute the cube, if needed.
+        :return: VisibilityCube
+        '''
+        engine = EphemerisEngine.fromSite(site)
+        start = VisibilityCube.nightStart(engine, jd)
+
+        night = '%i:%.8f:%.8f:%.2f:%.8f:%.3f:' % (CACHE_VERSION, engine.latitude, engine.longitude,
+                                                  engine.elevation, start, step)
+        signature = (night, VisibilityCube.catalogSignature(session))
+        # another thread (e.g. the robobs lookahead) may be replacing the loaded cube
+        cube = _loaded.get(_signatures.get(signature))
+        if cube is not None:
+            return cube
+
+        catalog = VisibilityCube.readCatalog(session)
+
+        key = hashlib.sha1(night)
+        key.update(catalog.tostring())
+        key = key.hexdigest()
+
+        cube = _loaded.get(key)
+        if cube is not None:
+            _signatures.clear()
+            _signatures[signature] = key
+            return cube
+
+        cube = None
+        path = os.path.join(cacheDir, key) if cacheDir is not None else None
+
+        if path is not None and os.path.isdir(path):
+            try:
+                cube = VisibilityCube.load(path, engine)
+                log.debug('Visibility cube loaded from %s' % path)
+            except Exception, e:
+                log.warning('Could not load visibility cube from %s. Recomputing.' % path)
+                log.exception(e)
+                cube = None
+            else:
+                try:
+                    # mark it as recently used (see evict)
+                    os.utime(path, None)
+                except OSError:
+                    pass
+
+        if cube is None:
+            nstep = int(np.ceil(86400./step))
+            times = start+np.arange(nstep+1)*step/86400.
+            cube = VisibilityCube.compute(engine, times, catalog, path, executor)
+            if path is not None:
+                VisibilityCube.evict(cacheDir, keep=[key])
+
+        _loaded.clear()
+        _loaded[key] = cube
+        _signatures.clear()
+        _signatures[signature] = key
+        return cube
+
+    @staticmethod
+    def evict(cacheDir, nkeep=CACHE_KEEP, keep=None):
+        '''
+        Remove all but the nkeep most recently used cubes (and unfinished cubes older than CACHE_TMP_AGE) from the
+        cache directory. Cubes listed in keep are never removed.
+        '''
+        keep = set(keep or [])
+        try:
+            names = os.listdir(cacheDir)
+        except OSError:
+            return
+
+        now = time.time()
+        cubes = []
+        for name in names:
+            path = os.path.join(cacheDir, name)
+            try:
+                if not os.path.isdir(path):
+                    continue
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if name.endswith('.tmp'):
+                if now-mtime > CACHE_TMP_AGE:
+                    shutil.rmtree(path, ignore_errors=True)
+            elif name not in keep:
+                cubes.append((mtime, path))
+
+        cubes.sort(reverse=True)
+        for mtime, path in cubes[max(0, nkeep-len(keep)):]:
+            log.debug('Removing visibility cube %s' % path)
+            shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def catalogSignature(session=None):
+        '''
+        Cheap summary of the target catalog (number of targets, largest id and sum of coordinates), computed by the
+        database. Changes whenever targets are added, removed or moved.
+        '''
+        _session = Session() if session is None else session
+        signature = tuple(_session.query(func.count(Targets.id), func.max(Targets.id),
+                                         func.sum(Targets.targetRa), func.sum(Targets.targetDec)).one())
+        if session is None:
+            _session.commit()
+        return signature
+
+    @staticmethod
+    def readCatalog(session=None):
+        '''
+        Read id and coordinates (in radians) of all targets in the database.
+        '''
+        _session = Session() if session is None else session
+        rows = _session.query(Targets.id, Targets.targetRa, Targets.targetDec).order_by(Targets.id).all()
+        if session is None:
+            _session.commit()
+
+        catalog = np.zeros(len(rows), dtype=_catalogDtype)
+        if len(rows) > 0:
+            data = np.array(rows, dtype=np.float64)
+            catalog['tid'] = data[:, 0]
+            catalog['ra'] = data[:, 1]*np.pi/12.
+            catalog['dec'] = data[:, 2]*np.pi/180.
+        return catalog
+
+    @staticmethod
+    def compute(engine, times, catalog, path=None, executor=None):
+        '''
+        Compute a cube on the time grid and, if path is given, store it there. Targets are split in chunks that are
+        computed by the executor workers.
+        '''
+        if executor is None:
+            executor = ScheduleExecutor(chunk_size=CHUNK_SIZE)
+
+        log.debug('Computing visibility cube: %i times x %i targets' % (len(times), len(catalog)))
+
+        lst = engine.lst(times)
+        table = MoonEphemeris.compute(engine, times)
+        moon = np.zeros(len(times), dtype=_moonDtype)
+        moon['ra'] = table.ra
+        moon['dec'] = table.dec
+        moon['fraction'] = table.fraction
+
+        tmppath = None
+        if path is not None and len(catalog) > 0:
+            tmppath = '%s.%i.tmp' % (path, os.getpid())
+            try:
+                if not os.path.isdir(tmppath):
+                    os.makedirs(tmppath)
+                altitude = np.lib.format.open_memmap(os.path.join(tmppath, 'altitude.npy'), mode='w+',
+                                                     dtype=np.float32, shape=(len(times), len(catalog)))
+                moonSeparation = np.lib.format.open_memmap(os.path.join(tmppath, 'moonsep.npy'), mode='w+',
+                                                           dtype=np.float32, shape=(len(times), len(catalog)))
+            except Exception, e:
+                log.warning('Could not create visibility cache at %s. Keeping it in memory.' % tmppath)
+                log.exception(e)
+                tmppath = None
+
+        if tmppath is None:
+            altitude = np.zeros((len(times), len(catalog)), dtype=np.float32)
+            moonSeparation = np.zeros((len(times), len(catalog)), dtype=np.float32)
+
+        chunks = executor.chunks(len(catalog))
+        tasks = [(engine.latitude, engine.longitude, catalog['ra'][i:j], catalog['dec'][i:j], lst,
+                  moon['ra'], moon['dec']) for i, j in chunks]
+
+        for (i, j), (chunkAltitude, chunkSeparation) in zip(chunks, executor.imap(_computeChunk, tasks)):
+            altitude[:, i:j] = chunkAltitude
+            moonSeparation[:, i:j] = chunkSeparation
+
+        if tmppath is not None:
+            try:
+                altitude.flush()
+                moonSeparation.flush()
+                np.save(os.path.join(tmppath, 'times.npy'), times)
+                np.save(os.path.join(tmppath, 'catalog.npy'), catalog)
+                np.save(os.path.join(tmppath, 'moon.npy'), moon)
+                os.rename(tmppath, path)
+                log.debug('Visibility cube stored at %s' % path)
+                return VisibilityCube.load(path, engine)
+            except Exception, e:
+                log.warning('Could not store visibility cube at %s.' % path)
+                log.exception(e)
+                shutil.rmtree(tmppath, ignore_errors=True)
+
+        return VisibilityCube(engine, times, catalog, altitude, moonSeparation, moon)
+
+    @staticmethod
+    def load(path, engine):
+        return VisibilityCube(engine,
+                              np.load(os.path.join(path, 'times.npy')),
+                              np.load(os.path.join(path, 'catalog.npy')),
+                              np.load(os.path.join(path, 'altitude.npy'), mmap_mode='r'),
+                              np.load(os.path.join(path, 'moonsep.npy'), mmap_mode='r'),
+                              np.load(os.path.join(path, 'moon.npy')))
+
+    def contains(self, time):
+        return np.all((self.times[0] <= np.asarray(time)) & (np.asarray(time) <= self.times[-1]))
+
+    def hasTarget(self, tid):
+        return tid in self._index
+
+    def columns(self, tids):
+        '''
+        Column index of each target id.
+        '''
+        try:
+            return np.array([self._index[tid] for tid in tids], dtype=np.int)
+        except KeyError, e:
+            raise VisibilityCubeException('Target %s not in visibility cube.' % e)
+
+    def _interpolate(self, data, times, cols, offset=0.):
+        time = np.asarray(times, dtype=np.float64)[:, np.newaxis] + np.asarray(offset, dtype=np.float64)
+        time, cols = np.broadcast_arrays(time, np.asarray(cols)[np.newaxis, :])
+
+        f = (time-self.times[0])/self.step
+        inside = (f >= 0.) & (f <= len(self.times)-1)
+        i0 = np.clip(np.floor(f).astype(np.int), 0, len(self.times)-2)
+        w = f-i0
+
+        value = data[i0, cols]*(1.-w) + data[i0+1, cols]*w
+        return value, inside, time, cols
+
+    def altitude(self, times, cols, offset=0.):
+        '''
+        Altitude (degrees) matrix with one row per time and one column per target.
+
+        :param times: julian dates.
+        :param cols: target columns (see columns()).
+        :param offset: time offset (days), either a scalar or one value per target.
+        '''
+        value, inside, time, cols = self._interpolate(self._altitude, times, cols, offset)
+        if not inside.all():
+            outside = np.bitwise_not(inside)
+            value[outside] = self.engine.altitude(self.ra[cols[outside]],
+                                                  self.dec[cols[outside]],
+                                                  self.engine.lst(time[outside]))
+        return value
+
+    def airmass(self, times, cols, offset=0.):
+        return airmass(self.altitude(times, cols, offset))
+
+    def moonSeparation(self, times, cols):
+        '''
+        Moon separation (degrees) matrix with one row per time and one column per target.
+        '''
+        value, inside, time, cols = self._interpolate(self._moonSeparation, times, cols)
+        if not inside.all():
+            outside = np.bitwise_not(inside)
+            moon = self.moon(time[outside])
+            value[outside] = angularSeparation(self.ra[cols[outside]],
+                                               self.dec[cols[outside]],
+                                               moon['ra'],
+                                               moon['dec'])
+        return value
+
+    def moon(self, times):
+        '''
+        Moon ra, dec (radians), altitude (degrees) and brightness (%) at the given julian dates.
+        '''
+        return self._moon.at(times)
@@ -0,0 +1,312 @@
+'''
+Operation flags and lock keys of the instruments. The store is kept in memory and is the reference for the supervisor,
+so reading flags and keys never touches the database. Changes are appended to a journal file, synced to disk in
+batches, and written to the status database from time to time (checkpoint), after which the journal is emptied. If the
+supervisor dies before a checkpoint, the journal is replayed on the database when the store is loaded again.
+'''
+
+import os
+import json
+import time
+import datetime
+import threading
+import logging
+from collections import OrderedDict
+
+from chimera_supervisor.controllers.iostatus_model import ScopedSession, InstrumentOperationStatus, KeyList
+from chimera_supervisor.controllers.status import InstrumentOperationFlag
+
+log = logging.getLogger(__name__)
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _timeToStr(t):
+    return None if t is None else t.strftime(TIME_FORMAT)
+
+
+def _strToTime(s):
+    return None if s is None else datetime.datetime.strptime(s, TIME_FORMAT)
+
+
+class InstrumentState(object):
+    '''
+    Flag and lock keys of an instrument. keys maps each key to (active, updatetime).
+    '''
+
+    def __init__(self, status, lastUpdate=None, lastChange=None, keys=None):
+        self.status = status
+        self.lastUpdate = lastUpdate
+        self.lastChange = lastChange
+        self.keys = dict(keys or {})
+
+    def activeKeys(self):
+        return [key for key, (active, updatetime) in self.keys.items() if active]
+
+    def toJson(self, instrument):
+        return json.dumps({'instrument': instrument,
+                           'status': self.status,
+                           'lastUpdate': _timeToStr(self.lastUpdate),
+                           'lastChange': _timeToStr(self.lastChange),
+                           'keys': [[key, active, _timeToStr(updatetime)]
+                                    for key, (active, updatetime) in self.keys.items()]})
+
+    @staticmethod
+    def fromJson(line):
+        entry = json.loads(line)
+        return entry['instrument'], InstrumentState(entry['status'],
+                                                    _strToTime(entry['lastUpdate']),
+                                                    _strToTime(entry['lastChange']),
+                                                    dict([(key, (active, _strToTime(updatetime)))
+                                                          for key, active, updatetime in entry['keys']]))
+
+    def copy(self):
+        return InstrumentState(self.status, self.lastUpdate, self.lastChange, self.keys)
+
+
+class StatusStore(object):
+    '''
+    In memory instrument flags and lock keys with write-behind persistence.
+
+    :param journal: path of the journal file, None to only write at checkpoints.
+    :param syncInterval: time (s) changes are gathered before being synced to the journal.
+    :param checkpointInterval: time (s) between writes of the changes to the database.
+    :param session: sessionmaker of the status database.
+    '''
+
+    def __init__(self, journal=None, syncInterval=1., checkpointInterval=60., session=ScopedSession):
+        self.journal = journal
+        self.syncInterval = syncInterval
+        self.checkpointInterval = checkpointInterval
+        self._session = session
+
+        self._states = {}
+        self._pending = {}
+        self._lines = []
+        self._lock = threading.RLock()
+        self._writeLock = threading.Lock()
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._writer = None
+
+    def load(self, instruments):
+        '''
+        Read flags and keys from the database, replay the journal left by a previous run and add the instruments not
+        in the database yet with flag UNSET.
+
+        :return: dictionary with the flag (InstrumentOperationFlag) of each instrument.
+        '''
+        with self._lock:
+            session = self._session()
+            try:
+                for iostatus in session.query(InstrumentOperationStatus):
+                    self._states[iostatus.instrument] = InstrumentState(iostatus.status,
+                                                                        iostatus.lastUpdate,
+                                                                        iostatus.lastChange,
+                                                                        dict([(k.key, (k.active, k.updatetime))
+                                                                              for k in iostatus.keylist]))
+            finally:
+                session.close()
+
+            for instrument, state in self._readJournal():
+                self._states[instrument] = state
+                self._pending[instrument] = state.copy()
+
+            now = datetime.datetime.utcnow()
+            for instrument in instruments:
+                if instrument not in self._states:
+                    log.warning("No %s intrument on database. Adding with status UNSET." % instrument)
+                    self._states[instrument] = InstrumentState(InstrumentOperationFlag.UNSET.index, now, now)
+                    self._pending[instrument] = self._states[instrument].copy()
+
+            flags = dict([(instrument, InstrumentOperationFlag[self._states[instrument].status])
+                          for instrument in instruments])
+
+        if self._pending:
+            self.checkpoint()
+
+        return flags
+
+    def start(self):
+        if self._writer is not None:
+            return
+        self._stop.clear()
+        self._writer = threading.Thread(target=self._run, name='StatusStore writer')
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+    def stop(self):
+        '''
+        Stop the writer and write all changes to the database.
+        '''
+        self._stop.set()
+        self._wake.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        self.checkpoint()
+
+    def status(self, instrument):
+        '''
+        Flag (InstrumentOperationFlag) of instrument.
+        '''
+        with self._lock:
+            return InstrumentOperationFlag[self._states[instrument].status]
+
+    def keys(self, instrument):
+        '''
+        Active keys locking instrument.
+        '''
+        with self._lock:
+            return self._states[instrument].activeKeys()
+
+    def update(self, instrument, status, key=None):
+        '''
+        Change the flag of instrument. A locked instrument stays locked until all its keys are removed.
+
+        :param status: new flag (InstrumentOperationFlag).
+        :param key: key to lock (if status is LOCK) or unlock the instrument with.
+        :return: False if the instrument is locked with other keys and was not unlocked, True otherwise.
+        '''
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            state = self._states[instrument]
+            log.debug("Update %s status: %s -> %s" % (instrument,
+                                                      InstrumentOperationFlag[state.status],
+                                                      status))
+            old = state.status
+            updated = True
+
+            if state.status != InstrumentOperationFlag.LOCK.index: # Instrument currently unlocked
+                state.status = status.index
+                if key is not None and status == InstrumentOperationFlag.LOCK: # new status is a lock
+                    state.keys[key] = (True, now)
+            elif status != InstrumentOperationFlag.LOCK: # it is an unlock operation
+                if key in state.keys:
+                    state.keys[key] = (False, now)
+                if len(state.activeKeys()) == 0: # able to unlock instrument
+                    state.status = status.index
+                else:
+                    # Could not unlock instrument
+                    updated = False
+            else: # it is a new lock operation
+                state.keys[key] = (True, now)
+
+            state.lastUpdate = now
+            if state.status != old:
+                state.lastChange = now
+
+            self._pending[instrument] = state.copy()
+            if self.journal is not None:
+                self._lines.append((instrument, state.toJson(instrument)))
+            self._wake.set()
+
+        return updated
+
+    def sync(self):
+        '''
+        Append the changes not yet in the journal to it and sync it to disk.
+        '''
+        with self._writeLock:
+            with self._lock:
+                lines, self._lines = self._lines, []
+            self._writeJournal(lines)
+
+    def checkpoint(self):
+        '''
+        Write the changes to the database and empty the journal.
+        '''
+        with self._writeLock:
+            with self._lock:
+                lines, self._lines = self._lines, []
+                pending, self._pending = self._pending, {}
+            if not pending:
+                self._writeJournal(lines)
+                return
+
+            try:
+                self._writeJournal(lines)
+                self._writeDatabase(pending)
+            except Exception:
+                # keep the changes for the next checkpoint, unless they were changed again meanwhile
+                with self._lock:
+                    for instrument, state in pending.items():
+                        self._pending.setdefault(instrument, state)
+                raise
+
+            if self.journal is not None and os.path.exists(self.journal):
+                open(self.journal, 'w').close()
+
+    def _run(self):
+        lastCheckpoint = time.time()
+        while not self._stop.isSet():
+            self._wake.wait(self.checkpointInterval)
+            # let changes made close together go in the same batch
+            self._stop.wait(self.syncInterval)
+            self._wake.clear()
+            try:
+                self.sync()
+                if self._pending and time.time()-lastCheckpoint >= self.checkpointInterval:
+                    self.checkpoint()
+                    lastCheckpoint = time.time()
+            except Exception, e:
+                log.exception(e)
+
+    def _writeJournal(self, lines):
+        if self.journal is None or not lines:
+            return
+        # entries hold the whole state of the instrument, only the last one of each instrument is needed
+        latest = OrderedDict()
+        for instrument, line in lines:
+            latest.pop(instrument, None)
+            latest[instrument] = line
+        with open(self.journal, 'a') as journal:
+            journal.write('\n'.join(latest.values())+'\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def _readJournal(self):
+        if self.journal is None or not os.path.exists(self.journal):
+            return []
+        entries = []
+        with open(self.journal) as journal:
+            for line in journal:
+                if not line.strip():
+                    continue
+                try:
+                    entries.append(InstrumentState.fromJson(line))
+                except Exception, e:
+                    # last line may be incomplete if the supervisor died while writing it
+                    log.warning('Ignoring journal entry %s: %s' % (line.strip(), repr(e)))
+        if entries:
+            log.info('Replaying %i status changes from %s' % (len(entries), self.journal))
+        return entries
+
+    def _writeDatabase(self, pending):
+        session = self._session()
+        try:
+            for instrument, state in pending.items():
+                iostatus = session.query(InstrumentOperationStatus).filter(
+                    InstrumentOperationStatus.instrument == instrument).first()
+                if iostatus is None:
+                    iostatus = InstrumentOperationStatus(instrument=instrument)
+                    session.add(iostatus)
+                    session.flush()
+                iostatus.status = state.status
+                iostatus.lastUpdate = state.lastUpdate
+                iostatus.lastChange = state.lastChange
+
+                existing = dict([(k.key, k) for k in session.query(KeyList).filter(KeyList.key_id == iostatus.id)])
+                for key, (active, updatetime) in state.keys.items():
+                    if key not in existing:
+                        existing[key] = KeyList(key_id=iostatus.id, key=key)
+                        session.add(existing[key])
+                    existing[key].active = active
+                    existing[key].updatetime = updatetime
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
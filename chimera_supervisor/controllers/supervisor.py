@@ -6,9 +6,15 @@ import urllib
 
 from chimera_supervisor.controllers.machine import Machine
 from chimera_supervisor.controllers.checklist import CheckList
+from chimera_supervisor.controllers.weather import WeatherSnapshot
+from chimera_supervisor.controllers.proxyguard import ProxyGuard
+from chimera_supervisor.controllers.statusstore import StatusStore
+from chimera_supervisor.controllers.history import HistoryRecorder, summary
+from chimera_supervisor.controllers.model import Session, List
 from chimera_supervisor.controllers.status import OperationStatus, InstrumentOperationFlag
 from chimera_supervisor.controllers.states import State
 from chimera_supervisor.core.exceptions import StatusUpdateException
+from chimera_supervisor.core.constants import DEFAULT_STATUS_DATABASE
 
 from chimera.core.constants import SYSTEM_CONFIG_DIRECTORY
 from chimera.core.chimeraobject import ChimeraObject
@@ -26,6 +32,7 @@ import telegram.ext
 import logging
 import logging.handlers
 import time
+import datetime
 from collections import OrderedDict
 
 class Supervisor(ChimeraObject):
@@ -42,7 +49,18 @@ class Supervisor(ChimeraObject):
                     "telegram-broascast-ids": None,  # Telegram broadcast ids
                     "telegram-listen-ids": None,     # Telegram listen ids
                     "freq": 0.01  ,                  # Set manager watch frequency in Hz.
-                    "max_mins": 10                   # Maximum time, in minutes, data from weather station should have
+                    "max_mins": 10,                  # Maximum time, in minutes, data from weather station should have
+                    "weather_ttl": 30.,              # Time, in seconds, checks share weather readings (capped by item periods)
+                    "check_workers": 4,              # Number of checklist items checked at the same time
+                    "check_timeout": 60.,            # Time, in seconds, a check and each of its instrument calls may take
+                    "proxy_deadline": 10.,           # Time, in seconds, to wait for instrument calls of checks
+                    "proxy_deadlines": None,         # Per instrument deadlines, e.g. "dome:20,weatherstations:5"
+                    "response_deadline": 300.,       # Time, in seconds, to wait for instrument calls of responses
+                    "circuit_failures": 3,           # Consecutive timeouts before calls to an instrument fail right away
+                    "circuit_reset": 300.,           # Time, in seconds, before trying a failing instrument again
+                    "status_sync": 1.,               # Time, in seconds, flag changes are gathered before syncing them
+                    "status_checkpoint": 60.,        # Time, in seconds, between writes of flag changes to the database
+                    "history_flush": 10.             # Time, in seconds, between writes of the flag and checklist history
                  }
 
     def __init__(self):
@@ -74,6 +92,10 @@ class Supervisor(ChimeraObject):
         self.checklist = None
         self.machine = None
         self.bot = None
+        self.weather = WeatherSnapshot()
+        self.guard = ProxyGuard()
+        self.statusStore = StatusStore(DEFAULT_STATUS_DATABASE+'.journal')
+        self.history = HistoryRecorder()
 
 
     def __start__(self):
@@ -95,6 +117,20 @@ class Supervisor(ChimeraObject):
                     for i, ainstrument in enumerate(self._instrument_list[instrument]):
                         self._operationStatus[instrument+'_%02i' % (i+1)] = InstrumentOperationFlag.UNSET
 
+        self.weather.ttl = self["weather_ttl"]
+        self.weather.maxMins = self["max_mins"]
+
+        self.guard.deadline = self["proxy_deadline"]
+        self.guard.deadlines = ProxyGuard.parseDeadlines(self["proxy_deadlines"])
+        self.guard.failures = self["circuit_failures"]
+        self.guard.resetTime = self["circuit_reset"]
+
+        self.statusStore.syncInterval = self["status_sync"]
+        self.statusStore.checkpointInterval = self["status_checkpoint"]
+
+        self.history.flushInterval = self["history_flush"]
+        self.history.start()
+
         self.checklist = CheckList(self)
         self.machine = Machine(self.checklist, self)
 
@@ -120,6 +156,9 @@ class Supervisor(ChimeraObject):
 
         self.machine.state(State.SHUTDOWN)
         self.checklist.mustStop.set()
+        self.checklist.close()
+        self.statusStore.stop()
+        self.history.stop()
 
         if self.isTelegramConnected():
             self.disconnectTelegram()
@@ -501,6 +540,26 @@ class Supervisor(ChimeraObject):
     def getRobObs(self,index=0):
         return self.getManager().getProxy(self["robobs"][index])
 
+    def getHistory(self, hours=24., end=None):
+        '''
+        Statistics of the instrument flags and checklist items in the given number of hours before end (UTC, now by
+        default). See history.summary.
+        '''
+        self.history.flush()
+        end = end or datetime.datetime.utcnow()
+        session = Session()
+        try:
+            items = [str(name) for name, in session.query(List.name)]
+        finally:
+            session.close()
+        return summary(self.getInstrumentList(), items, end-datetime.timedelta(hours=hours), end)
+
+    def getProxyStatus(self):
+        '''
+        Circuit state and call latencies of the instruments used by the checklist.
+        '''
+        return self.guard.status()
+
     def getItems(self):
         return self.checklist.itemsList
 
@@ -511,6 +570,7 @@ class Supervisor(ChimeraObject):
         return self._operationStatus.keys()
 
     def setFlag(self, instrument, flag, updatedb= True):
+        old = self._operationStatus.get(instrument)
         if updatedb:
             if self.checklist.updateInstrumentStatus(instrument,flag):
                 self._operationStatus[instrument] = flag
@@ -520,6 +580,25 @@ class Supervisor(ChimeraObject):
         else:
             self._operationStatus[instrument] = flag
 
+        self._flagChanged(instrument, old, updatedb)
+
+    def _flagChanged(self, instrument, old, record=True):
+        if self._operationStatus[instrument] == old:
+            return
+        if record:
+            self.history.flagChanged(instrument, self._operationStatus[instrument])
+        self.trigger("flag:%s" % instrument)
+
+    def trigger(self, event):
+        '''
+        Check right away the checklist items that depend on event. Events are the names of the telescope and scheduler
+        events the supervisor listens to (e.g. "slewBegin", "programComplete") and "flag:<instrument>" when an
+        instrument flag changes. Items can also list events in their triggers.
+        '''
+        if self.machine is None:
+            return False
+        return self.machine.trigger(event)
+
     def getFlag(self,instrument):
         return self._operationStatus[instrument]
 
@@ -546,10 +625,12 @@ class Supervisor(ChimeraObject):
 
     def lockInstrument(self,instrument,key):
 
+        old = self._operationStatus.get(instrument)
         if self.checklist.updateInstrumentStatus(instrument,
                                                  InstrumentOperationFlag.LOCK,
                                                  key):
             self._operationStatus[instrument] = InstrumentOperationFlag.LOCK
+            self._flagChanged(instrument, old)
         else:
             self.log.warning("Could not change instrument status.")
 
@@ -569,6 +650,7 @@ class Supervisor(ChimeraObject):
                                                  InstrumentOperationFlag.CLOSE,
                                                  key):
             self._operationStatus[instrument] = InstrumentOperationFlag.CLOSE
+            self._flagChanged(instrument, InstrumentOperationFlag.LOCK)
             return True
         else:
             raise StatusUpdateException("Unable to unlock %s with provided key"%(instrument))
@@ -653,16 +735,18 @@ class Supervisor(ChimeraObject):
 
     def _watchSlewBegin(self, target):
         self.setFlag("telescope",InstrumentOperationFlag.OPERATING)
+        self.trigger("slewBegin")
 
     def _watchSlewComplete(self, position, status):
-        pass
+        self.trigger("slewComplete")
 
     def _watchTrackingStarted(self, position):
         # Todo
-        pass
+        self.trigger("trackingStarted")
 
     def _watchTrackingStopped(self, position, status):
         self.setFlag("telescope",InstrumentOperationFlag.READY)
+        self.trigger("trackingStopped")
         self.broadCast('Telescope tracking stopped with status %s.' % status)
         if status == TelescopeStatus.OBJECT_TOO_LOW:
             # Todo: Make this an action on the checklist database, so user can configure what to do
@@ -685,18 +769,22 @@ class Supervisor(ChimeraObject):
         self.broadCast("Telescope parked")
         self.setFlag("telescope",InstrumentOperationFlag.CLOSE)
         self.setFlag("dome",InstrumentOperationFlag.CLOSE)
+        self.trigger("parkComplete")
 
     def _watchTelescopeUnpark(self):
 
         self.broadCast("Telescope unparked")
         self.setFlag("telescope",InstrumentOperationFlag.READY)
         self.setFlag("dome",InstrumentOperationFlag.READY)
+        self.trigger("unparkComplete")
 
     def _watchProgramBegin(self,program):
         if self.getFlag("scheduler") != InstrumentOperationFlag.OPERATING:
             self.setFlag("scheduler",InstrumentOperationFlag.OPERATING)
+        self.trigger("programBegin")
 
     def _watchProgramComplete(self, program, status, message=None):
+        self.trigger("programComplete")
         if status == SchedStatus.ERROR:
             msg = "Scheduler in ERROR"
             if message is not None:
@@ -720,6 +808,7 @@ class Supervisor(ChimeraObject):
             self.setFlag("scheduler",InstrumentOperationFlag.OPERATING)
         else:
             self.setFlag("scheduler",InstrumentOperationFlag.READY)
+        self.trigger("stateChanged")
 
     @lock
     def status(self,new=None):
@@ -0,0 +1,170 @@
+'''
+Snapshot of the weather station readings used by the checklist handlers. When a reading is needed, every quantity
+that is out of date is read from every station in a single pass and kept for a few seconds, so all the weather items
+of a checklist pass share the same readings instead of polling the stations themselves. Stations are called without
+holding the snapshot lock: readers of a quantity being read wait for that pass only. Stations that do not answer (see ProxyGuard) are not hidden as missing readings: if
+no station could be reached, the error reaches the checklist, which marks the item as an error.
+'''
+
+import time
+import datetime
+import threading
+import logging
+
+from chimera_supervisor.core.exceptions import ProxyTimeoutException, CircuitOpenException
+
+log = logging.getLogger(__name__)
+
+# Quantities available from the weather stations (method names of the chimera WeatherStation interface)
+WEATHER_QUANTITIES = ['temperature', 'humidity', 'wind_speed', 'dew_point', 'sky_transparency']
+
+
+class WeatherSnapshot(object):
+    '''
+    Last readings of every weather station.
+
+    :param stations: weather station proxies.
+    :param ttl: time (s) readings are reused before reading the stations again.
+    :param maxMins: readings older than this (minutes, from the reading time) are not valid.
+    '''
+
+    def __init__(self, stations=None, ttl=30., maxMins=10.):
+        self.ttl = ttl
+        self.maxMins = maxMins
+        self._stations = list(stations or [])
+        self._readings = {}
+        # quantity: Event set when the pass reading it ends
+        self._fetching = {}
+        self._lock = threading.Lock()
+
+    def setStations(self, stations):
+        with self._lock:
+            self._stations = list(stations)
+            self._readings = {}
+
+    def __len__(self):
+        return len(self._stations)
+
+    def expire(self):
+        '''
+        Discard all readings, next access reads the stations again.
+        '''
+        with self._lock:
+            self._readings = {}
+
+    def refresh(self, quantities=None):
+        '''
+        Read the given quantities (all by default) from every station, if the last readings are older than ttl.
+        '''
+        for quantity in (quantities or WEATHER_QUANTITIES):
+            self.readings(quantity)
+
+    def _isFresh(self, quantity, now):
+        return quantity in self._readings and now-self._readings[quantity][0] < self.ttl
+
+    def _read(self, quantity):
+        '''
+        Readings of quantity and, for each station, the error that kept it from answering (timeout or open circuit),
+        if any.
+        '''
+        with self._lock:
+            now = time.time()
+            if self._isFresh(quantity, now):
+                return self._readings[quantity][1:]
+
+            stations = list(self._stations)
+            done = self._fetching.get(quantity)
+            if done is None:
+                # read every quantity that is out of date, unless another pass is already reading it
+                quantities = [q for q in WEATHER_QUANTITIES if not self._isFresh(q, now) and q not in self._fetching]
+                if quantity not in quantities:
+                    quantities.append(quantity)
+                done = threading.Event()
+                for q in quantities:
+                    self._fetching[q] = done
+            else:
+                quantities = None
+
+        if quantities is None:
+            done.wait()
+        else:
+            try:
+                results = self._fetch(stations, quantities)
+                with self._lock:
+                    self._readings.update(results)
+            finally:
+                with self._lock:
+                    for q in quantities:
+                        if self._fetching.get(q) is done:
+                            del self._fetching[q]
+                done.set()
+
+        with self._lock:
+            if quantity in self._readings:
+                return self._readings[quantity][1:]
+        return [None]*len(stations), [None]*len(stations)
+
+    def _fetch(self, stations, quantities):
+        # read the quantities from every station. A station that does not answer (timeout or open circuit) is not
+        # called again in the same pass.
+        now = time.time()
+        readings = dict([(q, []) for q in quantities])
+        errors = dict([(q, []) for q in quantities])
+        for i, station in enumerate(stations):
+            error = None
+            for quantity in quantities:
+                value = None
+                if error is None:
+                    try:
+                        value = getattr(station, quantity)()
+                    except (ProxyTimeoutException, CircuitOpenException), e:
+                        log.warning('Weather station %i not answering: %s' % (i, e))
+                        error = e
+                    except Exception, e:
+                        log.debug('Could not read %s from weather station %i: %s' % (quantity, i, repr(e)))
+                readings[quantity].append(value)
+                errors[quantity].append(error)
+        return dict([(q, (now, readings[q], errors[q])) for q in quantities])
+
+    def readings(self, quantity):
+        '''
+        Reading of quantity from each station (None for stations that could not be read).
+
+        :raise ProxyTimeoutException, CircuitOpenException: if no station answered.
+        '''
+        readings, errors = self._read(quantity)
+        if len(errors) > 0 and None not in errors:
+            raise errors[0]
+        return readings
+
+    def reading(self, quantity, index):
+        '''
+        Reading of quantity from station index, or None.
+
+        :raise ProxyTimeoutException, CircuitOpenException: if the station did not answer.
+        '''
+        readings, errors = self._read(quantity)
+        if not 0 <= index < len(readings):
+            return None
+        if errors[index] is not None:
+            raise errors[index]
+        return readings[index]
+
+    def isFresh(self, reading):
+        '''
+        Check that a station reading exists and is recent enough.
+        '''
+        try:
+            return reading is not None and \
+                datetime.datetime.utcnow() - reading.time < datetime.timedelta(minutes=self.maxMins)
+        except Exception:
+            return False
+
+    def first(self, quantity):
+        '''
+        First valid reading of quantity, in station order, or None.
+        '''
+        for reading in self.readings(quantity):
+            if self.isFresh(reading):
+                return reading
+        return None
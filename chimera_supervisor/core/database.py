@@ -0,0 +1,229 @@
+'''
+Engines and sessions of the SQLite databases (checklist, instrument status and robotic scheduler). All engines are
+created here with the same tuning:
+
+- WAL journal, so readers (e.g. the command line tools) do not block the writers and the other way around;
+- synchronous NORMAL, which is safe with WAL and avoids a sync on every commit;
+- a busy timeout, so concurrent writers wait for each other instead of failing with "database is locked";
+- optionally, a pool of connections kept open (see configure).
+
+There is a single engine per database in a process, shared by all the sessions. The databases of the models are
+Database objects: their engine is only created, and their tables only created or upgraded, when the first session is
+opened, so importing a model (e.g. in a command line tool that only talks to the supervisor) does not touch the disk.
+'''
+
+import os
+import threading
+import logging
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
+from sqlalchemy.pool import NullPool, QueuePool, StaticPool
+
+log = logging.getLogger(__name__)
+
+# Settings of the engines created from now on (see configure)
+_options = {'journalMode': 'WAL',      # SQLite journal mode
+            'synchronous': 'NORMAL',   # SQLite synchronous setting
+            'busyTimeout': 30.,        # Time, in seconds, to wait for a locked database
+            'poolSize': 0,             # Connections kept open by each engine, 0 opens one per session
+            'echo': False}
+
+_engines = {}
+_databases = []
+_lock = threading.RLock()
+
+
+def configure(**options):
+    '''
+    Change the settings (journalMode, synchronous, busyTimeout, poolSize, echo) of the engines created afterwards.
+    '''
+    for option in options:
+        if option not in _options:
+            raise ValueError('Unknown database option %s.' % option)
+    _options.update(options)
+
+
+def _isMemory(url):
+    return url in ('sqlite://', 'sqlite:///:memory:')
+
+
+def createEngine(url, **options):
+    '''
+    New engine for url, with the tuning of this module. Prefer getEngine, which shares engines.
+    '''
+    settings = dict(_options)
+    settings.update(options)
+
+    kwargs = {'echo': settings['echo'],
+              'connect_args': {'timeout': settings['busyTimeout'],
+                               'check_same_thread': False}}
+    if _isMemory(url):
+        # a single connection, otherwise each session would see a different database
+        kwargs['poolclass'] = StaticPool
+    elif settings['poolSize'] > 0:
+        kwargs['poolclass'] = QueuePool
+        kwargs['pool_size'] = settings['poolSize']
+        kwargs['max_overflow'] = settings['poolSize']
+    else:
+        kwargs['poolclass'] = NullPool
+
+    engine = create_engine(url, **kwargs)
+
+    if not _isMemory(url):
+        journalMode = settings['journalMode']
+        synchronous = settings['synchronous']
+        busyTimeout = int(settings['busyTimeout']*1000)
+
+        @event.listens_for(engine, 'connect')
+        def setPragmas(connection, record):
+            cursor = connection.cursor()
+            if journalMode is not None:
+                cursor.execute('PRAGMA journal_mode=%s' % journalMode)
+            if synchronous is not None:
+                cursor.execute('PRAGMA synchronous=%s' % synchronous)
+            cursor.execute('PRAGMA busy_timeout=%i' % busyTimeout)
+            cursor.close()
+
+    log.debug('Engine created for %s' % url)
+    return engine
+
+
+def getEngine(url):
+    '''
+    Engine of the database at url, created on first use.
+    '''
+    with _lock:
+        if url not in _engines:
+            _engines[url] = createEngine(url)
+        return _engines[url]
+
+
+class ScratchSession(Session):
+    '''
+    Session that never writes to the database: changes are kept in memory only, flush and commit do nothing. See
+    Database.scratch.
+    '''
+
+    def flush(self, objects=None):
+        pass
+
+    def commit(self):
+        pass
+
+
+class LazySessionMaker(sessionmaker):
+    '''
+    sessionmaker of a Database, bound to its engine when the first session is opened. Binding it to another engine
+    with configure(bind=...) before that (e.g. a memory database) leaves the Database untouched.
+    '''
+
+    def __init__(self, database, **kw):
+        sessionmaker.__init__(self, **kw)
+        self._database = database
+
+    def __call__(self, **local_kw):
+        if local_kw.get('bind') is None:
+            local_kw.pop('bind', None)
+            if self.kw.get('bind') is None:
+                self.configure(bind=self._database.engine())
+
+        sessions = getattr(self._database._local, 'sessions', None)
+        if sessions is None:
+            return sessionmaker.__call__(self, **local_kw)
+
+        for key, value in self.kw.items():
+            local_kw.setdefault(key, value)
+        session = ScratchSession(**local_kw)
+        sessions.append(session)
+        return session
+
+
+class Database(object):
+    '''
+    Database of a model, initialised on first use.
+
+    :param url: default URL of the database.
+    :param metaData: MetaData of the model, its tables are created on the first use.
+    :param variable: environment variable that, if set, overrides url.
+    :param init: function called with the engine after the tables are created (e.g. to upgrade their columns).
+    '''
+
+    def __init__(self, url, metaData, variable=None, init=None):
+        self._url = os.environ.get(variable, url) if variable is not None else url
+        self.metaData = metaData
+        self._init = init
+        self._engine = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self.Session = LazySessionMaker(self)
+        # Session of the calling thread, for threads that write often
+        self.ScopedSession = scoped_session(self.Session)
+
+        with _lock:
+            _databases.append(self)
+
+    @property
+    def url(self):
+        return self._url
+
+    def setUrl(self, url):
+        '''
+        Change the URL of the database. Only possible before it is first used.
+        '''
+        with self._lock:
+            if self._engine is not None and url != self._url:
+                raise ValueError('Database %s already in use, cannot change it to %s.' % (self._url, url))
+            self._url = url
+
+    def initialised(self):
+        return self._engine is not None
+
+    def engine(self):
+        '''
+        Engine of the database. On the first call the engine is created and the tables of the model created (and
+        upgraded) if needed.
+        '''
+        with self._lock:
+            if self._engine is None:
+                engine = getEngine(self._url)
+                self.metaData.bind = engine
+                self.metaData.create_all(engine)
+                if self._init is not None:
+                    self._init(engine)
+                self._engine = engine
+                log.debug('Database %s ready' % self._url)
+            return self._engine
+
+    @contextmanager
+    def scratch(self):
+        '''
+        Sessions opened by the calling thread inside the block are ScratchSessions: they read from the database but
+        never write to it, and are rolled back and closed at the end of the block, so whatever they change is thrown
+        away (e.g. to try a selection without keeping what it writes). Queries do not see the changes of the block.
+        Other threads and the sessions opened before the block are not affected.
+        '''
+        self._local.sessions = []
+        try:
+            yield
+        finally:
+            sessions, self._local.sessions = self._local.sessions, None
+            for session in sessions:
+                try:
+                    session.rollback()
+                    session.close()
+                except Exception, e:
+                    log.exception(e)
+
+
+def dispose():
+    '''
+    Close the connections of all engines (e.g. before forking).
+    '''
+    with _lock:
+        for database in _databases:
+            database.ScopedSession.remove()
+        for engine in _engines.values():
+            engine.dispose()
@@ -8,4 +8,10 @@ class CheckExecutionException(ChimeraException):
     pass
 
 class StatusUpdateException(ChimeraException):
-    pass
\ No newline at end of file
+    pass
+
+class ProxyTimeoutException(ChimeraException):
+    pass
+
+class CircuitOpenException(ChimeraException):
+    pass
@@ -5,7 +5,7 @@ setup(
     version='0.0.1',
     packages=['chimera_supervisor', 'chimera_supervisor.controllers', 'chimera_supervisor.controllers.scheduler',
               'chimera_supervisor.core', 'chimera_supervisor.controllers.scheduler.algorithms'],
-    scripts=['scripts/chimera-supervisor', 'scripts/chimera-robobs'],
+    scripts=['scripts/chimera-supervisor', 'scripts/chimera-robobs', 'scripts/chimera-schedbench'],
     url='http://github.com/astroufsc/chimera-supervisor',
     license='GPL v2',
     author='Tiago Ribeiro',